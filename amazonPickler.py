@@ -12,6 +12,7 @@ import ankura.label as label
 import ankura.pipeline
 
 from classtm.labeled import AbstractClassifiedDataset, get_labels, get_classorder
+from classtm.corpus import corpus_path, save_corpus
 from activetm import utils
 
 
@@ -34,20 +35,29 @@ def _run():
     parser = argparse.ArgumentParser(description='Pickler of ClassTM datasets')
     parser.add_argument('settings', help='path to a file containing settings')
     parser.add_argument('outputdir', help='directory for output')
+    parser.add_argument('--corpus', action='store_true',
+                        help='write a corpus directory, which loads much '
+                        'faster, instead of a pickle')
     args = parser.parse_args()
 
     start = time.time()
     settings = utils.parse_settings(args.settings)
     pickle_name = utils.get_pickle_name(args.settings)
-    if not os.path.exists(os.path.join(args.outputdir, pickle_name)):
+    output = os.path.join(args.outputdir, pickle_name)
+    if args.corpus:
+        output = corpus_path(output)
+    if not os.path.exists(output):
         pre_dataset = get_dataset(settings)
         labels = get_labels(settings['labels'])
         classorder = get_classorder(labels)
         dataset = AbstractClassifiedDataset(pre_dataset,
                                             labels,
                                             classorder)
-        with open(os.path.join(args.outputdir, pickle_name), 'wb') as ofh:
-            pickle.dump(dataset, ofh)
+        if args.corpus:
+            save_corpus(dataset, output)
+        else:
+            with open(output, 'wb') as ofh:
+                pickle.dump(dataset, ofh)
     end = time.time()
     import_time = datetime.timedelta(seconds=end-start)
     with open(os.path.join(args.outputdir, pickle_name+'_import.time'), 'w') as ofh:
@@ -0,0 +1,81 @@
+"""Check that CooccurrenceAccumulator builds the same Q as ClassifiedDataset
+
+Streams the documents of a pickled dataset (or corpus directory) into a
+CooccurrenceAccumulator and compares its Q with that of a ClassifiedDataset
+built from the same dataset, for each form of label_weight
+"""
+import argparse
+import time
+
+import numpy as np
+
+import classtm.corpus
+import classtm.labeled
+
+
+# one of each form get_label_weight_function takes
+LABEL_WEIGHTS = ['500', 'doc:0.5', 'corpus:0.01']
+
+
+def parse_args():
+    """Parses arguments"""
+    parser = argparse.ArgumentParser(
+        description='Compare streamed Q with ClassifiedDataset Q')
+    parser.add_argument('dataset', help='path to pickled dataset or corpus '
+                        'directory')
+    parser.add_argument('--smoothing', type=float, default=0.01)
+    parser.add_argument('--label-weights', nargs='*', default=LABEL_WEIGHTS,
+                        help='label_weight settings to compare under')
+    parser.add_argument('--chunk-size', type=int, default=1024,
+                        help='documents the accumulator buffers at a time')
+    return parser.parse_args()
+
+
+def _accumulated_q(dataset, smoothing, label_weight, chunk_size):
+    """Q of dataset, built by streaming its documents into a
+    CooccurrenceAccumulator"""
+    accumulator = classtm.labeled.CooccurrenceAccumulator(
+        len(dataset.vocab),
+        dataset.classorder,
+        smoothing,
+        label_weight,
+        corpussize=dataset.num_docs,
+        chunk_size=chunk_size)
+    accumulator.add_documents(
+        (dataset.doc_tokens(docnum), dataset.labels[title])
+        for docnum, title in enumerate(dataset.titles))
+    return accumulator.Q
+
+
+def _dataset_q(dataset, smoothing, label_weight):
+    """Q of a ClassifiedDataset built from dataset"""
+    return np.asarray(classtm.labeled.ClassifiedDataset(dataset,
+                                                        dataset.labels,
+                                                        dataset.classorder,
+                                                        smoothing,
+                                                        label_weight).Q)
+
+
+def _run():
+    args = parse_args()
+    dataset = classtm.corpus.load_dataset(args.dataset)
+    for label_weight in args.label_weights:
+        start = time.time()
+        expected = _dataset_q(dataset, args.smoothing, label_weight)
+        dataset_time = time.time() - start
+        start = time.time()
+        streamed = _accumulated_q(dataset,
+                                  args.smoothing,
+                                  label_weight,
+                                  args.chunk_size)
+        streamed_time = time.time() - start
+        print('label_weight', label_weight)
+        print('\tmax absolute Q difference:',
+              np.max(np.abs(streamed - expected)))
+        print('\tmax absolute Q entry:', np.max(np.abs(expected)))
+        print('\tClassifiedDataset: {:.3f} s, accumulator: {:.3f} s'.format(
+            dataset_time, streamed_time))
+
+
+if __name__ == '__main__':
+    _run()
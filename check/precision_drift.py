@@ -0,0 +1,103 @@
+"""Check how much accuracy drifts when running in float32 instead of float64"""
+import os
+import pickle
+import random
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from activetm import utils
+from classtm import evaluate
+
+
+FILE_DIR = os.path.dirname(__file__)
+REPO_DIR = os.path.join(FILE_DIR, os.pardir)
+OUT_DIR = '/local/okuda/tmp'
+PRECISIONS = ['float64', 'float32']
+
+
+def _write_settings(settings, precision):
+    """Write a copy of the settings file settings that runs with precision
+
+    Returns the path to the copy and the group its results get written to
+    """
+    parsed = utils.parse_settings(os.path.join(FILE_DIR, settings))
+    parsed['group'] = parsed['group'] + '.' + precision
+    parsed['precision'] = precision
+    outname = os.path.join(OUT_DIR, parsed['group'] + '.settings')
+    with open(outname, 'w') as ofh:
+        for key, value in sorted(parsed.items()):
+            ofh.write(key + '\t' + value + '\n')
+    return outname, parsed['group']
+
+
+def _run_experiments(settingses, num):
+    """Run experiments with settings in settingses at each precision, each
+    repeated num times with the same seed for every precision"""
+    for i in range(num):
+        cur_seed = random.randint(0, sys.maxsize)
+        for settings in settingses:
+            for precision in PRECISIONS:
+                filename, _ = _write_settings(settings, precision)
+                print('====', cur_seed, filename, '====', flush=True)
+                start = time.time()
+                subprocess.run([
+                    'python3',
+                    os.path.join(REPO_DIR, 'incremental_submain.py'),
+                    filename,
+                    OUT_DIR,
+                    str(i),
+                    str(cur_seed)])
+                print('####', time.time() - start, flush=True)
+
+
+def _load_run(group, i):
+    """Returns per-round accuracies and final Q of run i of group"""
+    prefix = os.path.join(OUT_DIR, group, str(i))
+    with open(prefix + '.results', 'rb') as ifh:
+        results = pickle.load(ifh)
+    accuracies = [evaluate.accuracy(result['confusion_matrix'])
+                  for result in results]
+    with open(prefix + '.Q', 'rb') as ifh:
+        cooccurrences = pickle.load(ifh)
+    return np.array(accuracies), cooccurrences
+
+
+def _report(settingses, num):
+    """Print how far float32 runs drift from float64 runs"""
+    for settings in settingses:
+        groups = [_write_settings(settings, precision)[1]
+                  for precision in PRECISIONS]
+        drifts = []
+        q_diffs = []
+        for i in range(num):
+            base_acc, base_q = _load_run(groups[0], i)
+            test_acc, test_q = _load_run(groups[1], i)
+            drifts.append(test_acc - base_acc)
+            q_diffs.append(np.max(np.abs(
+                test_q.astype(np.float64) - base_q)))
+        drifts = np.array(drifts)
+        print(settings)
+        print('\taccuracy drift per round (mean):', drifts.mean(axis=0))
+        print('\tmax absolute accuracy drift:', np.abs(drifts).max())
+        print('\tmax absolute Q difference:', max(q_diffs))
+
+
+def _run():
+    """Run experiments and report drift"""
+    settingses = [
+        'neg.settings',
+        'noneg.settings',
+        'zeroneg.settings',
+        'projected.settings',
+        'sup.settings',
+        ]
+    num = 10
+    _run_experiments(settingses, num)
+    _report(settingses, num)
+
+
+if __name__ == '__main__':
+    _run()
@@ -0,0 +1,83 @@
+"""Micro-benchmark of single document prediction latency
+
+Times predict_one against predict([tokens]) on documents of a pickled dataset
+and prints the distribution of per-call latencies, along with how each infers
+topic mixtures (predict_one always in memory, predict by running lda-c for
+models with the variational helper)
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+import classtm.corpus
+import classtm.scoring
+
+
+PERCENTILES = [50, 90, 99, 100]
+
+
+def parse_args():
+    """Parses arguments"""
+    parser = argparse.ArgumentParser(
+        description='Latency of single document prediction')
+    parser.add_argument('model',
+                        help='export directory, pickled model, or results')
+    parser.add_argument('dataset', help='path to pickled dataset or corpus '
+                        'directory')
+    parser.add_argument('--docs', type=int, default=1000,
+                        help='number of documents to time')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def _time_calls(predict, docs):
+    """Returns the predictions and per-call latencies (in seconds) of predict
+    on each document of docs"""
+    predictions = []
+    latencies = np.empty(len(docs))
+    for i, doc in enumerate(docs):
+        start = time.perf_counter()
+        predictions.append(predict(doc))
+        latencies[i] = time.perf_counter() - start
+    return predictions, latencies
+
+
+def _report(name, latencies):
+    """Print latency percentiles in milliseconds"""
+    print(name)
+    for percentile, value in zip(PERCENTILES,
+                                 np.percentile(latencies, PERCENTILES)):
+        print('\tp{:d}: {:.3f} ms'.format(percentile, value * 1000))
+    print('\tmean: {:.3f} ms'.format(latencies.mean() * 1000))
+
+
+def _run():
+    args = parse_args()
+    model = classtm.scoring.load_model(args.model)
+    dataset = classtm.corpus.load_dataset(args.dataset)
+    doc_ids = random.Random(args.seed).sample(range(dataset.num_docs),
+                                              min(args.docs, dataset.num_docs))
+    docs = [list(dataset.doc_tokens(doc_id)) for doc_id in doc_ids]
+    # the first call builds the scratch buffers and dense weights
+    start = time.perf_counter()
+    model.predict_one(docs[0])
+    print('first call: {:.3f} ms'.format(
+        (time.perf_counter() - start) * 1000))
+    # e.g., VariationalInference (in memory) against VariationalHelper or
+    # LdacInference (lda-c inf) for models that infer with lda-c
+    print('topic inference: predict_one with {:s}, predict with {:s}'.format(
+        type(model._scorer.inference).__name__,
+        type(model.lda).__name__))
+    one, one_latencies = _time_calls(model.predict_one, docs)
+    batch, batch_latencies = _time_calls(lambda doc: model.predict([doc])[0],
+                                         docs)
+    _report('predict_one', one_latencies)
+    _report('predict([tokens])', batch_latencies)
+    agree = np.mean([a == b for a, b in zip(one, batch)])
+    print('predictions that agree: {:.2%}'.format(agree))
+
+
+if __name__ == '__main__':
+    _run()
@@ -0,0 +1,33 @@
+"""Command line entry point: python3 -m classtm {serve,predict} ..."""
+
+import argparse
+
+import classtm.serve
+import classtm.stream
+
+
+def parse_args():
+    """Parses arguments"""
+    parser = argparse.ArgumentParser(prog='classtm',
+                                     description='Use trained ClassTM models')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    classtm.serve.add_arguments(commands.add_parser(
+        'serve',
+        help='serve predictions over a socket'))
+    classtm.stream.add_arguments(commands.add_parser(
+        'predict',
+        help='predict labels for a file of documents'))
+    return parser.parse_args()
+
+
+def _run():
+    args = parse_args()
+    if args.command == 'serve':
+        classtm.serve.main(args)
+    elif args.command == 'predict':
+        classtm.stream.main(args)
+
+
+if __name__ == '__main__':
+    _run()
@@ -1,32 +1,155 @@
 """Classifiers"""
+from concurrent.futures import ThreadPoolExecutor
 import os
+import shutil
 import subprocess
+import time
 
 import numpy as np
+from sklearn.svm import LinearSVC
+
+import classtm.scoring
 
 
 FILE_DIR = os.path.dirname(os.path.abspath(__file__))
 SVM_DIR = os.path.join(FILE_DIR, 'svm_light')
 SVM_LEARN = os.path.join(SVM_DIR, 'svm_learn')
 SVM_CLASSIFY = os.path.join(SVM_DIR, 'svm_classify')
+# every line of a training file starts with a label column of this many
+# characters, so that one file of features can be relabeled for each class
+LABEL_WIDTH = 2
+PLACEHOLDER_LABEL = '0 '
+# what each line starts with before labels are patched in: the label column,
+# then the space separating it from the features (so that the column can hold
+# '+1' and '-1'); unpatched lines thus have two spaces after the 0
+LINE_START = PLACEHOLDER_LABEL.ljust(LABEL_WIDTH) + ' '
+# number of rows formatted at a time when writing SVMLight files
+SVMLIGHT_BLOCK_ROWS = 4096
+
+
+def _run_timed(args):
+    """Runs args as a subprocess
+
+    Returns the time taken (in seconds) and whatever the subprocess wrote to
+    stderr
+    """
+    start = time.time()
+    completed = subprocess.run(args, stderr=subprocess.PIPE)
+    return time.time() - start, completed.stderr.decode(errors='replace')
+
+
+def _format_values(data):
+    """Same as [str(datum) for datum in data], as a np.array of str
+
+    Most features are word counts, which are whole numbers; those are
+    formatted as integers, which is much faster than formatting floats
+    """
+    whole = (data == np.trunc(data)) & (np.abs(data) < 1e6) & (data != 0)
+    # no float's str is longer than 32 characters
+    result = np.empty(len(data), dtype='U32')
+    result[whole] = np.char.add(data[whole].astype(np.int64).astype('U'),
+                                '.0')
+    fractions = data[~whole]
+    if fractions.dtype == np.float64:
+        # Python's float repr is the same as numpy's str, only faster
+        result[~whole] = list(map(repr, fractions.tolist()))
+    else:
+        result[~whole] = fractions.astype('U')
+    return result
+
+
+def _format_block(block):
+    """Formats the rows of block (a csr matrix) as SVMLight lines, each
+    starting with LINE_START
+
+    Returns bytes
+    """
+    # str(col+1)+':'+str(datum)+' ' for every entry at once
+    entries = np.char.add(
+        np.char.add(np.char.add((block.indices + 1).astype('U'), ':'),
+                    _format_values(block.data)),
+        ' ').astype(object)
+    # each row's entries get preceded by its label and followed by a newline
+    positions = np.column_stack([block.indptr[:-1],
+                                 block.indptr[1:]]).ravel()
+    delimiters = np.tile(np.array([LINE_START, '\n'], dtype=object),
+                         block.shape[0])
+    return ''.join(np.insert(entries, positions, delimiters).tolist()).encode()
+
+
+def write_svmlight(filename, features):
+    """Writes features (a csr matrix) to filename in SVMLight format, with the
+    placeholder label on every line
+
+    Returns the byte offsets of the beginnings of the lines, as a 1D np.array
+    """
+    line_starts = [np.zeros(0, dtype=np.int64)]
+    written = 0
+    with open(filename, 'wb') as ofh:
+        for start in range(0, features.shape[0], SVMLIGHT_BLOCK_ROWS):
+            block = features[start:start+SVMLIGHT_BLOCK_ROWS]
+            block.sort_indices()
+            formatted = _format_block(block)
+            # each line starts just after the newline ending the one before
+            ends = np.flatnonzero(
+                np.frombuffer(formatted, dtype=np.uint8) == ord('\n')) + 1
+            line_starts.append(written + np.concatenate([[0], ends[:-1]]))
+            ofh.write(formatted)
+            written += len(formatted)
+    return np.concatenate(line_starts)
+
+
+def read_predictions(filename):
+    """Reads the output of svm_classify into a 1D np.array"""
+    with open(filename, 'rb') as ifh:
+        return np.array(ifh.read().split(), dtype=float)
+
+
+def _patch_labels(filename, line_starts, labels):
+    """Overwrites the label column of each line in filename
+
+        * line_starts :: 1D np.array
+            byte offsets of the beginnings of the lines in filename
+        * labels :: 1D np.array
+            LABEL_WIDTH-character label for each line
+    """
+    if not len(line_starts):
+        return
+    patch = np.frombuffer(
+        np.asarray(labels, dtype='S'+str(LABEL_WIDTH)).tobytes(),
+        dtype=np.uint8).reshape(-1, LABEL_WIDTH)
+    mapped = np.memmap(filename, dtype=np.uint8, mode='r+')
+    mapped[line_starts[:, np.newaxis] + np.arange(LABEL_WIDTH)] = patch
+    mapped.flush()
+    del mapped
 
 
 class TSVM:
-    """Transductive support vector machine"""
+    """Transductive support vector machine
 
-    def __init__(self, varname, classorder):
+    One-vs-rest, with the SVMLight runs for the classes done concurrently on
+    up to workers subprocesses at a time
+    """
+
+    def __init__(self, varname, classorder, workers=None):
         self.outdir = varname+'_tsvm'
         if len(varname) >= 86:
             raise Exception('Output name prefix is too long: '+self.varname)
         os.makedirs(self.outdir, exist_ok=True)
         self.train_prefix = os.path.join(self.outdir, 'train')
+        self.features_name = self.train_prefix+'.dat'
         self.model_prefix = os.path.join(self.outdir, 'model')
-        self.test_name = os.path.join(self.outdir, 'test.dat')
-        self.pred_prefix = os.path.join(self.outdir, 'pred')
         self.classorder = classorder
         self.orderedclasses = [0] * len(self.classorder)
         for key, val in self.classorder.items():
             self.orderedclasses[val] = key
+        if workers is None:
+            workers = min(len(self.classorder), os.cpu_count() or 1)
+        self.workers = workers
+        # {class: (seconds, stderr)} for the latest svm_learn/svm_classify run
+        # of each class
+        self.fit_log = {}
+        self.predict_log = {}
 
     def _train_name(self, label):
         return self.train_prefix+'_'+str(label)+'.dat'
@@ -34,63 +157,233 @@ class TSVM:
     def _model_name(self, label):
         return self.model_prefix+'_'+str(label)
 
-    def _pred_name(self, label):
-        return self.pred_prefix+'_'+str(label)
+    def copy_models(self, directory):
+        """Copies the SVMLight model file of each class to directory (created
+        if need be), under the same names as in outdir"""
+        os.makedirs(directory, exist_ok=True)
+        for label_type in self.classorder:
+            model_name = self._model_name(label_type)
+            shutil.copyfile(model_name,
+                            os.path.join(directory,
+                                         os.path.basename(model_name)))
+
+    def _run_classes(self, make_args):
+        """Runs the subprocess for each class on the worker pool
 
-    def _write_feats(self, ofh, feats):
-        """Writes the features into the data file"""
-        # expecting feats to be a csr row
-        for col, datum in zip(feats.indices[feats.indptr[0]:feats.indptr[1]],
-                              feats.data[feats.indptr[0]:feats.indptr[1]]):
-            ofh.write(str(col+1))
-            ofh.write(':')
-            ofh.write(str(datum))
-            ofh.write(' ')
+            * make_args :: function(str) -> [str]
+                command line for a class
+        Returns {class: (seconds, stderr)}
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {label_type: executor.submit(_run_timed,
+                                                   make_args(label_type))
+                       for label_type in self.classorder}
+        return {label_type: future.result()
+                for label_type, future in futures.items()}
 
     def fit(self, features, labels):
         """Call SVMLight for transductive SVM training
 
-        features must be a csr matrix
+        features must be a csr matrix; documents labeled 'unknown' are the
+        unlabeled documents used transductively
         """
+        labels = np.asarray(labels)
+        # the features are only written once; each class gets a copy with its
+        # own labels patched in
+        line_starts = write_svmlight(self.features_name, features)
         for label_type in self.classorder:
+            class_labels = np.where(labels == label_type, '+1', '-1')
+            class_labels[labels == 'unknown'] = PLACEHOLDER_LABEL
             train_file = self._train_name(label_type)
-            with open(train_file, 'w') as ofh:
-                for feats, label in zip(features, labels):
-                    if label_type == 'unknown':
-                        ofh.write('0 ')
-                    elif label_type == label:
-                        ofh.write('+1 ')
-                    else:
-                        ofh.write('-1 ')
-                    self._write_feats(ofh, feats)
-                    ofh.write('\n')
-            subprocess.run(
-                [
-                    SVM_LEARN,
-                    train_file,
-                    self._model_name(label_type)])
+            shutil.copyfile(self.features_name, train_file)
+            _patch_labels(train_file, line_starts, class_labels)
+        self.fit_log = self._run_classes(
+            lambda label_type: [
+                SVM_LEARN,
+                self._train_name(label_type),
+                self._model_name(label_type)])
 
     def predict(self, features):
-        """Call SVMLight for transductive SVM prediction"""
-        with open(self.test_name, 'w') as ofh:
-            for feats in features:
-                ofh.write('0 ')
-                self._write_feats(ofh, feats)
-                ofh.write('\n')
-        predictions = []
-        for label_type in self.classorder:
-            pred_name = self._pred_name(label_type)
-            subprocess.run(
-                [
+        """Call SVMLight for transductive SVM prediction
+
+        Safe to call concurrently: the test documents and predictions of each
+        call go in a scratch directory of their own
+        """
+        with classtm.scoring.scratch_dir() as scratch:
+            test_name = os.path.join(scratch, 'test.dat')
+            write_svmlight(test_name, features)
+
+            def pred_name(label_type):
+                return os.path.join(scratch, 'pred_'+str(label_type))
+
+            self.predict_log = self._run_classes(
+                lambda label_type: [
                     SVM_CLASSIFY,
-                    self.test_name,
+                    test_name,
                     self._model_name(label_type),
-                    pred_name])
-            tmp = []
-            with open(pred_name) as ifh:
-                for line in ifh:
-                    line = line.strip()
-                    tmp.append(float(line))
-            predictions.append(tmp)
-        predictions = np.argmax(np.array(predictions), axis=0)
-        return np.array([self.orderedclasses[a] for a in predictions])
+                    pred_name(label_type)])
+            # rows of predictions need to line up with orderedclasses
+            predictions = np.array([
+                read_predictions(pred_name(label_type))
+                for label_type in self.orderedclasses])
+        predictions = np.argmax(predictions, axis=0)
+        return np.asarray(self.orderedclasses)[predictions]
+
+
+def _fit_binary_tsvm(features, targets, cost, unlabeled_cost, max_switches,
+                     random_state):
+    """Trains one transductive linear SVM by label switching with annealing
+
+        * features :: scipy.sparse.csr_matrix
+        * targets :: 1D np.array
+            +1 or -1 for labeled documents, 0 for unlabeled documents
+        * cost :: float
+            C for labeled documents
+        * unlabeled_cost :: float
+            C for unlabeled documents that annealing ends at
+        * max_switches :: int
+            maximum number of rounds of label switching per value of C for
+            unlabeled documents
+    Returns (coef_, intercept_) of the final LinearSVC, or (None, constant
+    score) if the labeled documents are all in one class
+
+    This follows Joachims (ICML 1999): unlabeled documents are labeled by the
+    classifier trained on labeled documents alone, keeping the same fraction
+    of positives as among the labeled documents; then, while the cost of
+    unlabeled documents is doubled up to unlabeled_cost, pairs of unlabeled
+    documents with opposite labels whose slacks add to more than 2 have their
+    labels switched and the SVM is retrained.
+    """
+    labeled = targets != 0
+    if len(np.unique(targets[labeled])) < 2:
+        return None, (1.0 if np.all(targets[labeled] > 0) else -1.0)
+    svm = LinearSVC(C=cost, random_state=random_state)
+    svm.fit(features[labeled], targets[labeled])
+    unlabeled = np.flatnonzero(~labeled)
+    if not len(unlabeled):
+        return svm.coef_, svm.intercept_
+    # label the unlabeled documents with the highest scores as positive
+    num_positive = int(round(np.mean(targets[labeled] > 0) * len(unlabeled)))
+    scores = svm.decision_function(features[unlabeled])
+    guesses = np.full(len(unlabeled), -1)
+    guesses[np.argsort(-scores)[:num_positive]] = 1
+    all_targets = targets.copy()
+    weights = np.ones(len(targets))
+    current_cost = min(1e-5, unlabeled_cost)
+    while True:
+        weights[unlabeled] = current_cost / cost
+        for _ in range(max_switches):
+            all_targets[unlabeled] = guesses
+            svm.fit(features, all_targets, sample_weight=weights)
+            slacks = np.maximum(
+                0,
+                1 - guesses * svm.decision_function(features[unlabeled]))
+            positives = np.flatnonzero((guesses > 0) & (slacks > 0))
+            negatives = np.flatnonzero((guesses < 0) & (slacks > 0))
+            positives = positives[np.argsort(-slacks[positives])]
+            negatives = negatives[np.argsort(-slacks[negatives])]
+            pairs = min(len(positives), len(negatives))
+            switch = slacks[positives[:pairs]] + slacks[negatives[:pairs]] > 2
+            if not np.any(switch):
+                break
+            guesses[positives[:pairs][switch]] = -1
+            guesses[negatives[:pairs][switch]] = 1
+        if current_cost >= unlabeled_cost:
+            break
+        current_cost = min(2 * current_cost, unlabeled_cost)
+    return svm.coef_, svm.intercept_
+
+
+class LinearTSVM:
+    """Transductive linear support vector machine trained in process
+
+    Has the same interface as TSVM, but needs no SVMLight binaries and no
+    files; one-vs-rest, with the classes trained concurrently on up to workers
+    threads
+    """
+
+    # pylint:disable-msg=too-many-arguments
+    def __init__(self,
+                 classorder,
+                 cost=1.0,
+                 unlabeled_cost=None,
+                 workers=None,
+                 max_switches=10,
+                 random_state=0):
+        """
+            * classorder :: {'class': int}
+            * cost :: float
+                C for labeled documents
+            * unlabeled_cost :: float
+                C for unlabeled documents once annealing is done (defaults to
+                cost)
+            * workers :: int
+                number of classes trained at once (defaults to the smaller of
+                the number of classes and the number of CPUs)
+            * max_switches :: int
+                maximum rounds of label switching for each step of annealing
+            * random_state :: int
+                passed on to LinearSVC, so that runs are reproducible
+        """
+        self.classorder = classorder
+        self.orderedclasses = [0] * len(self.classorder)
+        for key, val in self.classorder.items():
+            self.orderedclasses[val] = key
+        self.cost = cost
+        self.unlabeled_cost = cost if unlabeled_cost is None else \
+            unlabeled_cost
+        if workers is None:
+            workers = min(len(self.classorder), os.cpu_count() or 1)
+        self.workers = workers
+        self.max_switches = max_switches
+        self.random_state = random_state
+        # one (coef, intercept) per class, in orderedclasses order
+        self.models = None
+        # {class: seconds} it took to train each class
+        self.fit_log = {}
+
+    def _fit_class(self, features, labels, label_type):
+        """Trains the one-vs-rest classifier for label_type"""
+        start = time.time()
+        targets = np.where(labels == label_type, 1, -1)
+        targets[labels == 'unknown'] = 0
+        model = _fit_binary_tsvm(features,
+                                 targets,
+                                 self.cost,
+                                 self.unlabeled_cost,
+                                 self.max_switches,
+                                 self.random_state)
+        return model, time.time() - start
+
+    def fit(self, features, labels):
+        """Train on features (a csr matrix) and labels, where documents
+        labeled 'unknown' are the unlabeled documents used transductively"""
+        labels = np.asarray(labels)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self._fit_class,
+                                       features,
+                                       labels,
+                                       label_type)
+                       for label_type in self.orderedclasses]
+        results = [future.result() for future in futures]
+        self.models = [model for model, _ in results]
+        self.fit_log = {label_type: seconds
+                        for label_type, (_, seconds)
+                        in zip(self.orderedclasses, results)}
+
+    def decision_function(self, features):
+        """Score of each class (columns, in orderedclasses order) for each
+        document (rows)"""
+        result = np.empty((features.shape[0], len(self.models)))
+        for i, (coef, intercept) in enumerate(self.models):
+            if coef is None:
+                # all labeled documents were on one side of this class
+                result[:, i] = intercept
+            else:
+                result[:, i] = features.dot(coef.ravel()) + intercept[0]
+        return result
+
+    def predict(self, features):
+        """Predict labels for features"""
+        return np.asarray(self.orderedclasses)[
+            np.argmax(self.decision_function(features), axis=1)]
@@ -0,0 +1,229 @@
+"""Binary corpus directories, which load much faster than pickled datasets
+
+A corpus directory holds an AbstractClassifiedDataset as uncompressed .npy
+files:  the docwords matrix as its CSC arrays (data, indices, indptr), the
+vocabulary and the titles as packed string tables (the UTF-8 encoded strings
+back to back, plus the offset of each one), and the labels as the class index
+of each document.  The files get memory-mapped read-only when the corpus is
+loaded, so loading takes about as long as reading corpus.json, no matter how
+big the corpus is; pages get read from disk only when they are used, and they
+are shared by every process on the host that loads the same corpus.
+"""
+from collections.abc import Mapping, Sequence
+import json
+import os
+import pickle
+
+import numpy as np
+import scipy.sparse
+
+import ankura.pipeline
+
+from classtm import labeled
+
+
+# bumped whenever the layout of corpus directories changes
+CORPUS_VERSION = 1
+# name of the file in a corpus directory that describes the corpus
+CORPUS_META = 'corpus.json'
+# name of the file in a corpus directory holding pickled metadata
+CORPUS_METADATA = 'metadata.pkl'
+# added to the name of a dataset pickle to get the name of the corpus
+# directory written in its place
+CORPUS_SUFFIX = '.corpus'
+# label index of documents without a label
+NO_LABEL = -1
+
+
+class StringTable(Sequence):
+    """Read-only list of strings packed into one array of UTF-8 bytes
+
+    String i is blob[offsets[i]:offsets[i+1]]; strings get decoded only when
+    asked for
+    """
+
+    def __init__(self, blob, offsets):
+        """
+            * blob :: 1D np.array of np.uint8
+            * offsets :: 1D np.array of np.int64
+                one longer than the number of strings
+        """
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def pack(cls, strings):
+        """Builds a StringTable holding strings"""
+        encoded = [str(string).encode('utf-8') for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded],
+                  out=offsets[1:])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return cls(blob, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('StringTable index out of range')
+        start, stop = self.offsets[index], self.offsets[index+1]
+        return self.blob[start:stop].tobytes().decode('utf-8')
+
+    def __array__(self, dtype=None, copy=None):
+        # so that np.append and friends see the strings, not the table
+        return np.array(list(self), dtype=dtype)
+
+
+class PackedLabels(Mapping):
+    """Read-only {title: label} backed by the class index of each document"""
+
+    def __init__(self, titles, label_ids, orderedclasses):
+        """
+            * titles :: sequence of str
+            * label_ids :: 1D np.array of int
+                label_ids[i] is the index into orderedclasses of the label of
+                titles[i], or NO_LABEL if it has none
+            * orderedclasses :: [str]
+        """
+        self.titles = titles
+        self.label_ids = label_ids
+        self.orderedclasses = orderedclasses
+        # {title: document index}, built the first time a label is looked up
+        self._titlesorder = None
+
+    def __getitem__(self, title):
+        if self._titlesorder is None:
+            self._titlesorder = labeled.get_titles_order(self.titles)
+        label_id = self.label_ids[self._titlesorder[title]]
+        if label_id == NO_LABEL:
+            raise KeyError(title)
+        return self.orderedclasses[label_id]
+
+    def __iter__(self):
+        for i in np.flatnonzero(np.asarray(self.label_ids) != NO_LABEL):
+            yield self.titles[i]
+
+    def __len__(self):
+        return int(np.count_nonzero(np.asarray(self.label_ids) != NO_LABEL))
+
+
+class LazyPickle(Sequence):
+    """Pickled sequence that gets unpickled the first time it is used"""
+
+    def __init__(self, path):
+        self.path = path
+        self._items = None
+
+    def _load(self):
+        if self._items is None:
+            with open(self.path, 'rb') as ifh:
+                self._items = pickle.load(ifh)
+        return self._items
+
+    def __len__(self):
+        return len(self._load())
+
+    def __getitem__(self, index):
+        return self._load()[index]
+
+
+def corpus_path(pickle_path):
+    """Path of the corpus directory written in place of the dataset pickle at
+    pickle_path"""
+    return pickle_path + CORPUS_SUFFIX
+
+
+def save_corpus(dataset, path):
+    """Writes dataset as a corpus directory
+
+        * dataset :: AbstractClassifiedDataset
+        * path :: str
+            directory to write to (created if need be)
+    Labels of titles that are not in dataset do not get written.  As with
+    export directories, corpus.json gets written last, so that a partially
+    written corpus cannot be loaded
+    """
+    docwords = scipy.sparse.csc_matrix(dataset.docwords)
+    if not docwords.has_sorted_indices:
+        docwords = docwords.sorted_indices()
+    vocab = StringTable.pack(dataset.vocab)
+    titles = StringTable.pack(dataset.titles)
+    label_ids = np.array([dataset.classorder[dataset.labels[title]]
+                          if title in dataset.labels else NO_LABEL
+                          for title in dataset.titles],
+                         dtype=np.int32)
+    arrays = {'data': docwords.data,
+              'indices': docwords.indices,
+              'indptr': docwords.indptr,
+              'vocab_blob': vocab.blob,
+              'vocab_offsets': vocab.offsets,
+              'titles_blob': titles.blob,
+              'titles_offsets': titles.offsets,
+              'labels': label_ids}
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name+'.npy'), array, allow_pickle=False)
+    has_metadata = dataset.metadata is not None
+    if has_metadata:
+        with open(os.path.join(path, CORPUS_METADATA), 'wb') as ofh:
+            pickle.dump(list(dataset.metadata), ofh)
+    meta = {'version': CORPUS_VERSION,
+            'shape': list(docwords.shape),
+            'orderedclasses': list(dataset.orderedclasses),
+            'metadata': has_metadata}
+    with open(os.path.join(path, CORPUS_META), 'w') as ofh:
+        json.dump(meta, ofh, indent=2, sort_keys=True)
+
+
+def load_corpus(path):
+    """Loads the AbstractClassifiedDataset in the corpus directory at path
+
+    Arrays are memory-mapped read-only; titles and vocabulary words get
+    decoded, and metadata unpickled, only when they are used
+    """
+    with open(os.path.join(path, CORPUS_META)) as ifh:
+        meta = json.load(ifh)
+    if meta['version'] != CORPUS_VERSION:
+        raise ValueError('Corpus at {:s} has version {}; expected {:d}'.format(
+            path, meta['version'], CORPUS_VERSION))
+
+    def _load(name):
+        return np.load(os.path.join(path, name+'.npy'), mmap_mode='r')
+
+    docwords = scipy.sparse.csc_matrix(
+        (_load('data'), _load('indices'), _load('indptr')),
+        shape=tuple(meta['shape']))
+    docwords.has_sorted_indices = True
+    vocab = StringTable(_load('vocab_blob'), _load('vocab_offsets'))
+    titles = StringTable(_load('titles_blob'), _load('titles_offsets'))
+    metadata = None
+    if meta['metadata']:
+        metadata = LazyPickle(os.path.join(path, CORPUS_METADATA))
+    orderedclasses = meta['orderedclasses']
+    classorder = {cla: i for i, cla in enumerate(orderedclasses)}
+    labels = PackedLabels(titles, _load('labels'), orderedclasses)
+    return labeled.AbstractClassifiedDataset(
+        ankura.pipeline.Dataset(docwords, vocab, titles, metadata),
+        labels,
+        classorder)
+
+
+def load_dataset(path):
+    """Loads a dataset written by one of the picklers
+
+        * path :: str
+            a corpus directory, or a dataset pickle; if a corpus directory
+            was written in place of the pickle (see corpus_path), it gets
+            loaded instead
+    """
+    if os.path.isdir(path):
+        return load_corpus(path)
+    if os.path.isdir(corpus_path(path)):
+        return load_corpus(corpus_path(path))
+    with open(path, 'rb') as ifh:
+        return pickle.load(ifh)
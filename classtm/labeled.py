@@ -1,6 +1,13 @@
 """ClassifiedDataset for labeled datasets (classification)"""
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 import ctypes
+import fcntl
+import hashlib
+import multiprocessing
 import os
+import socket
+import tempfile
 
 import numpy as np
 import numpy.ctypeslib as npct
@@ -8,6 +15,8 @@ import scipy.sparse
 
 import ankura.pipeline
 
+import classtm.pickling
+
 
 ARRAY_1D_DOUBLE = npct.ndpointer(dtype=np.double, ndim=1, flags='CONTIGUOUS')
 SO_PATH = os.path.join(
@@ -21,6 +30,457 @@ LIBCD.simplexproj.argtypes = [
     ARRAY_1D_DOUBLE,
     ctypes.c_int,
     ctypes.c_double]
+# number of rows of Q computed at a time
+Q_BLOCK_SIZE = 1024
+# number of threads computing blocks of Q
+Q_THREADS = os.cpu_count() or 1
+
+
+def doc_norms(docwords):
+    """Computes the norm used to normalize each document's word counts
+
+        * docwords :: scipy.sparse.csc_matrix
+            shape is (V, D)
+    See supplementary 4.1 of Arora et al. (ICML 2013)
+    """
+    counts = np.asarray(docwords.sum(axis=0)).ravel()
+    return counts * (counts - 1)
+
+
+def build_h_matrices(docwords, numerators, norms):
+    """Builds H_tilde and H_hat for computing Q
+
+        * docwords :: scipy.sparse.csc_matrix
+            shape is (V, D)
+        * numerators :: 1D np.array
+            aligned with docwords.data; the contribution of each entry to H_hat
+            before being divided by the norm of its document
+        * norms :: 1D np.array
+            norm of each document
+    Documents with a norm of 0 are left unscaled in H_tilde and contribute
+    nothing to H_hat.  Returns H_tilde as a scipy.sparse.csc_matrix and H_hat
+    as a 1D np.array.
+    """
+    vocab_size, num_docs = docwords.shape
+    entry_docs = np.repeat(np.arange(num_docs), np.diff(docwords.indptr))
+    nonzero = norms != 0
+    scale = np.ones(num_docs)
+    scale[nonzero] = 1.0 / np.sqrt(norms[nonzero])
+    inverse_norms = np.zeros(num_docs)
+    inverse_norms[nonzero] = 1.0 / norms[nonzero]
+    H_tilde = scipy.sparse.csc_matrix(
+        (docwords.data * scale[entry_docs],
+         docwords.indices,
+         docwords.indptr),
+        shape=docwords.shape,
+        dtype=float)
+    H_hat = np.bincount(
+        docwords.indices,
+        weights=numerators * inverse_norms[entry_docs],
+        minlength=vocab_size)
+    return H_tilde, H_hat
+
+
+def row_blocks(num_rows, block_size):
+    """Yields (start, stop) for each block of block_size rows"""
+    for start in range(0, num_rows, block_size):
+        yield start, min(start + block_size, num_rows)
+
+
+def fill_cooccurrences(H_tilde,
+                       H_hat,
+                       num_docs,
+                       out,
+                       block_size=Q_BLOCK_SIZE,
+                       num_threads=Q_THREADS,
+                       finish_rows=None):
+    """Computes (H_tilde * H_tilde.T - diag(H_hat)) / num_docs into out
+
+        * H_tilde :: scipy.sparse.csc_matrix
+            shape is (V, D)
+        * H_hat :: 1D np.array
+        * num_docs :: int
+        * out :: 2D np.array
+            preallocated, C-contiguous array (or np.memmap) of shape (V, V);
+            if its dtype is not float64, each block is still computed in
+            float64 and only rounded to out's dtype once it is finished
+        * block_size :: int
+            number of rows of out computed at a time
+        * num_threads :: int
+            number of blocks computed concurrently
+        * finish_rows :: function(2D np.array)
+            if not None, called on each finished block of rows of out, which it
+            may modify in place
+    Each float64 block is written directly into out, so the only memory used
+    beyond out is the sparse product for the blocks currently being computed
+    (plus a float64 copy of each block when out is not float64).
+    """
+    H_rows = H_tilde.tocsr()
+    # the transpose of a csc_matrix is a csr_matrix sharing the same arrays
+    H_tilde_T = H_tilde.T
+
+    def _fill_block(start):
+        """Computes the rows of out from start to start+block_size"""
+        stop = min(start + block_size, out.shape[0])
+        product = H_rows[start:stop] * H_tilde_T
+        if out.dtype == np.float64:
+            block = out[start:stop]
+            block.fill(0)
+            # toarray adds into out, which is why block was zeroed out first
+            product.toarray(out=block)
+        else:
+            block = product.toarray()
+        block[np.arange(stop - start), np.arange(start, stop)] -= \
+            H_hat[start:stop]
+        block /= num_docs
+        if finish_rows is not None:
+            finish_rows(block)
+        if out.dtype != np.float64:
+            out[start:stop] = block
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        # list forces any exceptions raised in the threads to surface here
+        list(executor.map(_fill_block, range(0, out.shape[0], block_size)))
+    return out
+
+
+def shard_ranges(num_docs, num_shards):
+    """Splits documents into num_shards contiguous ranges
+
+    Returns list of (start, stop) pairs
+    """
+    bounds = np.linspace(0, num_docs, num_shards + 1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def hash_docwords(docwords, *extras):
+    """Hashes the contents of docwords along with the reprs of extras"""
+    docwords = scipy.sparse.csc_matrix(docwords, dtype=float)
+    hasher = hashlib.sha1()
+    for extra in extras:
+        hasher.update(repr(extra).encode())
+    hasher.update(repr(docwords.shape).encode())
+    for array in [docwords.indptr, docwords.indices, docwords.data]:
+        hasher.update(np.ascontiguousarray(array).tobytes())
+    return hasher.hexdigest()
+
+
+def _shard_key(dataset, start, stop):
+    """Hashes everything that goes into a shard of Q
+
+    Shards are named by this key, so that a shard only gets recomputed when the
+    documents in it (or the way they are turned into Q) change.  A shard only
+    depends on its columns of dataset._docwords (label pseudo-words included)
+    and on how H_tilde and H_hat are built from them, so datasets of different
+    types share shards when they build them the same way.
+    """
+    return hash_docwords(dataset._docwords[:, start:stop],
+                         type(dataset)._doc_norms.__qualname__,
+                         type(dataset)._h_hat_numerators.__qualname__)
+
+
+def _shard_paths(dataset, sharddir, start, stop):
+    """Gets file names for the partial H_tilde * H_tilde.T and H_hat sums"""
+    prefix = os.path.join(
+        sharddir,
+        '{:d}-{:d}-{:s}'.format(start, stop, _shard_key(dataset, start, stop)))
+    return prefix+'.cooc.npz', prefix+'.hhat.npy'
+
+
+def _merged_key(dataset, num_shards):
+    """Hashes everything that goes into Q built from num_shards shards"""
+    hasher = hashlib.sha1()
+    hasher.update(type(dataset)._finish_cooccurrence_rows.__qualname__.encode())
+    hasher.update(dataset.q_dtype.name.encode())
+    for start, stop in shard_ranges(dataset.num_docs, num_shards):
+        hasher.update(_shard_key(dataset, start, stop).encode())
+    return 'Q-{:d}-{:s}'.format(num_shards, hasher.hexdigest())
+
+
+def _tmp_name(path):
+    """Name to write to before moving the finished file to path"""
+    return '{:s}.{:s}.{:d}.tmp'.format(path, socket.gethostname(), os.getpid())
+
+
+def write_cooccurrence_shard(dataset, start, stop, sharddir):
+    """Writes partial sums for Q over the documents from start to stop
+
+        * dataset :: AbstractClassifiedDataset
+        * start, stop :: int
+            column range of dataset._docwords belonging to this shard
+        * sharddir :: str
+            directory the shard is written to; may be on a shared filesystem
+    Writes the partial H_tilde * H_tilde.T as a scipy.sparse .npz file, which
+    only has entries for pairs of words that occur together in the shard's
+    documents, and the partial H_hat as a .npy file.  If the shard already
+    exists (because its documents have not changed), it is not recomputed.
+    Returns the names of the two files.
+    """
+    cooc_path, hhat_path = _shard_paths(dataset, sharddir, start, stop)
+    if os.path.exists(cooc_path) and os.path.exists(hhat_path):
+        return cooc_path, hhat_path
+    H_tilde, H_hat = dataset._build_h(dataset._docwords[:, start:stop])
+    # files are written under temporary names and moved into place once they
+    # are complete, so that concurrent workers never see partial shards
+    tmp_cooc = _tmp_name(cooc_path)
+    with open(tmp_cooc, 'wb') as ofh:
+        # written through a file object, since save_npz would add .npz to the
+        # temporary name
+        scipy.sparse.save_npz(ofh,
+                              (H_tilde.tocsr() * H_tilde.T).tocsr(),
+                              compressed=False)
+    tmp_hhat = _tmp_name(hhat_path)
+    with open(tmp_hhat, 'wb') as ofh:
+        np.save(ofh, H_hat)
+    os.replace(tmp_cooc, cooc_path)
+    os.replace(tmp_hhat, hhat_path)
+    return cooc_path, hhat_path
+
+
+def merge_cooccurrence_shards(dataset, sharddir, num_shards, out=None):
+    """Builds Q for dataset from shards written by write_cooccurrence_shard
+
+        * dataset :: AbstractClassifiedDataset
+        * sharddir :: str
+        * num_shards :: int
+            number of shards the documents of dataset were split into
+        * out :: 2D np.array
+            if not None, Q gets written into out
+    The partial sums are added up in a dense float64 array (out itself, if
+    it is float64, or else one allocated like Q), one shard at a time and one
+    block of rows of each shard at a time, so that only a block's worth of a
+    shard's entries is ever unpacked at once.  Each block of rows is then
+    finished in place.  Raises FileNotFoundError if any shard is missing.
+    """
+    vocab_size, num_docs = dataset._docwords.shape
+    if out is None:
+        out = dataset._allocate_cooccurrences((vocab_size, vocab_size))
+    if out.dtype == np.float64:
+        sums = out
+    else:
+        # Q only gets rounded once, when the finished rows are stored
+        sums = dataset._allocate_cooccurrences((vocab_size, vocab_size),
+                                               np.float64)
+    blocks = list(row_blocks(vocab_size, dataset.q_block_size))
+    for start, stop in blocks:
+        sums[start:stop] = 0
+    H_hat = np.zeros(vocab_size)
+    for start, stop in shard_ranges(num_docs, num_shards):
+        cooc_path, hhat_path = _shard_paths(dataset, sharddir, start, stop)
+        shard = scipy.sparse.load_npz(cooc_path).tocsr()
+        for block_start, block_stop in blocks:
+            rows = shard[block_start:block_stop].tocoo()
+            sums[block_start + rows.row, rows.col] += rows.data
+        # freed before the next shard gets loaded
+        del shard
+        H_hat += np.load(hhat_path)
+    for start, stop in blocks:
+        block = sums[start:stop]
+        block[np.arange(stop - start), np.arange(start, stop)] -= \
+            H_hat[start:stop]
+        block /= num_docs
+        dataset._finish_cooccurrence_rows(block)
+        if sums is not out:
+            out[start:stop] = block
+    return out
+
+
+def merged_cooccurrences(dataset, sharddir, num_shards, mmap_mode='c'):
+    """Loads Q for dataset from sharddir, merging its shards into a file there
+    first if that has not been done yet
+
+        * dataset :: AbstractClassifiedDataset
+        * sharddir :: str
+        * num_shards :: int
+            number of shards the documents of dataset were split into
+        * mmap_mode :: str
+            as for cached_cooccurrences
+    The merged Q is named by a hash of its shards' keys, so that
+    compute_sharded_cooccurrences only uses it for datasets that would build
+    the same shards
+    """
+    vocab_size = dataset._docwords.shape[0]
+    return cached_cooccurrences(
+        sharddir,
+        _merged_key(dataset, num_shards),
+        (vocab_size, vocab_size),
+        lambda out: merge_cooccurrence_shards(dataset,
+                                              sharddir,
+                                              num_shards,
+                                              out),
+        mmap_mode,
+        dataset.q_dtype)
+
+
+# dataset the shard workers in a multiprocessing.Pool compute shards for
+_SHARD_DATASET = None
+
+
+def _init_shard_worker(dataset):
+    """Sets the dataset for this shard worker"""
+    global _SHARD_DATASET
+    _SHARD_DATASET = dataset
+
+
+def _shard_worker(args):
+    """Writes one shard of Q in a worker process"""
+    start, stop, sharddir = args
+    return write_cooccurrence_shard(_SHARD_DATASET, start, stop, sharddir)
+
+
+def write_cooccurrence_shards(dataset, ranges, sharddir, processes):
+    """Writes shards of Q with local worker processes
+
+        * dataset :: AbstractClassifiedDataset
+        * ranges :: [(int, int)]
+            column ranges of dataset._docwords to write shards for
+        * sharddir :: str
+        * processes :: int
+            number of worker processes writing shards
+    """
+    os.makedirs(sharddir, exist_ok=True)
+    jobs = [(start, stop, sharddir) for start, stop in ranges]
+    if processes > 1:
+        with multiprocessing.Pool(processes,
+                                  initializer=_init_shard_worker,
+                                  initargs=(dataset,)) as pool:
+            pool.map(_shard_worker, jobs)
+    else:
+        for job in jobs:
+            write_cooccurrence_shard(dataset, *job)
+
+
+def compute_sharded_cooccurrences(dataset, sharddir, num_shards, processes):
+    """Computes Q by writing shards with local worker processes and merging
+
+        * dataset :: AbstractClassifiedDataset
+        * sharddir :: str
+        * num_shards :: int
+        * processes :: int
+            number of worker processes writing shards
+    Shards that already exist in sharddir are reused.  If the shards have
+    already been merged into Q in sharddir (see merged_cooccurrences), Q is
+    memory-mapped from there (copy-on-write) instead.
+    """
+    merged = os.path.join(sharddir, _merged_key(dataset, num_shards)+'.npy')
+    if os.path.exists(merged):
+        return np.load(merged, mmap_mode='c')
+    write_cooccurrence_shards(dataset,
+                              shard_ranges(dataset.num_docs, num_shards),
+                              sharddir,
+                              processes)
+    return merge_cooccurrence_shards(dataset, sharddir, num_shards)
+
+
+def cached_cooccurrences(cache_dir,
+                         key,
+                         shape,
+                         compute,
+                         mmap_mode='c',
+                         dtype=float):
+    """Loads a cooccurrence matrix from cache_dir, computing it first if needed
+
+        * cache_dir :: str
+        * key :: str
+            name of the matrix in cache_dir
+        * shape :: (int, int)
+            shape of the matrix
+        * compute :: function(2D np.array)
+            fills in the matrix it is given
+        * mmap_mode :: str
+            how the cached matrix gets memory-mapped; with the default of 'c',
+            changes to the returned matrix are never written back to the cache
+        * dtype :: np.dtype
+    A lock file keeps concurrent processes on one host from computing the same
+    matrix at the same time, and the matrix is written under a temporary name
+    before being moved into place, so a partially written matrix is never
+    loaded.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key+'.npy')
+    if not os.path.exists(path):
+        with open(path+'.lock', 'w') as lockfh:
+            fcntl.flock(lockfh, fcntl.LOCK_EX)
+            try:
+                # another process may have finished while we waited
+                if not os.path.exists(path):
+                    tmp = _tmp_name(path)
+                    result = np.lib.format.open_memmap(tmp,
+                                                       mode='w+',
+                                                       dtype=dtype,
+                                                       shape=shape)
+                    compute(result)
+                    result.flush()
+                    del result
+                    os.replace(tmp, path)
+            finally:
+                fcntl.flock(lockfh, fcntl.LOCK_UN)
+    return np.load(path, mmap_mode=mmap_mode)
+
+
+# open reference files of the shared segments this process is using
+_SHARED_REFS = {}
+
+
+def _release_shared_segments():
+    """Releases this process's references to shared segments
+
+    The last process using a segment removes it
+    """
+    for path, reffh in _SHARED_REFS.items():
+        fcntl.flock(reffh, fcntl.LOCK_UN)
+        try:
+            # only succeeds when no other process holds a reference
+            fcntl.flock(reffh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            reffh.close()
+            continue
+        for name in [path, path+'.lock', path+'.refs']:
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+        reffh.close()
+    _SHARED_REFS.clear()
+
+
+def shared_cooccurrences(shared_dir,
+                         key,
+                         shape,
+                         compute,
+                         mmap_mode='c',
+                         dtype=float):
+    """Maps a cooccurrence matrix from a segment shared by all processes on
+    this host
+
+        * shared_dir :: str
+            host-local directory for segments, preferably on tmpfs (e.g.,
+            /dev/shm/classtm)
+    The other arguments are as for cached_cooccurrences.  The first process
+    to ask for the matrix computes it; the others map the same pages.  Each
+    process holds a shared lock on the segment's reference file until it
+    exits, and the last one to exit removes the segment.
+    """
+    os.makedirs(shared_dir, exist_ok=True)
+    path = os.path.join(shared_dir, key+'.npy')
+    if path not in _SHARED_REFS:
+        if not _SHARED_REFS:
+            atexit.register(_release_shared_segments)
+        while True:
+            reffh = open(path+'.refs', 'a')
+            fcntl.flock(reffh, fcntl.LOCK_SH)
+            # the last process using the segment may have removed it while we
+            # were waiting for the lock
+            if os.fstat(reffh.fileno()).st_nlink > 0:
+                break
+            reffh.close()
+        _SHARED_REFS[path] = reffh
+    return cached_cooccurrences(shared_dir,
+                                key,
+                                shape,
+                                compute,
+                                mmap_mode,
+                                dtype)
 
 
 def get_labels(filename):
@@ -100,10 +560,83 @@ def orderclasses(classorder):
     return orderedclasses
 
 
+class TokenStore(object):
+    """Tokens of every document in one flat int32 array
+
+    The tokens of document d are tokens[offsets[d]:offsets[d+1]].  A document's
+    tokens get shuffled the first time they are asked for, by a generator
+    seeded with the store's seed and the document's id, so that the order does
+    not depend on the order in which documents are asked for.
+    """
+
+    def __init__(self, docwords, seed=None):
+        """
+            * docwords :: scipy.sparse.csc_matrix
+                word counts per document; shape is (V, D)
+            * seed :: int
+                seed for shuffling; if None, one is drawn from np.random
+        """
+        docwords = scipy.sparse.csc_matrix(docwords)
+        counts = docwords.data.astype(np.int64)
+        self.tokens = np.repeat(docwords.indices.astype(np.int32), counts)
+        cumulative = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=cumulative[1:])
+        self.offsets = cumulative[docwords.indptr]
+        self.shuffled = np.zeros(docwords.shape[1], dtype=bool)
+        if seed is None:
+            # pylint:disable-msg=no-member
+            seed = np.random.randint(2**31)
+        self.seed = seed
+
+    def doc_tokens(self, doc_id, rng=None):
+        """Returns a read-only view of the tokens of document doc_id
+
+            * rng :: np.random.RandomState
+                used instead of the store's generator if the document has not
+                been shuffled yet
+        """
+        tokens = self.tokens[self.offsets[doc_id]:self.offsets[doc_id+1]]
+        if not self.shuffled[doc_id]:
+            if rng is None:
+                rng = np.random.RandomState([self.seed, doc_id])
+            rng.shuffle(tokens)
+            self.shuffled[doc_id] = True
+        view = tokens.view()
+        view.flags.writeable = False
+        return view
+
+
 class AbstractClassifiedDataset(ankura.pipeline.Dataset):
-    """For use with classtm models"""
+    """For use with classtm models
+
+    Q gets built by fill_cooccurrences (or from shards of documents when
+    q_shard_dir is set); subclasses change how Q gets built by overriding
+    _doc_norms, _h_hat_numerators, and _finish_cooccurrence_rows
+    """
 
-    def __init__(self, dataset, labels, classorder):
+    # class level defaults so that previously pickled datasets still work
+    q_block_size = Q_BLOCK_SIZE
+    q_threads = Q_THREADS
+    # when q_shard_dir is set, Q gets built from shards of documents
+    q_shard_dir = None
+    q_shards = 1
+    q_shard_processes = 1
+    # when q_cache_dir is set, matrices that stay the same across runs on the
+    # same corpus get cached there; when q_shared_dir is set, they get shared
+    # by all processes on the host instead
+    q_cache_dir = None
+    q_shared_dir = None
+    # when q_memmap_dir is set, Q is backed by a file there instead of memory
+    q_memmap_dir = None
+    # dtype Q is stored in
+    q_dtype = np.dtype(np.float64)
+    # attributes that can be rebuilt from the rest, and so do not get pickled
+    _caches = ('_tokens', '_cooccurrences')
+    # seed of the TokenStore, kept across pickling so that documents get
+    # shuffled the same way once it is rebuilt
+    _token_seed = None
+
+    def __init__(self, dataset, labels, classorder, settings=None):
         super(AbstractClassifiedDataset, self).__init__(
             dataset.docwords,
             dataset.vocab,
@@ -112,30 +645,195 @@ class AbstractClassifiedDataset(ankura.pipeline.Dataset):
         self.labels = labels
         self.classorder = classorder
         self.orderedclasses = orderclasses(self.classorder)
+        # TokenStore, built the first time tokens are asked for
+        self._tokens = None
+        if settings:
+            self.configure_cooccurrences(settings)
+
+    def configure_cooccurrences(self, settings):
+        """Reads options for building Q from settings
+
+            * settings :: {str: str}
+                all of the options (see README.md) are optional
+        """
+        if 'q_block_size' in settings:
+            self.q_block_size = int(settings['q_block_size'])
+        if 'q_threads' in settings:
+            self.q_threads = int(settings['q_threads'])
+        if 'q_shard_dir' in settings:
+            self.q_shard_dir = settings['q_shard_dir']
+        if 'q_shards' in settings:
+            self.q_shards = int(settings['q_shards'])
+        if 'q_shard_processes' in settings:
+            self.q_shard_processes = int(settings['q_shard_processes'])
+        if 'q_cache_dir' in settings:
+            self.q_cache_dir = settings['q_cache_dir']
+        if 'q_shared_dir' in settings:
+            self.q_shared_dir = settings['q_shared_dir']
+        if 'q_memmap_dir' in settings:
+            self.q_memmap_dir = settings['q_memmap_dir']
+        if 'precision' in settings:
+            self.q_dtype = np.dtype(settings['precision'])
+
+    def __getstate__(self):
+        """Leaves out the caches named in _caches; Q and the tokens get
+        rebuilt the first time they are asked for"""
+        state = classtm.pickling.drop_caches(self.__dict__, self._caches)
+        if isinstance(self._tokens, TokenStore):
+            state['_token_seed'] = self._tokens.seed
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def _token_vocab_size(self):
+        """Number of rows of docwords that doc_tokens returns tokens for"""
+        return self._docwords.shape[0]
+
+    def doc_tokens(self, doc_id, rng=None):
+        """Returns a read-only int32 array of the tokens of document doc_id,
+        shuffled
+
+        The array is a view into a TokenStore shared by all documents
+        """
+        # datasets pickled before TokenStore existed cached a dict of lists
+        if not isinstance(self._tokens, TokenStore):
+            self._tokens = TokenStore(
+                self._docwords[:self._token_vocab_size()],
+                self._token_seed)
+        return self._tokens.doc_tokens(doc_id, rng)
+
+    def _doc_norms(self, docwords):
+        """Norm of each document in docwords"""
+        return doc_norms(docwords)
+
+    def _h_hat_numerators(self, docwords):
+        """Contribution of each entry of docwords to H_hat before being divided
+        by the norm of its document
+        """
+        return docwords.data
+
+    def _finish_cooccurrence_rows(self, rows):
+        """Called on each block of rows of Q once the block has been computed"""
+        pass
+
+    def _build_h(self, docwords):
+        """Builds H_tilde and H_hat from docwords"""
+        docwords = scipy.sparse.csc_matrix(docwords, dtype=float)
+        return build_h_matrices(docwords,
+                                self._h_hat_numerators(docwords),
+                                self._doc_norms(docwords))
+
+    def compute_cooccurrences(self, epsilon=1e-15):
+        """Computes Q in blocks of rows"""
+        if self.q_shard_dir is not None:
+            self._cooccurrences = compute_sharded_cooccurrences(
+                self,
+                self.q_shard_dir,
+                self.q_shards,
+                self.q_shard_processes)
+            return
+        vocab_size = self._docwords.shape[0]
+        self._cooccurrences = self._build_cooccurrences(
+            self._docwords,
+            self._allocate_cooccurrences((vocab_size, vocab_size)))
+
+    def _allocate_cooccurrences(self, shape, dtype=None):
+        """Allocates an array for Q (of dtype, q_dtype by default), backed by a
+        file in q_memmap_dir if set"""
+        if dtype is None:
+            dtype = self.q_dtype
+        if self.q_memmap_dir is None:
+            return np.empty(shape, dtype=dtype)
+        os.makedirs(self.q_memmap_dir, exist_ok=True)
+        # the file has no name, so its space is released once Q is unmapped
+        return np.memmap(tempfile.TemporaryFile(dir=self.q_memmap_dir),
+                         dtype=dtype,
+                         mode='w+',
+                         shape=shape)
+
+    def _reuses_cooccurrences(self):
+        """Whether matrices that stay the same across runs get reused"""
+        return self.q_cache_dir is not None or self.q_shared_dir is not None
+
+    def _reused_cooccurrences(self, docwords, key, mmap_mode='c'):
+        """Loads Q for docwords from the host's shared segments or the cache,
+        computing it first if needed
+        """
+        vocab_size = docwords.shape[0]
+        if self.q_shared_dir is not None:
+            load = shared_cooccurrences
+            directory = self.q_shared_dir
+        else:
+            load = cached_cooccurrences
+            directory = self.q_cache_dir
+        return load(directory,
+                    key+'.'+self.q_dtype.name,
+                    (vocab_size, vocab_size),
+                    lambda out: self._build_cooccurrences(docwords, out),
+                    mmap_mode,
+                    self.q_dtype)
+
+    def _build_cooccurrences(self, docwords, out):
+        """Computes Q for docwords into out"""
+        H_tilde, H_hat = self._build_h(docwords)
+        return fill_cooccurrences(H_tilde,
+                                  H_hat,
+                                  docwords.shape[1],
+                                  out,
+                                  self.q_block_size,
+                                  self.q_threads,
+                                  self._finish_cooccurrence_rows)
 
 
 class AbstractParameterizedClassifiedDataset(AbstractClassifiedDataset):
     """When you want parameters on how Q gets constructed"""
 
-    def __init__(self, dataset, labels, classorder, smoothing, label_weight):
+    # label_weight is a closure, which cannot be pickled; it gets built again
+    # from label_weight_setting
+    _caches = AbstractClassifiedDataset._caches + ('label_weight',)
+
+    # pylint:disable-msg=too-many-arguments
+    def __init__(self,
+                 dataset,
+                 labels,
+                 classorder,
+                 smoothing,
+                 label_weight,
+                 settings=None):
         super(AbstractParameterizedClassifiedDataset, self).__init__(
             dataset,
             labels,
-            classorder)
+            classorder,
+            settings)
         self.smoothing = smoothing
+        self.label_weight_setting = label_weight
         self.label_weight = get_label_weight_function(label_weight)
 
+    def __setstate__(self, state):
+        super(AbstractParameterizedClassifiedDataset, self).__setstate__(state)
+        self.label_weight = get_label_weight_function(
+            self.label_weight_setting)
+
 
 # pylint:disable-msg=too-few-public-methods
 class ClassifiedDataset(AbstractParameterizedClassifiedDataset):
     """Classified, as in data is labeled with classes"""
 
-    def __init__(self, dataset, labels, classorder, smoothing, label_weight):
+    # pylint:disable-msg=too-many-arguments
+    def __init__(self,
+                 dataset,
+                 labels,
+                 classorder,
+                 smoothing,
+                 label_weight,
+                 settings=None):
         super(ClassifiedDataset, self).__init__(dataset,
                                                 labels,
                                                 classorder,
                                                 smoothing,
-                                                label_weight)
+                                                label_weight,
+                                                settings)
         # add pseudo labels if necessary
         if not isinstance(dataset, ClassifiedDataset):
             self.origvocabsize = len(self._vocab)
@@ -153,20 +851,9 @@ class ClassifiedDataset(AbstractParameterizedClassifiedDataset):
             self._docwords = tmp.tocsc()
         # when compute_cooccurrences gets called, we should get the Q we want
 
-    def doc_tokens(self, doc_id, rng=np.random):
-        if doc_id in self._tokens:
-            return self._tokens[doc_id]
-
-        token_ids, _, counts = scipy.sparse.find(self._docwords[:, doc_id])
-        tokens = []
-        for token_id, count in zip(token_ids, counts):
-            if token_id < self.origvocabsize:
-                tokens.extend([token_id] * count)
-        # pylint:disable-msg=no-member
-        rng.shuffle(tokens)
-
-        self._tokens[doc_id] = tokens
-        return tokens
+    def _token_vocab_size(self):
+        # label pseudo-words are not tokens
+        return self.origvocabsize
 
 
 def get_titles_order(titles):
@@ -224,6 +911,132 @@ def get_label_weight_function(label_weight):
     return return_value(float(label_weight))
 
 
+# pylint:disable-msg=too-many-instance-attributes
+class CooccurrenceAccumulator(object):
+    """Accumulates Q from documents as they stream in
+
+    Q comes out the same as for a ClassifiedDataset built from the same
+    documents, but the document-term matrix is never held in memory; only the
+    running sums of H_tilde * H_tilde.T and H_hat are kept.  Documents can be
+    added straight from a reader, before (or instead of) building a dataset:
+
+        accumulator = CooccurrenceAccumulator(len(vocab), classorder,
+                                              smoothing, label_weight)
+        accumulator.add_documents((tokens, labels[title])
+                                  for title, tokens in documents)
+        cooccurrences = accumulator.Q
+
+    check/cooccurrence_accumulator.py compares its Q with ClassifiedDataset's
+    on a pickled dataset
+    """
+
+    # pylint:disable-msg=too-many-arguments
+    def __init__(self,
+                 vocab_size,
+                 classorder,
+                 smoothing,
+                 label_weight,
+                 corpussize=None,
+                 chunk_size=1024,
+                 dtype=float):
+        """
+            * vocab_size :: int
+                size of the vocabulary (not counting label pseudo-words) that
+                token ids index into
+            * classorder :: {str: int}
+            * smoothing :: float
+                smoothing value used in place of zero for class values
+            * label_weight :: str
+                see get_label_weight_function
+            * corpussize :: int
+                number of documents that will be added; only needed when
+                label_weight is scaled by corpus size
+            * chunk_size :: int
+                number of documents buffered before being added to the sums
+            * dtype :: np.dtype
+                dtype Q comes out as; the sums themselves are always kept in
+                float64
+        """
+        if label_weight.startswith('corpus:') and corpussize is None:
+            raise ValueError('corpussize is needed for label_weight ' +
+                             label_weight)
+        self.origvocabsize = vocab_size
+        self.classorder = classorder
+        self.smoothing = smoothing
+        self.label_weight = get_label_weight_function(label_weight)
+        self.corpussize = corpussize
+        self.chunk_size = chunk_size
+        self.dtype = np.dtype(dtype)
+        self.num_docs = 0
+        size = vocab_size + len(classorder)
+        self._sums = np.zeros((size, size))
+        self._H_hat = np.zeros(size)
+        self._chunk = []
+
+    def add_document(self, tokens, label=None):
+        """Adds a document
+
+            * tokens :: [int]
+                token ids of the document
+            * label :: str
+                label of the document, or None if the document is unlabeled
+        """
+        word_ids, counts = np.unique(np.asarray(tokens, dtype=int),
+                                     return_counts=True)
+        classcount = len(self.classorder)
+        label_values = np.full(classcount, self.smoothing, dtype=float)
+        if label is not None:
+            label_values[self.classorder[label]] = self.label_weight(
+                counts.sum(),
+                self.corpussize)
+        self._chunk.append((
+            np.concatenate(
+                [word_ids, self.origvocabsize + np.arange(classcount)]),
+            np.concatenate([counts.astype(float), label_values])))
+        self.num_docs += 1
+        if len(self._chunk) >= self.chunk_size:
+            self._flush()
+
+    def add_documents(self, documents):
+        """Adds documents
+
+            * documents :: iterable of ([int], str)
+                token ids and label (or None) of each document
+        """
+        for tokens, label in documents:
+            self.add_document(tokens, label)
+
+    # pylint:disable-msg=invalid-name
+    def _flush(self):
+        """Adds buffered documents to the sums"""
+        if not self._chunk:
+            return
+        indptr = np.cumsum([0] + [len(indices) for indices, _ in self._chunk])
+        docwords = scipy.sparse.csc_matrix(
+            (np.concatenate([data for _, data in self._chunk]),
+             np.concatenate([indices for indices, _ in self._chunk]),
+             indptr),
+            shape=(self._sums.shape[0], len(self._chunk)))
+        H_tilde, H_hat = build_h_matrices(docwords,
+                                          docwords.data,
+                                          doc_norms(docwords))
+        product = (H_tilde * H_tilde.transpose()).tocoo()
+        self._sums[product.row, product.col] += product.data
+        self._H_hat += H_hat
+        self._chunk = []
+
+    @property
+    def Q(self):
+        """Q over all documents added so far"""
+        if not self.num_docs:
+            raise ValueError('No documents have been added')
+        self._flush()
+        result = self._sums / self.num_docs
+        diagonal = np.arange(result.shape[0])
+        result[diagonal, diagonal] -= self._H_hat / self.num_docs
+        return result.astype(self.dtype, copy=False)
+
+
 # pylint:disable-msg=too-many-instance-attributes
 class IncrementalClassifiedDataset(AbstractParameterizedClassifiedDataset):
     """ClassifiedDataset for incremental case"""
@@ -235,24 +1048,70 @@ class IncrementalClassifiedDataset(AbstractParameterizedClassifiedDataset):
                                                            {},
                                                            {},
                                                            smoothing,
-                                                           label_weight)
+                                                           label_weight,
+                                                           settings)
         self.origvocabsize = len(self._vocab)
         self.titlesorder = get_titles_order(self.titles)
 
-    def doc_tokens(self, doc_id, rng=np.random):
-        if doc_id in self._tokens:
-            return self._tokens[doc_id]
+    def _token_vocab_size(self):
+        # label pseudo-words are not tokens
+        return self.origvocabsize
 
-        token_ids, _, counts = scipy.sparse.find(self._docwords[:, doc_id])
-        tokens = []
-        for token_id, count in zip(token_ids, counts):
-            if token_id < self.origvocabsize:
-                tokens.extend([token_id] * count)
-        # pylint:disable-msg=no-member
-        rng.shuffle(tokens)
+    def _unlabeled_docwords(self):
+        """Builds docwords as if no document had been labeled"""
+        words = self._docwords[:self.origvocabsize, :]
+        smoothing = scipy.sparse.csc_matrix(
+            np.full((len(self.classorder), self._docwords.shape[1]),
+                    self.smoothing))
+        return scipy.sparse.vstack([words, smoothing], format='csc')
 
-        self._tokens[doc_id] = tokens
-        return tokens
+    # pylint:disable-msg=invalid-name
+    def _update_cooccurrences(self, old_docwords, new_docwords):
+        """Replaces the contribution of some documents to Q
+
+            * old_docwords :: scipy.sparse.csc_matrix
+                columns of the documents as they were when Q was computed
+            * new_docwords :: scipy.sparse.csc_matrix
+                columns of the same documents as they are now
+        Only the entries of Q that these documents touch get updated.  The
+        difference between the old and new contributions is worked out in
+        float64 before being added to Q, so that Q (which may be stored with
+        less precision) is only rounded once per entry.
+        """
+        num_docs = self._docwords.shape[1]
+        old_H_tilde, old_H_hat = self._build_h(old_docwords)
+        new_H_tilde, new_H_hat = self._build_h(new_docwords)
+        update = (new_H_tilde * new_H_tilde.transpose() -
+                  old_H_tilde * old_H_tilde.transpose() -
+                  scipy.sparse.diags(new_H_hat - old_H_hat)).tocoo()
+        self._cooccurrences[update.row, update.col] += update.data / num_docs
+
+    def compute_cooccurrences(self, epsilon=1e-15):
+        """Computes Q
+
+        If q_cache_dir or q_shared_dir is set, Q for the corpus with no labeled
+        documents gets reused, and only the labeled documents are accounted for
+        here (in copy-on-write pages)
+        """
+        if not self._reuses_cooccurrences():
+            super(IncrementalClassifiedDataset,
+                  self).compute_cooccurrences(epsilon)
+            return
+        unlabeled = self._unlabeled_docwords()
+        key = hash_docwords(unlabeled,
+                            type(self).__name__,
+                            self.smoothing,
+                            self.label_weight_setting)
+        self._cooccurrences = self._reused_cooccurrences(unlabeled, key)
+        label_rows = self._docwords[self.origvocabsize:, :].toarray()
+        docnums = np.nonzero(np.any(label_rows != self.smoothing, axis=0))[0]
+        if docnums.size:
+            self._update_cooccurrences(unlabeled[:, docnums],
+                                       self._docwords[:, docnums])
+
+    def record_new_labels(self):
+        """Does nothing: documents go into self.labels as they get labeled"""
+        pass
 
     def _label_helper(self, docwords, title, label):
         docnum = self.titlesorder[title]
@@ -346,77 +1205,66 @@ class IncrementalClassifiedDataset(AbstractParameterizedClassifiedDataset):
 class QuickIncrementalClassifiedDataset(IncrementalClassifiedDataset):
     """ClassifiedDataset for incremental labeling using quick Q building"""
 
+    # Q gets computed from scratch again after unpickling, and documents
+    # labeled since then are applied on top
+    _caches = IncrementalClassifiedDataset._caches + ('prevq',)
+
     def __init__(self, dataset, settings):
         super(QuickIncrementalClassifiedDataset, self).__init__(dataset,
                                                                 settings)
         self.newlabels = {}
         self.prevq = None
 
-    # pylint:disable-msg=invalid-name
-    def _build_miniq(self, docnums):
-        """Builds Q with just the documents in docnums
-
-            * docnums :: np.array
-                column indices into self._docwords for the documents that have
-                been labeled for this update
-        """
-        data = []
-        indices = []
-        indptr = [0]
-        H_hat = np.zeros(self.vocab_size)
-        for docnum in docnums:
-            col_start = self._docwords.indptr[docnum]
-            col_end = self._docwords.indptr[docnum+1]
-            row_indices = self._docwords.indices[col_start:col_end]
-            count = np.sum(self._docwords.data[col_start:col_end])
-            norm = count * (count - 1)
-            if norm != 0:
-                sqrtnorm = np.sqrt(norm)
-                H_hat[row_indices] += \
-                    self._docwords.data[col_start:col_end] / norm
-                data.extend(self._docwords.data[col_start:col_end] / sqrtnorm)
-                indices.extend(row_indices)
-                indptr.append(len(data))
-        H_tilde = scipy.sparse.csc_matrix(
-            (data, indices, indptr),
-            shape=(self.vocab_size, len(indptr)-1),
-            dtype=np.float)
-        return H_tilde * H_tilde.transpose() - np.diag(H_hat)
+    def _apply_newlabels(self):
+        """Labels the documents in self.newlabels, updating Q to match"""
+        docnums = np.array(
+            [self.titlesorder[title] for title in self.newlabels])
+        unlabeled = self._docwords[:, docnums]
+        tmp = self._docwords.tolil()
+        for title, label in self.newlabels.items():
+            self._label_helper(tmp, title, label)
+        self._docwords = tmp.tocsc()
+        # swap what the documents contributed to Q before labeling for what
+        # they contribute now
+        self._update_cooccurrences(unlabeled, self._docwords[:, docnums])
+        self.newlabels = {}
 
     def compute_cooccurrences(self, epsilon=1e-15):
         """Updates Q"""
         if self.prevq is None:
-            ankura.pipeline.Dataset.compute_cooccurrences(self, epsilon)
+            super(QuickIncrementalClassifiedDataset,
+                  self).compute_cooccurrences(epsilon)
             self.prevq = self._cooccurrences
         else:
             # reload previous Q
             self._cooccurrences = self.prevq
         if self.newlabels:
-            # compute what needs to be taken out of Q
-            docnums = []
-            for title in self.newlabels:
-                docnums.append(self.titlesorder[title])
-            docnums = np.array(docnums)
-            miniq = self._build_miniq(docnums)
-            # take it out of Q
-            self._cooccurrences -= np.array(miniq / self._docwords.shape[1])
-            # compute what needs to be put into Q
-            tmp = self._docwords.tolil()
-            for title, label in self.newlabels.items():
-                self._label_helper(tmp, title, label)
-            self._docwords = tmp.tocsc()
-            miniq = self._build_miniq(docnums)
-            # put it into Q
-            self._cooccurrences += np.array(miniq / self._docwords.shape[1])
-            # reset new labels
-            self.newlabels = {}
-        if np.any(self._cooccurrences < 0):
-            print('Negative in Q')
-            print(np.transpose(np.nonzero(self._cooccurrences < 0)))
-            print(self._cooccurrences[self._cooccurrences < 0])
+            self._apply_newlabels()
+        self._zero_small_negatives(epsilon)
+
+    def _zero_small_negatives(self, epsilon):
+        """Reports negatives in Q and zeros out those within epsilon of 0
+
+        Goes through Q one block of rows at a time, writing only to blocks that
+        have negatives
+        """
+        found = False
+        for start, stop in row_blocks(self._cooccurrences.shape[0],
+                                      self.q_block_size):
+            block = self._cooccurrences[start:stop]
+            negatives = block < 0
+            if not np.any(negatives):
+                continue
+            if not found:
+                print('Negative in Q')
+                found = True
+            positions = np.transpose(np.nonzero(negatives))
+            positions[:, 0] += start
+            print(positions)
+            print(block[negatives])
+            block[negatives & (-epsilon < block)] = 0
+        if found:
             print('Original vocab size:', self.origvocabsize, flush=True)
-        self._cooccurrences[
-            (-epsilon < self._cooccurrences) & (self._cooccurrences < 0)] = 0
 
     def label_document(self, title, label):
         """Label a document in this corpus
@@ -461,49 +1309,82 @@ class ProjectedDataset(QuickIncrementalClassifiedDataset):
 
     @property
     def Q(self):
-        result = super(ProjectedDataset, self).Q.copy()
-        if np.any(result < 0):
+        cooccurrences = super(ProjectedDataset, self).Q
+        result = self._allocate_cooccurrences(cooccurrences.shape)
+        has_negatives = False
+        for start, stop in row_blocks(result.shape[0], self.q_block_size):
+            result[start:stop] = cooccurrences[start:stop]
+            has_negatives = has_negatives or np.any(result[start:stop] < 0)
+        if has_negatives:
             result = self._project(result)
         return result
 
     def compute_cooccurrences(self, epsilon=1e-15):
         """Updates Q"""
         if self.prevq is None:
-            ankura.pipeline.Dataset.compute_cooccurrences(self, epsilon)
+            IncrementalClassifiedDataset.compute_cooccurrences(self, epsilon)
             self.prevq = self._cooccurrences
         else:
             # reload previous Q
             self._cooccurrences = self.prevq
         if self.newlabels:
-            # compute what needs to be taken out of Q
-            docnums = []
-            for title in self.newlabels:
-                docnums.append(self.titlesorder[title])
-            docnums = np.array(docnums)
-            miniq = self._build_miniq(docnums)
-            # take it out of Q
-            self._cooccurrences -= np.array(miniq / self._docwords.shape[1])
-            # compute what needs to be put into Q
-            tmp = self._docwords.tolil()
-            for title, label in self.newlabels.items():
-                self._label_helper(tmp, title, label)
-            self._docwords = tmp.tocsc()
-            miniq = self._build_miniq(docnums)
-            # put it into Q
-            self._cooccurrences += np.array(miniq / self._docwords.shape[1])
-            # reset new labels
-            self.newlabels = {}
+            self._apply_newlabels()
 
     def _project(self, vector):
         """Projects vector onto simplex
 
         Uses algorithm proposed by Condat in "Fast Projection onto the Simplex
         and the l_1 Ball" (Mathematical Programming, July 2016, vol. 158, iss.
-        1)
+        1) when vector is stored in float64.  simplexproj only works on
+        doubles, and on the whole matrix at once, so for float32 the threshold
+        it would find is worked out a block of rows at a time instead (see
+        _simplex_threshold), and each block is then projected in a reusable
+        float64 buffer and written back into vector.
+        """
+        if vector.dtype == np.double:
+            flattened = np.ascontiguousarray(vector).ravel()
+            LIBCD.simplexproj(flattened, flattened, flattened.size, 1.0)
+            return flattened.reshape(vector.shape)
+        buf = np.empty((min(self.q_block_size, vector.shape[0]),
+                        vector.shape[1]))
+        threshold = self._simplex_threshold(vector, buf)
+        for start, stop in row_blocks(vector.shape[0], self.q_block_size):
+            block = buf[:stop-start]
+            block[:] = vector[start:stop]
+            block -= threshold
+            np.maximum(block, 0, out=block)
+            vector[start:stop] = block
+        return vector
+
+    def _simplex_threshold(self, vector, buf):
+        """Finds the tau for which projecting vector onto the simplex is
+        max(vector - tau, 0)
+
+        Runs Michelot's fixed point iteration (as in Condat's paper), which
+        only needs the sum and count of the entries above the current tau and
+        so can go through vector one block of rows at a time in buf; tau only
+        ever increases, and once the entries above it stay the same, it is the
+        tau simplexproj finds.
         """
-        flattened = vector.ravel()
-        LIBCD.simplexproj(flattened, flattened, flattened.size, 1.0)
-        return flattened.reshape(vector.shape)
+        threshold = None
+        prev_count = -1
+        while True:
+            total = 0.0
+            count = 0
+            for start, stop in row_blocks(vector.shape[0], self.q_block_size):
+                block = buf[:stop-start]
+                block[:] = vector[start:stop]
+                if threshold is None:
+                    total += block.sum()
+                    count += block.size
+                else:
+                    above = block > threshold
+                    total += block.sum(where=above)
+                    count += np.count_nonzero(above)
+            if count == prev_count:
+                return threshold
+            threshold = (total - 1.0) / count
+            prev_count = count
 
 
 class ZeroNegativesDataset(QuickIncrementalClassifiedDataset):
@@ -515,8 +1396,10 @@ class ZeroNegativesDataset(QuickIncrementalClassifiedDataset):
 
     @property
     def Q(self):
-        result = super(ZeroNegativesDataset, self).Q.copy()
-        result[result < 0] = 0
+        cooccurrences = super(ZeroNegativesDataset, self).Q
+        result = self._allocate_cooccurrences(cooccurrences.shape)
+        for start, stop in row_blocks(result.shape[0], self.q_block_size):
+            np.maximum(cooccurrences[start:stop], 0, out=result[start:stop])
         return result
 
 
@@ -527,140 +1410,87 @@ class ZeroEpsilonDataset(QuickIncrementalClassifiedDataset):
         super(ZeroEpsilonDataset, self).__init__(dataset,
                                                  settings)
 
-    # pylint:disable-msg=invalid-name
-    def _build_miniq(self, docnums):
-        """Builds Q with just the documents in docnums
+    def _h_hat_numerators(self, docwords):
+        """Squares the smoothing terms of unlabeled documents
 
-            * docnums :: np.array
-                column indices into self._docwords for the documents that have
-                been labeled for this update
+        Assumes that the label pseudo-words are the last entries of each column
+        of docwords
         """
-        data = []
-        indices = []
-        indptr = [0]
-        H_hat = np.zeros(self.vocab_size)
-        for docnum in docnums:
-            col_start = self._docwords.indptr[docnum]
-            col_end = self._docwords.indptr[docnum+1]
-            row_indices = self._docwords.indices[col_start:col_end]
-            count = np.sum(self._docwords.data[col_start:col_end])
-            norm = count * (count - 1)
-            if norm != 0:
-                sqrtnorm = np.sqrt(norm)
-                labels_start = col_end - len(self.classorder)
-                if np.all(
-                        self._docwords.data[labels_start:col_end] ==
-                        self.smoothing):
-                    H_hat[row_indices[:-len(self.classorder)]] += \
-                        self._docwords.data[col_start:labels_start] / norm
-                    H_hat[row_indices[-len(self.classorder):]] += \
-                        np.square(self._docwords.data[labels_start:col_end]) \
-                        / norm
-                else:
-                    H_hat[row_indices] += \
-                        self._docwords.data[col_start: col_end] / norm
-                data.extend(self._docwords.data[col_start:col_end] / sqrtnorm)
-                indices.extend(row_indices)
-                indptr.append(len(data))
-        H_tilde = scipy.sparse.csc_matrix(
-            (data, indices, indptr),
-            shape=(self.vocab_size, len(indptr)-1),
-            dtype=np.float)
-        return H_tilde * H_tilde.transpose() - np.diag(H_hat)
-
-    def init_compute_cooccurrences(self):
-        """Initialize Q"""
-        vocab_size, num_docs = self.M.shape
-        H_tilde = scipy.sparse.csc_matrix(self.M.copy(), dtype=float)
-        H_hat = np.zeros(vocab_size)
-
-        # Construct H_tilde and H_hat
-        for j in range(H_tilde.indptr.size - 1):
-            # get indices of column j
-            col_start = H_tilde.indptr[j]
-            col_end = H_tilde.indptr[j + 1]
-            row_indices = H_tilde.indices[col_start: col_end]
-
-            # get count of tokens in column (document) and compute norm
-            count = np.sum(H_tilde.data[col_start: col_end])
-            norm = count * (count - 1)
-
-            # update H_hat and H_tilde (see supplementary)
-            if norm != 0:
-                labels_start = col_end - len(self.classorder)
-                if len(self.classorder) and np.all(
-                        H_tilde.data[labels_start:col_end] == self.smoothing):
-                    H_hat[row_indices[:-len(self.classorder)]] += \
-                        H_tilde.data[col_start:labels_start] / norm
-                    H_hat[row_indices[-len(self.classorder):]] += \
-                        np.square(H_tilde.data[labels_start:col_end]) / norm
-                else:
-                    H_hat[row_indices] += \
-                        H_tilde.data[col_start: col_end] / norm
-                H_tilde.data[col_start: col_end] /= np.sqrt(norm)
-
-        # construct and store normalized Q
-        Q = H_tilde * H_tilde.transpose() - np.diag(H_hat)
-        self._cooccurrences = np.array(Q / num_docs)
-
-    def compute_cooccurrences(self, epsilon=1e-15):
-        """Updates Q"""
-        if self.prevq is None:
-            self.init_compute_cooccurrences()
-            self.prevq = self._cooccurrences
-        else:
-            # reload previous Q
-            self._cooccurrences = self.prevq
-        if self.newlabels:
-            # compute what needs to be taken out of Q
-            docnums = []
-            for title in self.newlabels:
-                docnums.append(self.titlesorder[title])
-            docnums = np.array(docnums)
-            miniq = self._build_miniq(docnums)
-            # take it out of Q
-            self._cooccurrences -= np.array(miniq / self._docwords.shape[1])
-            # compute what needs to be put into Q
-            tmp = self._docwords.tolil()
-            for title, label in self.newlabels.items():
-                self._label_helper(tmp, title, label)
-            self._docwords = tmp.tocsc()
-            miniq = self._build_miniq(docnums)
-            # put it into Q
-            self._cooccurrences += np.array(miniq / self._docwords.shape[1])
-            # reset new labels
-            self.newlabels = {}
-        if np.any(self._cooccurrences < 0):
-            print('Negative in Q')
-            print(np.transpose(np.nonzero(self._cooccurrences < 0)))
-            print(self._cooccurrences[self._cooccurrences < 0])
-            print('Original vocab size:', self.origvocabsize, flush=True)
-        self._cooccurrences[
-            (-epsilon < self._cooccurrences) & (self._cooccurrences < 0)] = 0
+        result = docwords.data.copy()
+        classcount = len(self.classorder)
+        if not classcount:
+            return result
+        lengths = np.diff(docwords.indptr)
+        ends = docwords.indptr[1:][lengths >= classcount]
+        label_entries = ends[:, np.newaxis] - np.arange(classcount, 0, -1)
+        smoothed = np.all(docwords.data[label_entries] == self.smoothing,
+                          axis=1)
+        label_entries = label_entries[smoothed].ravel()
+        result[label_entries] = np.square(docwords.data[label_entries])
+        return result
 
 
 class SupervisedAnchorDataset(AbstractClassifiedDataset):
     """Dataset implementing Nguyen et al. (NAACL 2015)"""
 
-    def __init__(self, dataset, labels, classorder):
+    _caches = AbstractClassifiedDataset._caches + ('_bar_q',)
+    # \bar{Q}; see _dataset_cooccurrences
+    _bar_q = None
+
+    def __init__(self, dataset, labels, classorder, settings=None):
         super(SupervisedAnchorDataset, self).__init__(dataset,
                                                       labels,
-                                                      classorder)
-        # precompute \bar{Q}
-        ankura.pipeline.Dataset.compute_cooccurrences(self)
-        # np doesn't broadcast across rows, so we make the rows into columns
-        # to perform the proper normalization before turning the columns back
-        # into rows
-        self._dataset_cooccurrences = \
-            (self._cooccurrences.T / self._cooccurrences.T.sum(axis=0)).T
+                                                      classorder,
+                                                      settings)
+        self._compute_dataset_cooccurrences()
+
+    def __setstate__(self, state):
+        # datasets pickled before \bar{Q} was left out of pickles
+        if '_dataset_cooccurrences' in state:
+            state['_bar_q'] = state.pop('_dataset_cooccurrences')
+        super(SupervisedAnchorDataset, self).__setstate__(state)
+
+    @property
+    def _dataset_cooccurrences(self):
+        """\bar{Q}, computed again the first time it is needed after
+        unpickling"""
+        if self._bar_q is None:
+            self._compute_dataset_cooccurrences()
+        return self._bar_q
+
+    def _compute_dataset_cooccurrences(self):
+        """Computes \bar{Q}; the rows get normalized as they are computed"""
+        if not self._reuses_cooccurrences():
+            AbstractClassifiedDataset.compute_cooccurrences(self)
+            self._bar_q = self._cooccurrences
+        else:
+            # \bar{Q} is never modified, so it can be mapped read-only
+            self._bar_q = self._reused_cooccurrences(
+                self._docwords,
+                hash_docwords(self._docwords, 'SupervisedAnchorDataset'),
+                mmap_mode='r')
         # fool ankura into calling compute_cooccurrences
         self._cooccurrences = None
 
+    def _finish_cooccurrence_rows(self, rows):
+        """Normalizes each row of \bar{Q}"""
+        rows /= rows.sum(axis=1, keepdims=True)
+
+    def _copy_dataset_cooccurrences(self):
+        """Sets Q to \bar{Q} with zeroed out columns for the classes"""
+        orig_height, orig_width = self._dataset_cooccurrences.shape
+        classcount = len(self.classorder)
+        self._cooccurrences = self._allocate_cooccurrences(
+            (orig_height, orig_width+classcount))
+        for start, stop in row_blocks(orig_height, self.q_block_size):
+            self._cooccurrences[start:stop, :orig_width] = \
+                self._dataset_cooccurrences[start:stop]
+            self._cooccurrences[start:stop, orig_width:] = 0
+
     def compute_cooccurrences(self, epsilon=1e-15):
         orig_height, orig_width = self._dataset_cooccurrences.shape
         classcount = len(self.classorder)
-        self._cooccurrences = np.zeros((orig_height, orig_width+classcount))
-        self._cooccurrences[:, :-classcount] = self._dataset_cooccurrences
+        self._copy_dataset_cooccurrences()
         # assuming that self._docwords is an instance of a scipy sparse matrix
         docwords_csr = self._docwords.tocsr()
         indices = docwords_csr.indices
@@ -688,20 +1518,33 @@ class IncrementalSupervisedAnchorDataset(SupervisedAnchorDataset):
     incrementally labeled data
     """
 
-    def __init__(self, dataset, _):
+    def __init__(self, dataset, settings):
         super(IncrementalSupervisedAnchorDataset, self).__init__(dataset,
                                                                  {},
-                                                                 {})
+                                                                 {},
+                                                                 settings)
         self.titlesorder = get_titles_order(self.titles)
         self.extra_counts = None
         self.newlabels = {}
 
-    def compute_cooccurrences(self, epsilon=1e-15):
-        orig_height, orig_width = self._dataset_cooccurrences.shape
+    def record_new_labels(self):
+        """Moves the documents labeled since the last call into self.labels
+
+        The per-class counts of labeled documents for each word (which the
+        label columns of Q are made from) get updated along with them, but Q
+        itself does not get built, so this is cheap enough to call whenever
+        only the labels are needed
+        """
+        orig_height = self._docwords.shape[0]
         classcount = len(self.classorder)
-        self._cooccurrences = np.zeros((orig_height, orig_width+classcount))
-        self._cooccurrences[:, :-classcount] = self._dataset_cooccurrences
-        if not self.extra_counts:
+        if self.extra_counts is not None and \
+                self.extra_counts.shape[1] < classcount:
+            # classes that showed up since start with no counts
+            self.extra_counts = np.hstack([
+                self.extra_counts,
+                np.zeros((orig_height,
+                          classcount - self.extra_counts.shape[1]))])
+        if self.extra_counts is None:
             self.extra_counts = np.zeros((orig_height, classcount))
             for title, label in self.newlabels.items():
                 self.labels[title] = label
@@ -742,12 +1585,18 @@ class IncrementalSupervisedAnchorDataset(SupervisedAnchorDataset):
                         data[indptr[title_index]:indptr[title_index+1]]):
                     if count > 0:
                         self.extra_counts[word, label] += 1
+                self.labels[title] = label_string
+        self.newlabels = {}
+
+    def compute_cooccurrences(self, epsilon=1e-15):
+        classcount = len(self.classorder)
+        self._copy_dataset_cooccurrences()
+        self.record_new_labels()
         # normalize tally
         row_sums = self.extra_counts.sum(axis=1, keepdims=True)
         # prevent divisions by zero
         row_sums[row_sums == 0] = 1
         self._cooccurrences[:, -classcount:] = self.extra_counts / row_sums
-        self.newlabels = {}
 
     def initial_label(self, titles, labels):
         """Account for initially labeled documents
@@ -789,20 +1638,21 @@ class IncrementalSupervisedNormalizedAnchorDataset(
     heavily weights the last columns, which contain label information)
     """
 
-    def __init__(self, dataset, _):
+    def __init__(self, dataset, settings):
         super(IncrementalSupervisedNormalizedAnchorDataset, self).__init__(
             dataset,
-            {})
+            settings)
 
     def compute_cooccurrences(self, epsilon=1e-15):
         orig_height, orig_width = self._dataset_cooccurrences.shape
         classcount = len(self.classorder)
         super(IncrementalSupervisedNormalizedAnchorDataset,
             self).compute_cooccurrences(epsilon)
-        self._cooccurrences[:, :-classcount] *= \
-            orig_width / (orig_width+classcount)
-        self._cooccurrences[:, -classcount:] *= classcount /\
-            (orig_width+classcount)
+        for start, stop in row_blocks(orig_height, self.q_block_size):
+            self._cooccurrences[start:stop, :-classcount] *= \
+                orig_width / (orig_width+classcount)
+            self._cooccurrences[start:stop, -classcount:] *= classcount /\
+                (orig_width+classcount)
 
 
 SUPANCH_CTORS = [
@@ -1,43 +1,93 @@
 """Models for use in ClassTM"""
 import datetime
+import functools
 import os
-import subprocess
+import pickle
 import json
 import time
 
 import sklearn.decomposition as decomp
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.linear_model import LogisticRegression
+from sklearn.feature_selection import chi2, mutual_info_classif
+from sklearn.linear_model import LogisticRegression, SGDClassifier
 from sklearn.naive_bayes import MultinomialNB
-from sklearn.svm import SVC
+from sklearn.svm import SVC, LinearSVC
 import numpy as np
-import scipy
-from scipy.sparse import csc_matrix
+import scipy.sparse
 
 import activetm.tech.anchor
 import ankura.pipeline
 import classtm.labeled
 import classtm.classifier
+import classtm.pickling
+import classtm.scoring
+from classtm.scoring import DocBatch, build_features, FREE_CHUNK_SIZE
 
 
-FILE_DIR = os.path.dirname(os.path.abspath(__file__))
-LDA_DIR = os.path.join(FILE_DIR, 'ldac')
-LDAC_EXE = os.path.join(LDA_DIR, 'lda')
-# these are the settings that Nguyen et al. used
-LDAC_SETTINGS = os.path.join(LDA_DIR, 'inf-settings.txt')
+# scikit-learn renamed the logistic loss of SGDClassifier from 'log'
+SGD_LOG_LOSS = 'log_loss' if 'log_loss' in SGDClassifier.loss_functions \
+    else 'log'
+# how to parse the value of each option allowed in classifier_options
+CLASSIFIER_OPTIONS = {'n_jobs': int,
+                      'solver': str,
+                      'tol': float,
+                      'max_iter': int,
+                      'linear': lambda value: value.upper() == 'YES'}
 
 
-def count_tokens(tokens):
-    """Count token types found in tokens
+def document_frequency(counts, _):
+    """Number of documents each word appears in"""
+    return np.asarray((counts > 0).sum(axis=0)).ravel()
 
-        * tokens :: [str]
+
+def chi2_scores(counts, labels):
+    """Chi-squared statistic between each word's counts and labels"""
+    scores, _ = chi2(counts, labels)
+    # words that never appear get nan
+    return np.nan_to_num(scores)
+
+
+def mutual_information(counts, labels):
+    """Mutual information between each word's counts and labels"""
+    return mutual_info_classif(counts, labels, discrete_features=True)
+
+
+# ways to score words for feature selection
+FEATURE_SCORES = {'chi2': chi2_scores,
+                  'mi': mutual_information,
+                  'df': document_frequency}
+
+
+def parse_feature_selection(value):
+    """Parses the value of the feature_selection setting
+
+        * value :: str
+            {chi2, mi, df}:k, e.g., 'chi2:2000' to keep the 2000 words with the
+            highest chi-squared statistic
+    Returns (str, int)
+    """
+    method, k = value.split(':')
+    if method not in FEATURE_SCORES:
+        raise Exception('Unknown feature selection method: ' + method)
+    return method, int(k)
+
+
+def parse_classifier_options(value):
+    """Parses the value of the classifier_options setting
+
+        * value :: str
+            comma-separated option=value pairs, e.g., 'n_jobs=4,solver=saga'
+    Returns {str: ?}
     """
     result = {}
-    for token in tokens:
-        if token in result:
-            result[token] += 1
-        else:
-            result[token] = 1
+    for pair in value.split(','):
+        if not pair.strip():
+            continue
+        option, optvalue = pair.split('=', 1)
+        option = option.strip()
+        if option not in CLASSIFIER_OPTIONS:
+            raise Exception('Unknown classifier option: ' + option)
+        result[option] = CLASSIFIER_OPTIONS[option](optvalue.strip())
     return result
 
 
@@ -56,52 +106,23 @@ class VariationalHelper:
                 things)
         """
         self.varname = varname
+        self.dtype = topics.dtype
         if len(varname) >= 86:
             raise Exception('Output name prefix is too long: '+self.varname)
-        self.datafile = self.varname+'_words.txt'
-        self.output = self.varname+'_out'
-        self.output_gamma = self.output+'-gamma.dat'
-        # .beta file has shape (topics, vocab)
-        topicscopy = topics.T.copy()
-        # lda-c stores topics in log space
-        topicscopy += 0.1e-100
-        # pylint:disable=no-member
-        topicscopy = np.log(topicscopy)
-        np.savetxt(varname+'.beta', topicscopy, fmt='%5.10f')
-        with open(varname+'.other', 'w') as ofh:
-            ofh.write('num_topics '+str(topicscopy.shape[0])+'\n')
-            ofh.write('num_terms '+str(topicscopy.shape[1])+'\n')
-            # Nguyen et al. use an alpha of 0.1:
-            # anchor_python/scripts/create_other_ldac.py
-            ofh.write('alpha 0.1\n')
-
-    def predict_topics(self, docwses):
+        classtm.scoring.write_ldac_model(topics, varname)
+
+    def predict_topics(self, batch):
         """Call on lda-c to get gammas
 
-            * docwses :: [[int]]
-                the first dimension separates documents; the second dimension
-                separates tokens
-        Assuming that all documents in docwses are non-empty
-        """
-        countses = []
-        for docws in docwses:
-            countses.append(count_tokens(docws))
-        with open(self.datafile, 'w') as ofh:
-            for counts in countses:
-                line = []
-                line.append(str(len(counts)))
-                for token, count in sorted(counts.items()):
-                    line.append(str(token)+':'+str(count))
-                ofh.write(' '.join(line)+'\n')
-        subprocess.run(
-            [
-                LDAC_EXE,
-                'inf',
-                LDAC_SETTINGS,
-                self.varname,
-                self.datafile,
-                self.output])
-        return np.loadtxt(self.output_gamma)
+            * batch :: DocBatch
+        Assuming that all documents in batch are non-empty
+
+        Safe to call concurrently: the documents and gammas of each call go in
+        a scratch directory of their own
+        """
+        return classtm.scoring.ldac_topic_mixes(self.varname,
+                                                batch,
+                                                self.dtype)
 
 
 class SamplingHelper:
@@ -121,24 +142,13 @@ class SamplingHelper:
         self.varname = varname
         self.numsamplesperpredictchain = 5
 
-    def predict_topics(self, docwses):
+    def predict_topics(self, batch):
         """Call ankura to get topic mixtures for all the documents
-            * docwses :: [[int]]
-                the first dimension separates documents; the second dimension
-                separates tokens
-        Assumes that all documents in docwses are non-empty
-        """
-        numtopics = self.topics.shape[1]
-        topic_mixes = np.zeros((len(docwses), numtopics))
-        for i, docws in enumerate(docwses):
-            result = np.zeros(numtopics)
-            for _ in range(self.numsamplesperpredictchain):
-                counts, _ = ankura.topic.predict_topics(self.topics,
-                                                        docws)
-                result += counts
-            result /= (len(docws) * self.numsamplesperpredictchain)
-            topic_mixes[i, :] = result
-        return topic_mixes
+            * batch :: DocBatch
+        Assumes that all documents in batch are non-empty
+        """
+        return classtm.scoring.sampled_topic_mixes(
+            self.topics, batch, self.numsamplesperpredictchain)
 
 
 class OnlineHelper:
@@ -151,24 +161,46 @@ class OnlineHelper:
             * topics :: 2D np.array
                 should have shape (vocab size, number of topics)
         """
+        self.dtype = topics.dtype
         self.lda = decomp.LatentDirichletAllocation(topics.shape[1])
         self.lda.components_ = topics.T
         self.lda._init_latent_vars(topics.shape[0])
 
-    def predict_topics(self, docwses):
-        """Call online variational Bayes to compute topic mixtures"""
-        data = []
-        indices = []
-        indptr = [0]
-        for docws in docwses:
-            for token, count in sorted(count_tokens(docws).items()):
-                data.append(count)
-                indices.append(token)
-            indptr.append(len(data))
-        doc_words = scipy.sparse.csr_matrix(
-            (data, indices, indptr),
-            shape=(len(docwses), self.lda.components_.shape[1]))
-        return self.lda.transform(doc_words)
+    def __getstate__(self):
+        """Keeps only what inference needs
+
+        The LatentDirichletAllocation also holds its randomly initialized
+        variational parameters, which are as big again
+        """
+        return {'dtype': self.dtype, 'topic_word': self.topic_word}
+
+    def __setstate__(self, state):
+        self.dtype = state['dtype']
+        if 'lda' in state:
+            # pickled with the whole LatentDirichletAllocation
+            self.lda = state['lda']
+        else:
+            self.lda = classtm.scoring.OnlineInference(state['topic_word'],
+                                                       self.dtype)
+
+    @property
+    def topic_word(self):
+        """exp(E[log beta]) of the topics, with shape (number of topics, vocab
+        size)"""
+        if isinstance(self.lda, classtm.scoring.OnlineInference):
+            return self.lda.topic_word
+        return self.lda.exp_dirichlet_component_
+
+    def predict_topics(self, batch):
+        """Call online variational Bayes to compute topic mixtures
+
+            * batch :: DocBatch
+        Once unpickled, this uses classtm.scoring.OnlineInference, which gets
+        the same mixtures without scikit-learn
+        """
+        if isinstance(self.lda, classtm.scoring.OnlineInference):
+            return self.lda.predict_topics(batch)
+        return self.lda.transform(batch.counts).astype(self.dtype, copy=False)
 
 
 # pylint:disable-msg=too-few-public-methods
@@ -181,9 +213,9 @@ class FreeClassifier:
             * weights :: 2D np.array
                 one row for each class, signifying the linear combination of
                 topics that represent a class
-            * class_given_word :: 2D np.array
+            * class_given_word :: 2D np.array (or scipy.sparse matrix)
                 expected shape is (number of classes, vocab size), this is the
-                probability of each class given each word
+                probability of each class given each word; stored as CSR
             * classorder :: {'class': int}
                 dictionary of class names that are mapped to corresponding
                 index in weights
@@ -196,30 +228,52 @@ class FreeClassifier:
         self.classorder = classorder
         self.orderedclasses = classtm.labeled.orderclasses(self.classorder)
         # Added by Connor to get word features working
-        self.class_given_word = class_given_word
+        self.class_given_word = scipy.sparse.csr_matrix(class_given_word)
 
-    def predict(self, features, doc_words):
-        """Predict class labels for each instance in features
+    def decision_function(self, features, batch, chunk_size=None):
+        """Score each class for each instance in features
 
             * features :: 2D np.array
                 has shape (number of instances, topic count)
-            * doc_words :: 2D scipy.sparse.csc_matrix
-                has shape (vocab size, number of documents)
-        """
-        # dot product calculates score for each label for each instance, where
-        # labels are lined up along the rows and instances are lined up along
-        # the columns
-        topic_score = np.dot(self.weights, features.T)
-        topic_score = topic_score / topic_score.sum(axis=0)
-        word_score = csc_matrix.dot(self.class_given_word, doc_words)
-        word_score_sum = word_score.sum(axis=0)
-        # wherever sums are 0, make no-op division
-        word_score_sum[word_score_sum == 0] = 1
-        word_score = word_score / word_score_sum
-        score = topic_score + word_score
-        # axis tells argmax to choose the highest row per column
-        predictions = np.argmax(score, axis=0)
-        return np.array([self.orderedclasses[pred] for pred in predictions])
+            * batch :: DocBatch
+                the documents features were computed for; word ids past the
+                end of class_given_word (i.e., label pseudo-words) are ignored
+            * chunk_size :: int
+                number of instances scored at a time, which bounds the memory
+                used for temporaries (default FREE_CHUNK_SIZE)
+        Returns 2D np.array of shape (number of instances, number of classes);
+        each score is the sum of a topic score and a word score, each of which
+        sums to 1 over the classes (the word score may instead be all 0 for
+        an instance with no words in class_given_word)
+        """
+        if chunk_size is None:
+            chunk_size = FREE_CHUNK_SIZE
+        return classtm.scoring.free_decision_function(features,
+                                                      batch,
+                                                      self.weights,
+                                                      self.class_given_word,
+                                                      chunk_size)
+
+    def predict_proba(self, features, batch, chunk_size=None):
+        """Scores from decision_function, normalized to sum to 1 per instance
+        """
+        result = self.decision_function(features, batch, chunk_size)
+        result /= result.sum(axis=1, keepdims=True)
+        return result
+
+    def predict_indices(self, features, batch, chunk_size=None):
+        """Predict index (according to classorder) of the class of each
+        instance in features"""
+        return np.argmax(self.decision_function(features, batch, chunk_size),
+                         axis=1)
+
+    def predict(self, features, batch, chunk_size=None):
+        """Predict class labels for each instance in features
+
+        See decision_function for parameters
+        """
+        return np.asarray(self.orderedclasses)[
+            self.predict_indices(features, batch, chunk_size)]
 
 
 def _get_train_intermediates(dataset, train_doc_ids, knownresp):
@@ -250,6 +304,10 @@ class AbstractTrainSetBuilder(object):
     reimplemented the closures in object-oriented form.
     """
 
+    # settings passed on to the training sets that get built (e.g., to choose
+    # how Q is computed and stored)
+    settings = {}
+
     def __init__(self, dataset_ctor):
         self.dataset_ctor = dataset_ctor
 
@@ -281,7 +339,8 @@ class TrainSetBuilder(AbstractTrainSetBuilder):
             knownresp)
         trainingset = self.dataset_ctor(filtered,
                                         labels,
-                                        dataset.classorder)
+                                        dataset.classorder,
+                                        settings=self.settings)
         return trainingset, corpus_to_train_vocab
 
 
@@ -313,7 +372,8 @@ class ParameterizedTrainSetBuilder(AbstractTrainSetBuilder):
                                         labels,
                                         dataset.classorder,
                                         self.smoothing,
-                                        self.label_weight)
+                                        self.label_weight,
+                                        settings=self.settings)
         return trainingset, corpus_to_train_vocab
 
 
@@ -347,6 +407,22 @@ def id_cands_maker(classcount, doc_threshold):
 class AbstractClassifyingAnchor:
     """Base class for classifying anchor words"""
 
+    # dtype for topics and topic mixtures
+    dtype = np.dtype(np.float64)
+    # options for the classifier trained on the topics (see
+    # parse_classifier_options)
+    classifier_options = {}
+    # (method, k) for choosing which word count features the classifier gets
+    # (see parse_feature_selection), or None to give it all of them
+    feature_selection = None
+    # word ids whose counts are features, or None for all words
+    selected_words = None
+    # number of documents that predict_topics last skipped inference on
+    # because they were duplicates of other documents in the batch
+    duplicate_docs = 0
+    # classtm.scoring.SingleDocScorer for predict_one, built on first use
+    _scorer = None
+
     # pylint:disable-msg=too-many-arguments
     def __init__(self,
                  rng,
@@ -384,6 +460,37 @@ class AbstractClassifyingAnchor:
         self.lda = None
         self.predictor = None
 
+    def __getstate__(self):
+        """Leaves out the SingleDocScorer and cached feature selections,
+        which get rebuilt when they are needed"""
+        state = classtm.pickling.drop_caches(self.__dict__, ['_scorer'])
+        if '_selection_cache' in state:
+            state['_selection_cache'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def configure(self, settings):
+        """Reads options that are not model parameters from settings
+
+            * settings :: {str: str}
+                'precision' (float64 or float32), 'classifier_options', and
+                'feature_selection' are optional; all settings are also passed
+                on to the training sets this model builds
+        """
+        if 'precision' in settings:
+            self.dtype = np.dtype(settings['precision'])
+        if 'classifier_options' in settings:
+            self.classifier_options = parse_classifier_options(
+                settings['classifier_options'])
+        if 'feature_selection' in settings:
+            self.feature_selection = parse_feature_selection(
+                settings['feature_selection'])
+            self._selection_cache = {}
+        if self.train_set_builder is not None:
+            self.train_set_builder.settings = settings
+
     def train(self,
               dataset,
               train_doc_ids,
@@ -408,6 +515,7 @@ class AbstractClassifyingAnchor:
                 name of the file containing the anchors this model should use
                 or None if gram-schmidt anchors should be used
         """
+        self._scorer = None
         trainingset, self.corpus_to_train_vocab = \
             self.train_set_builder.build_train_set(dataset,
                                                    train_doc_ids,
@@ -437,9 +545,10 @@ class AbstractClassifyingAnchor:
         # relying on fact that recover_topics goes through all rows of Q, the
         # cooccurrence matrix in trainingset
         # self.topics has shape (vocabsize, numtopics)
-        self.topics = ankura.topic.recover_topics(trainingset,
-                                                  self.anchors,
-                                                  self.expgrad_epsilon)
+        self.topics = ankura.topic.recover_topics(
+            trainingset,
+            self.anchors,
+            self.expgrad_epsilon).astype(self.dtype, copy=False)
         end = time.time()
         anchorwords_time = datetime.timedelta(seconds=end-start)
         self.lda = lda_helper(self.topics, varname)
@@ -449,69 +558,228 @@ class AbstractClassifyingAnchor:
 
     def predict(self, tokenses):
         """Predict labels"""
-        docwses = []
-        for tokens in tokenses:
-            docwses.append(self._convert_vocab_space(tokens))
-        features = scipy.sparse.hstack(
-            [
-                self.predict_topics(docwses),
-                self.encode(docwses)]).tocsr()
-        return self.predictor.predict(features)
-
-    def _convert_vocab_space(self, tokens):
-        """Change vocabulary from corpus space to training set space"""
-        result = []
-        for token in tokens:
-            conversion = self.corpus_to_train_vocab[token]
-            if conversion >= 0:
-                result.append(conversion)
-        return result
+        batch = self._convert_vocab_space(tokenses)
+        return self.predictor.predict(self.features(batch))
 
-    def encode(self, docwses):
+    def predict_parallel(self, tokenses, workers):
+        """Predict labels on a pool of workers threads
+
+        See classtm.scoring.predict_parallel
+        """
+        return classtm.scoring.predict_parallel(self.predict,
+                                                tokenses,
+                                                workers)
+
+    def predict_one(self, tokens):
+        """Predict label of one document, entirely in memory
+
+            * tokens :: [int]
+                token ids in corpus space
+        Much faster than predict([tokens]): see classtm.scoring.SingleDocScorer
+        """
+        if self._scorer is None:
+            self._scorer = self._single_doc_scorer()
+        return self._scorer.predict_one(tokens)
+
+    def _single_doc_scorer(self):
+        """Builds the SingleDocScorer for predict_one"""
+        if isinstance(self.lda, OnlineHelper):
+            inference = classtm.scoring.OnlineInference(self.lda.topic_word,
+                                                        self.dtype)
+        elif isinstance(self.lda, VariationalHelper):
+            inference = classtm.scoring.VariationalInference(self.topics,
+                                                             self.dtype)
+        else:
+            inference = classtm.scoring.SamplingInference(
+                self.lda.topics, self.lda.numsamplesperpredictchain)
+        predictor_kind, arrays = _export_predictor(
+            self.predictor,
+            classtm.labeled.orderclasses(self.classorder))
+        if predictor_kind == 'free':
+            arrays['class_given_word'] = self.predictor.class_given_word
+        return classtm.scoring.SingleDocScorer(inference,
+                                               self.numtopics,
+                                               self.corpus_to_train_vocab,
+                                               self.vocabsize,
+                                               self.dtype,
+                                               predictor_kind,
+                                               arrays,
+                                               self.selected_words,
+                                               self.predictor)
+
+    def _convert_vocab_space(self, tokenses):
+        """Change vocabulary from corpus space to training set space
+
+            * tokenses :: [[int]]
+                documents as token ids in corpus space
+        Returns DocBatch in training set space
+        """
+        return DocBatch.from_tokens(
+            tokenses,
+            self.vocabsize,
+            np.asarray(self.corpus_to_train_vocab, dtype=np.int64))
+
+    def encode(self, batch):
         """Produces sparse matrix of token counts
 
         Rows correspond to documents and columns correspond to tokens
         """
-        result = scipy.sparse.lil_matrix((len(docwses), self.vocabsize))
-        for i, docws in enumerate(docwses):
-            for token in sorted(docws):
-                result[i, token] += 1
-        return result
+        return batch.counts.astype(self.dtype)
+
+    @property
+    def selected_k(self):
+        """Number of word count features, or None if all words are used"""
+        if self.selected_words is None:
+            return None
+        return len(self.selected_words)
+
+    def select_words(self, batch, labels):
+        """Chooses which word counts are features, according to
+        feature_selection
+
+            * batch :: DocBatch
+                labeled training documents
+            * labels :: [?]
+                labels[i] is the label of document i in batch
+        Selections are cached, since the word counts of the labeled documents
+        often stay the same from one training to the next
+        """
+        if self.feature_selection is None:
+            self.selected_words = None
+            return
+        method, k = self.feature_selection
+        key = classtm.labeled.hash_docwords(batch.counts, method, k, labels)
+        if key not in self._selection_cache:
+            scores = FEATURE_SCORES[method](batch.counts, labels)
+            # stable sort, so that ties go to the lower word id
+            best = np.argsort(-scores, kind='mergesort')[:k]
+            self._selection_cache[key] = np.sort(best)
+        self.selected_words = self._selection_cache[key]
+
+    def features(self, batch):
+        """Produces sparse matrix of topic mixtures followed by token counts
+        (of only the selected words, if words have been selected)
+
+        Rows correspond to documents
+        """
+        topic_mixes = self.predict_topics(batch)
+        if self.selected_words is not None:
+            batch = DocBatch(batch.counts[:, self.selected_words],
+                             batch.lengths,
+                             batch.order)
+        return build_features(topic_mixes, batch, self.dtype)
 
     def cleanup(self):
         """Cleans up any resources used by this instance"""
         pass
 
-    def predict_topics(self, docwses):
-        """Predict topic mixtures for docwses
+    def predict_topics(self, batch):
+        """Predict topic mixtures for batch
 
-            * docwses :: [[int]]
-                the first dimension separates documents; the second dimension
-                separates tokens
-        Assuming that docwses is in trainingset vocabulary space
+            * batch :: DocBatch
+        Assuming that batch is in trainingset vocabulary space
+
+        Topic mixtures only get inferred once for each distinct non-empty
+        document; empty documents get the uniform mixture
         """
-        passon = []
-        empties = []
-        for i, docws in enumerate(docwses):
-            length = len(docws)
-            if length > 0:
-                passon.append(docws)
-            else:
-                empties.append(i)
-        empty_mix = np.array([1.0/self.numtopics] * self.numtopics)
-        topic_mixes = self.lda.predict_topics(passon)
-        result = np.zeros((len(docwses), self.numtopics))
-        added = 0
-        for i in range(len(docwses)):
-            if len(empties) > 0 and \
-                    added < len(empties) and \
-                    i == empties[added]:
-                result[i:] = empty_mix
-                added += 1
-            else:
-                result[i:] = topic_mixes[i-added]
+        result, self.duplicate_docs = classtm.scoring.infer_topic_mixes(
+            self.lda.predict_topics, batch, self.numtopics, self.dtype)
         return result
 
+    def export(self, path):
+        """Writes what prediction needs to directory path, for
+        classtm.scoring.load
+
+        Arrays (topics, corpus_to_train_vocab, selected words, and classifier
+        weights) are written as uncompressed .npy files, which get
+        memory-mapped when loaded.  Classifiers that are not linear (kernel
+        SVMs, random forests, and SVMLight TSVMs) get pickled instead, since
+        they have no weights to write; the model files of SVMLight TSVMs get
+        copied along with them.  Models that infer topic mixtures with lda-c
+        get its model files written too.
+        """
+        arrays = {'topics': self.topics,
+                  'corpus_to_train_vocab': np.asarray(
+                      self.corpus_to_train_vocab, dtype=np.int64)}
+        if self.selected_words is not None:
+            arrays['selected_words'] = self.selected_words
+        if isinstance(self.lda, OnlineHelper):
+            # what the helper actually infers with, which need not be
+            # derived from self.topics
+            arrays['topic_word'] = self.lda.topic_word
+        predictor_kind, predictor_arrays = _export_predictor(
+            self.predictor,
+            classtm.labeled.orderclasses(self.classorder))
+        arrays.update(predictor_arrays)
+        meta = {'model': type(self).__name__,
+                'helper': type(self.lda).__name__,
+                'predictor': predictor_kind,
+                'numtopics': self.numtopics,
+                'vocabsize': self.vocabsize,
+                'dtype': self.dtype.name,
+                'classorder': self.classorder}
+        if predictor_kind == 'free':
+            meta['class_given_word_shape'] = list(
+                self.predictor.class_given_word.shape)
+        elif predictor_kind == 'pickle':
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, 'predictor.pkl'), 'wb') as ofh:
+                pickle.dump(self.predictor, ofh)
+            if isinstance(self.predictor, classtm.classifier.TSVM):
+                self.predictor.copy_models(
+                    os.path.join(path, classtm.scoring.EXPORT_SVMLIGHT_DIR))
+                meta['svmlight_models'] = True
+        if isinstance(self.lda, VariationalHelper):
+            os.makedirs(path, exist_ok=True)
+            classtm.scoring.write_ldac_model(
+                self.topics,
+                os.path.join(path, classtm.scoring.EXPORT_LDAC_MODEL))
+        elif isinstance(self.lda, SamplingHelper):
+            meta['samples'] = self.lda.numsamplesperpredictchain
+        classtm.scoring.write_export(path, meta, arrays)
+
+
+def _export_predictor(predictor, orderedclasses):
+    """Gets the arrays classtm.scoring needs to score with predictor
+
+        * predictor :: sklearn-style classifier
+        * orderedclasses :: [?]
+            class labels, in classorder order
+    Returns the kind of predictor ('free', 'linear', or 'pickle' for those
+    that can only be pickled) and {name: np.array}
+    """
+    if isinstance(predictor, FreeClassifier):
+        class_given_word = predictor.class_given_word
+        return 'free', {'weights': predictor.weights,
+                        'class_given_word_data': class_given_word.data,
+                        'class_given_word_indices': class_given_word.indices,
+                        'class_given_word_indptr': class_given_word.indptr,
+                        'classes': np.asarray(predictor.orderedclasses)}
+    if isinstance(predictor, classtm.classifier.LinearTSVM):
+        num_features = max([len(coef.ravel())
+                            for coef, _ in predictor.models
+                            if coef is not None] + [0])
+        coef = np.zeros((len(predictor.models), num_features))
+        intercept = np.empty(len(predictor.models))
+        for i, (class_coef, class_intercept) in enumerate(predictor.models):
+            if class_coef is not None:
+                coef[i] = class_coef.ravel()
+            intercept[i] = np.ravel(class_intercept)[0]
+        return 'linear', {'coef': coef,
+                          'intercept': intercept,
+                          'classes': np.asarray(predictor.orderedclasses)}
+    if isinstance(predictor, MultinomialNB):
+        # predicts the class with the highest joint log likelihood, which is
+        # linear in the features
+        return 'linear', {'coef': predictor.feature_log_prob_,
+                          'intercept': predictor.class_log_prior_,
+                          'classes': predictor.classes_}
+    if isinstance(predictor, (LogisticRegression, LinearSVC, SGDClassifier)):
+        return 'linear', {'coef': predictor.coef_,
+                          'intercept': np.ravel(predictor.intercept_),
+                          'classes': predictor.classes_}
+    return 'pickle', {'classes': np.asarray(orderedclasses)}
+
 
 def free_classifier(freeclassifyinganchor, trainingset, _):
     """Builds a trained FreeClassifier
@@ -565,16 +833,9 @@ class FreeClassifyingAnchor(AbstractClassifyingAnchor):
 
     def predict(self, tokenses):
         """Predict labels"""
-        docwses = []
-        doc_words = scipy.sparse.dok_matrix(
-            (self.vocabsize-len(self.classorder), len(tokenses)))
-        for i, tokens in enumerate(tokenses):
-            real_vocab = self._convert_vocab_space(tokens)
-            docwses.append(real_vocab)
-            for token in real_vocab:
-                doc_words[token, i] += 1
-        features = self.predict_topics(docwses)
-        return self.predictor.predict(features, doc_words.tocsc())
+        batch = self._convert_vocab_space(tokenses)
+        features = self.predict_topics(batch)
+        return self.predictor.predict(features, batch)
 
 
 def sklearn_classifier(anchor, trainingset, knownresp, classifier):
@@ -583,10 +844,9 @@ def sklearn_classifier(anchor, trainingset, knownresp, classifier):
     docwses = []
     for i in range(len(trainingset.titles)):
         docwses.append(trainingset.doc_tokens(i))
-    features = scipy.sparse.hstack(
-        [
-            anchor.predict_topics(docwses),
-            anchor.encode(docwses)]).tocsr()
+    batch = DocBatch.from_tokens(docwses, anchor.vocabsize)
+    anchor.select_words(batch, knownresp)
+    features = anchor.features(batch)
     end = time.time()
     applytrain_time = datetime.timedelta(seconds=end-start)
     start = time.time()
@@ -597,17 +857,58 @@ def sklearn_classifier(anchor, trainingset, knownresp, classifier):
     return result, applytrain_time, train_time
 
 
+def _options(anchor, *names):
+    """The classifier options of anchor that are in names"""
+    return {name: anchor.classifier_options[name]
+            for name in names if name in anchor.classifier_options}
+
+
+def _logistic_builder(anchor, **kwargs):
+    """Returns function that makes LogisticRegression according to the
+    classifier options of anchor"""
+    kwargs.update(_options(anchor, 'n_jobs', 'solver', 'tol', 'max_iter'))
+    return functools.partial(LogisticRegression, **kwargs)
+
+
+def _svm_builder(anchor):
+    """Returns function that makes SVC (or LinearSVC, if the linear classifier
+    option is set) according to the classifier options of anchor"""
+    if anchor.classifier_options.get('linear'):
+        return functools.partial(LinearSVC, **_options(anchor,
+                                                       'tol',
+                                                       'max_iter'))
+    return functools.partial(SVC, **_options(anchor, 'tol', 'max_iter'))
+
+
+def _random_forest_builder(anchor):
+    """Returns function that makes RandomForestClassifier according to the
+    classifier options of anchor"""
+    return functools.partial(RandomForestClassifier,
+                             **_options(anchor, 'n_jobs'))
+
+
+def _sgd_builder(anchor, loss):
+    """Returns function that makes SGDClassifier according to the classifier
+    options of anchor"""
+    return functools.partial(SGDClassifier,
+                             loss=loss,
+                             **_options(anchor, 'n_jobs', 'tol', 'max_iter'))
+
+
 def logistic_regression(logisticanchor, trainingset, knownresp):
     """Builds trained LogisticRegression"""
     return sklearn_classifier(logisticanchor,
                               trainingset,
                               knownresp,
-                              LogisticRegression)
+                              _logistic_builder(logisticanchor))
 
 
 def svm(svmanchor, trainingset, knownresp):
-    """Builds trained SVC"""
-    return sklearn_classifier(svmanchor, trainingset, knownresp, SVC)
+    """Builds trained SVC (or LinearSVC)"""
+    return sklearn_classifier(svmanchor,
+                              trainingset,
+                              knownresp,
+                              _svm_builder(svmanchor))
 
 
 def random_forest(rfanchor, trainingset, knownresp):
@@ -615,7 +916,7 @@ def random_forest(rfanchor, trainingset, knownresp):
     return sklearn_classifier(rfanchor,
                               trainingset,
                               knownresp,
-                              RandomForestClassifier)
+                              _random_forest_builder(rfanchor))
 
 
 def naive_bayes(nbanchor, trainingset, knownresp):
@@ -631,10 +932,9 @@ def incremental_sklearn(anchor, trainingset, classifier):
     for title, label in trainingset.labels.items():
         docwses.append(trainingset.doc_tokens(trainingset.titlesorder[title]))
         knownresp.append(label)
-    features = scipy.sparse.hstack(
-        [
-            anchor.predict_topics(docwses),
-            anchor.encode(docwses)]).tocsr()
+    batch = DocBatch.from_tokens(docwses, anchor.vocabsize)
+    anchor.select_words(batch, knownresp)
+    features = anchor.features(batch)
     end = time.time()
     applytrain_time = datetime.timedelta(seconds=end-start)
     start = time.time()
@@ -645,23 +945,134 @@ def incremental_sklearn(anchor, trainingset, classifier):
     return result, applytrain_time, train_time
 
 
+def incremental_update_sklearn(anchor, trainingset, classifier, update,
+                               new_only=True):
+    """Builds classifier for partially labeled corpus by updating the one
+    trained in the previous round
+
+        * anchor :: AbstractIncrementalAnchor
+        * trainingset :: IncrementalSupervisedAnchorDataset
+        * classifier :: function() -> sklearn-style classifier
+            builds a classifier to train from scratch; used whenever
+            anchor.train recovers the topics again (the first round, every
+            anchor.full_refit_every rounds after that, whenever a new class
+            shows up, and whenever a document the classifier was trained on
+            gets relabeled)
+        * update :: function(classifier, features, labels)
+            updates the previous round's classifier
+        * new_only :: bool
+            if True, update only gets the documents labeled since the previous
+            round; otherwise, it gets all labeled documents
+    """
+    start = time.time()
+    # decided by anchor.train, which only recovers topics when this is True
+    refit = anchor.full_refit
+    titles = list(trainingset.labels)
+    if not refit and new_only:
+        # relabeled documents force a refit, so these are the documents
+        # labeled since the classifier was last trained
+        titles = [title for title in titles
+                  if title not in anchor.trained_labels]
+    docwses = []
+    knownresp = []
+    for title in titles:
+        docwses.append(trainingset.doc_tokens(trainingset.titlesorder[title]))
+        knownresp.append(trainingset.labels[title])
+    batch = DocBatch.from_tokens(docwses, anchor.vocabsize)
+    if refit:
+        # updates have to keep the words the classifier was trained on
+        anchor.select_words(batch, knownresp)
+    features = anchor.features(batch)
+    end = time.time()
+    applytrain_time = datetime.timedelta(seconds=end-start)
+    start = time.time()
+    if refit:
+        result = classifier()
+        result.fit(features, np.array(knownresp))
+        anchor.trained_labels = dict(zip(titles, knownresp))
+    else:
+        result = anchor.predictor
+        if titles:
+            update(result, features, np.array(knownresp))
+            anchor.trained_labels.update(zip(titles, knownresp))
+    anchor.rounds += 1
+    end = time.time()
+    train_time = datetime.timedelta(seconds=end-start)
+    return result, applytrain_time, train_time
+
+
+def _partial_fit(classifier, features, labels):
+    """Updates classifier with only the new documents"""
+    classifier.partial_fit(features, labels)
+
+
+def _refit(classifier, features, labels):
+    """Refits classifier (which should have warm_start set) on all documents
+    """
+    classifier.fit(features, labels)
+
+
+def incremental_sgd_logistic(anchor, trainingset):
+    """Builds logistic regression trained by SGD, updated with only newly
+    labeled documents"""
+    return incremental_update_sklearn(
+        anchor,
+        trainingset,
+        _sgd_builder(anchor, SGD_LOG_LOSS),
+        _partial_fit)
+
+
+def incremental_sgd_svm(anchor, trainingset):
+    """Builds linear SVM trained by SGD, updated with only newly labeled
+    documents"""
+    return incremental_update_sklearn(
+        anchor,
+        trainingset,
+        _sgd_builder(anchor, 'hinge'),
+        _partial_fit)
+
+
+def incremental_warm_logistic(anchor, trainingset):
+    """Builds LogisticRegression, refit each round starting from the previous
+    round's coefficients"""
+    return incremental_update_sklearn(
+        anchor,
+        trainingset,
+        _logistic_builder(anchor, warm_start=True),
+        _refit,
+        new_only=False)
+
+
+def incremental_accumulating_naive_bayes(anchor, trainingset):
+    """Builds MultinomialNB, adding only the counts of newly labeled documents
+    each round"""
+    return incremental_update_sklearn(anchor,
+                                      trainingset,
+                                      MultinomialNB,
+                                      _partial_fit)
+
+
 def incremental_logistic_regression(logisticanchor, trainingset):
     """Builds trained LogisticRegression for partially labeled corpus
 
         * logisticanchor :: IncrementalLogisticAnchor
         * trainingset :: IncrementalSupervisedAnchorDataset
     """
-    return incremental_sklearn(logisticanchor, trainingset, LogisticRegression)
+    return incremental_sklearn(logisticanchor,
+                               trainingset,
+                               _logistic_builder(logisticanchor))
 
 
 def incremental_svm(svmanchor, trainingset):
-    """Builds trained SVC for partially labeled corpus"""
-    return incremental_sklearn(svmanchor, trainingset, SVC)
+    """Builds trained SVC (or LinearSVC) for partially labeled corpus"""
+    return incremental_sklearn(svmanchor, trainingset, _svm_builder(svmanchor))
 
 
 def incremental_random_forest(rfanchor, trainingset):
     """Builds trained RandomForestClassifier for partially labeled corpus"""
-    return incremental_sklearn(rfanchor, trainingset, RandomForestClassifier)
+    return incremental_sklearn(rfanchor,
+                               trainingset,
+                               _random_forest_builder(rfanchor))
 
 
 def incremental_naive_bayes(nbanchor, trainingset):
@@ -676,8 +1087,12 @@ def incremental_free_classifier(freeclassifyinganchor, trainingset):
     return free_classifier(freeclassifyinganchor, trainingset, None)
 
 
-def incremental_tsvm(tsvmanchor, trainingset):
-    """Builds trained TSVM for partially labeled corpus"""
+def _incremental_transductive(anchor, trainingset, classifier):
+    """Builds trained transductive classifier for partially labeled corpus
+
+        * classifier :: function() -> TSVM-like
+            unlabeled documents are passed to its fit labeled 'unknown'
+    """
     start = time.time()
     docwses = []
     knownresp = []
@@ -686,22 +1101,39 @@ def incremental_tsvm(tsvmanchor, trainingset):
         knownresp.append(
             trainingset.labels[title]
             if title in trainingset.labels else 'unknown')
-    features = scipy.sparse.hstack(
-        [
-            tsvmanchor.predict_topics(docwses),
-            tsvmanchor.encode(docwses)]).tocsr()
+    batch = DocBatch.from_tokens(docwses, anchor.vocabsize)
+    features = anchor.features(batch)
     end = time.time()
     applytrain_time = datetime.timedelta(seconds=end-start)
     start = time.time()
-    result = classtm.classifier.TSVM(
-        tsvmanchor.lda.varname,
-        tsvmanchor.classorder)
+    result = classifier()
     result.fit(features, np.array(knownresp))
     end = time.time()
     train_time = datetime.timedelta(seconds=end-start)
     return result, applytrain_time, train_time
 
 
+def incremental_tsvm(tsvmanchor, trainingset):
+    """Builds trained TSVM for partially labeled corpus"""
+    return _incremental_transductive(
+        tsvmanchor,
+        trainingset,
+        lambda: classtm.classifier.TSVM(
+            tsvmanchor.lda.varname,
+            tsvmanchor.classorder,
+            tsvmanchor.classifier_options.get('n_jobs')))
+
+
+def incremental_linear_tsvm(tsvmanchor, trainingset):
+    """Builds trained LinearTSVM for partially labeled corpus"""
+    return _incremental_transductive(
+        tsvmanchor,
+        trainingset,
+        lambda: classtm.classifier.LinearTSVM(
+            tsvmanchor.classorder,
+            workers=tsvmanchor.classifier_options.get('n_jobs')))
+
+
 class LogisticAnchor(AbstractClassifyingAnchor):
     """Algorithm that produces a model for classification tasks
 
@@ -774,12 +1206,56 @@ class AbstractIncrementalAnchor(AbstractClassifyingAnchor):
             that only labeled data in the dataset will be used in training
     """
 
+    # for classifiers that get updated each round rather than trained from
+    # scratch, how many rounds go by between training from scratch anyway (0
+    # for never)
+    full_refit_every = 0
+    # whether the predictor gets updated from round to round (see
+    # incremental_update_sklearn) rather than trained from scratch; if so, the
+    # topics are only recovered again when it is trained from scratch, so
+    # that the topic features it was trained on keep their meaning
+    updates_predictor = False
+    # whether the current round trains the predictor from scratch
+    full_refit = True
+
     def __init__(self, rng, numtopics, expgrad_epsilon, classifier):
         super(AbstractIncrementalAnchor, self).__init__(rng,
                                                         numtopics,
                                                         expgrad_epsilon,
                                                         None,
                                                         classifier)
+        # number of times train has been called
+        self.rounds = 0
+        # {title: label} of the documents the current predictor has been
+        # trained on
+        self.trained_labels = {}
+
+    def configure(self, settings):
+        """Reads options that are not model parameters from settings
+
+            * settings :: {str: str}
+                'full_refit_every' is optional, along with the options read by
+                AbstractClassifyingAnchor.configure
+        """
+        super(AbstractIncrementalAnchor, self).configure(settings)
+        if 'full_refit_every' in settings:
+            self.full_refit_every = int(settings['full_refit_every'])
+
+    def _full_refit_due(self, dataset):
+        """Whether the predictor gets trained from scratch this round"""
+        if not self.updates_predictor or self.predictor is None:
+            return True
+        if self.full_refit_every > 0 and \
+                self.rounds % self.full_refit_every == 0:
+            return True
+        # partial_fit cannot take on classes the predictor has not seen, and
+        # new classes need anchors of their own anyway
+        if not set(dataset.classorder) <= set(self.predictor.classes_):
+            return True
+        # updates cannot take back what a relabeled document contributed
+        # under its old label
+        return any(dataset.labels[title] != label
+                   for title, label in self.trained_labels.items())
 
     def train(self, dataset, varname, lda_helper, anchors_file):
         """Train model
@@ -795,6 +1271,7 @@ class AbstractIncrementalAnchor(AbstractClassifyingAnchor):
                 name of the file containing the anchors this model should use
                 or None if gram-schmidt anchors should be used
         """
+        self._scorer = None
         if isinstance(dataset, classtm.labeled.ClassifiedDataset):
             self.corpus_to_train_vocab = list(
                 range(len(dataset.origvocabsize)))
@@ -803,37 +1280,47 @@ class AbstractIncrementalAnchor(AbstractClassifyingAnchor):
         trainingset = dataset
         self.vocabsize = trainingset.vocab_size
         self.classorder = trainingset.classorder
-        pdim = 1000 \
-            if trainingset.vocab_size > 1000 else trainingset.vocab_size
-        start = time.time()
-        if anchors_file is None:
-            # assumes that trainingset.Q has
-            # len(self.corpus_to_train_vocab)+len(self.classorder) columns
-            self.anchors = \
-                ankura.anchor.gramschmidt_anchors(
-                    trainingset,
-                    self.numtopics,
-                    id_cands_maker(len(self.classorder),
-                                   0.015 * len(trainingset.titles)),
-                    project_dim=pdim)
+        # Q only gets built when the topics are recovered, but the predictor
+        # needs the labels of documents labeled since the last round either way
+        trainingset.record_new_labels()
+        self.full_refit = self._full_refit_due(trainingset)
+        if not self.full_refit:
+            # the predictor gets updated against the same topics as before, so
+            # Q is left as it is until the next full refit
+            anchorwords_time = datetime.timedelta(0)
         else:
-            # pull user-made anchors from a JSON file of anchors
-            user_file = json.load(open(anchors_file, 'r'))
-            # we only want the last group of anchors that were chosen
-            user_anchors = user_file[len(user_file)-1]['anchors']
-            self.anchors = ankura.anchor.multiword_anchors(trainingset,
-                                                           user_anchors)
-            # numtopics is determined at runtime when using user anchors
-            self.numtopics = len(self.anchors)
-        # relying on fact that recover_topics goes through all rows of Q, the
-        # cooccurrence matrix in trainingset
-        # self.topics has shape (vocabsize, numtopics)
-        self.topics = ankura.topic.recover_topics(trainingset,
-                                                  self.anchors,
-                                                  self.expgrad_epsilon)
-        end = time.time()
-        anchorwords_time = datetime.timedelta(seconds=end-start)
-        self.lda = lda_helper(self.topics, varname)
+            pdim = 1000 \
+                if trainingset.vocab_size > 1000 else trainingset.vocab_size
+            start = time.time()
+            if anchors_file is None:
+                # assumes that trainingset.Q has
+                # len(self.corpus_to_train_vocab)+len(self.classorder) columns
+                self.anchors = \
+                    ankura.anchor.gramschmidt_anchors(
+                        trainingset,
+                        self.numtopics,
+                        id_cands_maker(len(self.classorder),
+                                       0.015 * len(trainingset.titles)),
+                        project_dim=pdim)
+            else:
+                # pull user-made anchors from a JSON file of anchors
+                user_file = json.load(open(anchors_file, 'r'))
+                # we only want the last group of anchors that were chosen
+                user_anchors = user_file[len(user_file)-1]['anchors']
+                self.anchors = ankura.anchor.multiword_anchors(trainingset,
+                                                               user_anchors)
+                # numtopics is determined at runtime when using user anchors
+                self.numtopics = len(self.anchors)
+            # relying on fact that recover_topics goes through all rows of Q,
+            # the cooccurrence matrix in trainingset
+            # self.topics has shape (vocabsize, numtopics)
+            self.topics = ankura.topic.recover_topics(
+                trainingset,
+                self.anchors,
+                self.expgrad_epsilon).astype(self.dtype, copy=False)
+            end = time.time()
+            anchorwords_time = datetime.timedelta(seconds=end-start)
+            self.lda = lda_helper(self.topics, varname)
         self.predictor, applytrain_time, train_time = \
             self.classifier(self, trainingset)
         return anchorwords_time, applytrain_time, train_time
@@ -890,6 +1377,72 @@ class IncrementalTSVMAnchor(AbstractIncrementalAnchor):
                                                     incremental_tsvm)
 
 
+class IncrementalLinearTSVMAnchor(AbstractIncrementalAnchor):
+    """Incrementally labeled corpus with in-process transductive linear SVM"""
+
+    def __init__(self, rng, numtopics, expgrad_epsilon):
+        super(IncrementalLinearTSVMAnchor, self).__init__(
+            rng,
+            numtopics,
+            expgrad_epsilon,
+            incremental_linear_tsvm)
+
+
+class IncrementalSGDLogisticAnchor(AbstractIncrementalAnchor):
+    """LogisticAnchor with incrementally labeled corpus, trained by SGD on
+    only the newly labeled documents each round"""
+
+    updates_predictor = True
+
+    def __init__(self, rng, numtopics, expgrad_epsilon):
+        super(IncrementalSGDLogisticAnchor, self).__init__(
+            rng,
+            numtopics,
+            expgrad_epsilon,
+            incremental_sgd_logistic)
+
+
+class IncrementalSGDSVMAnchor(AbstractIncrementalAnchor):
+    """SVMAnchor (linear) with incrementally labeled corpus, trained by SGD on
+    only the newly labeled documents each round"""
+
+    updates_predictor = True
+
+    def __init__(self, rng, numtopics, expgrad_epsilon):
+        super(IncrementalSGDSVMAnchor, self).__init__(rng,
+                                                      numtopics,
+                                                      expgrad_epsilon,
+                                                      incremental_sgd_svm)
+
+
+class IncrementalWarmLogisticAnchor(AbstractIncrementalAnchor):
+    """LogisticAnchor with incrementally labeled corpus, warm started from the
+    previous round's coefficients"""
+
+    updates_predictor = True
+
+    def __init__(self, rng, numtopics, expgrad_epsilon):
+        super(IncrementalWarmLogisticAnchor, self).__init__(
+            rng,
+            numtopics,
+            expgrad_epsilon,
+            incremental_warm_logistic)
+
+
+class IncrementalAccumulatingNBAnchor(AbstractIncrementalAnchor):
+    """NBAnchor with incrementally labeled corpus, adding only the counts of
+    the newly labeled documents each round"""
+
+    updates_predictor = True
+
+    def __init__(self, rng, numtopics, expgrad_epsilon):
+        super(IncrementalAccumulatingNBAnchor, self).__init__(
+            rng,
+            numtopics,
+            expgrad_epsilon,
+            incremental_accumulating_naive_bayes)
+
+
 class IncrementalFreeClassifyingAnchor(AbstractIncrementalAnchor):
     """FreeClassifyingAnchor with incrementally labeled corpus"""
 
@@ -902,23 +1455,9 @@ class IncrementalFreeClassifyingAnchor(AbstractIncrementalAnchor):
 
     def predict(self, tokenses):
         """Predict labels"""
-        docwses = []
-        data = []
-        indices = []
-        indptr = [0]
-        for tokens in tokenses:
-            real_vocab = self._convert_vocab_space(tokens)
-            docwses.append(real_vocab)
-            tmp = count_tokens(real_vocab)
-            for token, count in sorted(tmp.items()):
-                data.append(count)
-                indices.append(token)
-            indptr.append(len(data))
-        features = self.predict_topics(docwses)
-        doc_words = scipy.sparse.csc_matrix(
-            (data, indices, indptr),
-            shape=(self.vocabsize-len(self.classorder), len(tokenses)))
-        return self.predictor.predict(features, doc_words.tocsc())
+        batch = self._convert_vocab_space(tokenses)
+        features = self.predict_topics(batch)
+        return self.predictor.predict(features, batch)
 
 
 FACTORY = {'logistic': LogisticAnchor,
@@ -962,6 +1501,27 @@ INCFACTORY = {'inclog': [IncrementalLogisticAnchor,
                           classtm.labeled.IncrementalSupervisedAnchorDataset],
               'inctsvmnormed': [IncrementalTSVMAnchor,
                   classtm.labeled.IncrementalSupervisedNormalizedAnchorDataset],
+              'inclineartsvm': [
+                  IncrementalLinearTSVMAnchor,
+                  classtm.labeled.IncrementalSupervisedAnchorDataset],
+              'inclineartsvmnormed': [IncrementalLinearTSVMAnchor,
+                  classtm.labeled.IncrementalSupervisedNormalizedAnchorDataset],
+              'incsgdlog': [IncrementalSGDLogisticAnchor,
+                            classtm.labeled.IncrementalSupervisedAnchorDataset],
+              'incsgdlognormed': [IncrementalSGDLogisticAnchor,
+                  classtm.labeled.IncrementalSupervisedNormalizedAnchorDataset],
+              'incsgdsvm': [IncrementalSGDSVMAnchor,
+                            classtm.labeled.IncrementalSupervisedAnchorDataset],
+              'incsgdsvmnormed': [IncrementalSGDSVMAnchor,
+                  classtm.labeled.IncrementalSupervisedNormalizedAnchorDataset],
+              'incwarmlog': [IncrementalWarmLogisticAnchor,
+                             classtm.labeled.IncrementalSupervisedAnchorDataset],
+              'incwarmlognormed': [IncrementalWarmLogisticAnchor,
+                  classtm.labeled.IncrementalSupervisedNormalizedAnchorDataset],
+              'incaccnb': [IncrementalAccumulatingNBAnchor,
+                           classtm.labeled.IncrementalSupervisedAnchorDataset],
+              'incaccnbnormed': [IncrementalAccumulatingNBAnchor,
+                  classtm.labeled.IncrementalSupervisedNormalizedAnchorDataset],
               }
 
 
@@ -972,14 +1532,17 @@ def build(rng, settings):
     if settings['model'] == 'free':
         smoothing = float(settings['smoothing'])
         label_weight = settings['label_weight']
-        return FACTORY[settings['model']](rng,
-                                          numtopics,
-                                          expgrad_epsilon,
-                                          smoothing,
-                                          label_weight)
-    return FACTORY[settings['model']](rng,
-                                      numtopics,
-                                      expgrad_epsilon)
+        result = FACTORY[settings['model']](rng,
+                                            numtopics,
+                                            expgrad_epsilon,
+                                            smoothing,
+                                            label_weight)
+    else:
+        result = FACTORY[settings['model']](rng,
+                                            numtopics,
+                                            expgrad_epsilon)
+    result.configure(settings)
+    return result
 
 
 def initialize(rng, dataset, settings):
@@ -987,5 +1550,6 @@ def initialize(rng, dataset, settings):
     numtopics = int(settings['numtopics'])
     expgrad_epsilon = float(settings['expgrad_epsilon'])
     modeltype, datasettype = INCFACTORY[settings['model']]
-    return modeltype(rng, numtopics, expgrad_epsilon),\
-        datasettype(dataset, settings)
+    model = modeltype(rng, numtopics, expgrad_epsilon)
+    model.configure(settings)
+    return model, datasettype(dataset, settings)
@@ -0,0 +1,63 @@
+"""Keeping pickled datasets and models small
+
+Datasets and models hold caches (Q, tokens, scorers, and the like) that can be
+rebuilt from the rest of their state; their __getstate__ leaves those out.
+pickled_sizes and check_pickled_size help find whatever else makes a pickle
+big
+"""
+import pickle
+import sys
+
+
+# pickles bigger than this (in bytes) get their attributes reported by
+# check_pickled_size
+PICKLE_SIZE_LIMIT = 64 * 2**20
+
+
+def drop_caches(state, caches):
+    """Returns a copy of state (an object's __dict__) in which the attributes
+    named in caches are None"""
+    state = dict(state)
+    for name in caches:
+        if name in state:
+            state[name] = None
+    return state
+
+
+def _state(obj):
+    """What pickle stores of obj"""
+    if hasattr(obj, '__getstate__'):
+        state = obj.__getstate__()
+        if state is not None:
+            return state
+    return vars(obj)
+
+
+def pickled_sizes(obj):
+    """Gets [(attribute name, bytes)] of the pickled state of obj, largest
+    first
+
+    Each attribute is pickled on its own, so objects shared by several
+    attributes are counted once for each of them
+    """
+    sizes = [(name, len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+             for name, value in _state(obj).items()]
+    return sorted(sizes, key=lambda size: size[1], reverse=True)
+
+
+def check_pickled_size(obj, name, limit=PICKLE_SIZE_LIMIT, out=sys.stderr):
+    """Reports the pickled size of each attribute of obj to out if obj pickles
+    to more than limit bytes
+
+        * name :: str
+            what to call obj in the report
+    Returns the pickled size of obj
+    """
+    total = len(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+    if total > limit:
+        out.write('# {:s} pickles to {:.1f} MB:\n'.format(name,
+                                                          total / 2**20))
+        for attribute, size in pickled_sizes(obj):
+            out.write('#\t{:s}: {:.1f} MB\n'.format(attribute, size / 2**20))
+        out.flush()
+    return total
@@ -0,0 +1,986 @@
+"""Scoring with trained ClassTM models
+
+Everything here needs only numpy and scipy, so that a model written by
+AbstractClassifyingAnchor.export can be loaded and used for prediction without
+importing the training code (ankura, activetm, and scikit-learn)
+"""
+from concurrent.futures import ThreadPoolExecutor
+import ctypes
+import json
+import os
+import pickle
+import subprocess
+import tempfile
+import threading
+
+import numpy as np
+import scipy.sparse
+import scipy.special
+
+
+# number of instances free classifiers score at a time
+FREE_CHUNK_SIZE = 4096
+# bumped whenever the layout of export directories changes
+EXPORT_VERSION = 2
+# name of the file in an export directory that describes the model
+EXPORT_META = 'model.json'
+# name root of the lda-c model files in an export directory
+EXPORT_LDAC_MODEL = 'lda'
+# name of the directory in an export directory that holds SVMLight models
+EXPORT_SVMLIGHT_DIR = 'svmlight'
+LDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ldac')
+LDAC_EXE = os.path.join(LDA_DIR, 'lda')
+# these are the settings that Nguyen et al. used
+LDAC_SETTINGS = os.path.join(LDA_DIR, 'inf-settings.txt')
+# Nguyen et al. use an alpha of 0.1:
+# anchor_python/scripts/create_other_ldac.py
+LDAC_ALPHA = 0.1
+# lda-c's inference routine as a shared library, for VariationalInference
+LDAC_LIB = os.path.join(LDA_DIR, 'liblda.so')
+# where per-call scratch files go: tmpfs if there is one, so that they never
+# touch a disk (None means the default temporary directory)
+SCRATCH_ROOT = '/dev/shm' if os.access('/dev/shm', os.W_OK) else None
+# settings of the scikit-learn LatentDirichletAllocation that OnlineHelper
+# uses (they are its defaults)
+ONLINE_MAX_DOC_UPDATE_ITER = 100
+ONLINE_MEAN_CHANGE_TOL = 1e-3
+
+
+class DocBatch(object):
+    """Batch of documents held in arrays instead of lists of tokens
+
+        * counts :: scipy.sparse.csr_matrix
+            shape is (number of documents, vocab size); the column indices of
+            each row are the (sorted) word ids of a document and the data are
+            their counts
+        * lengths :: 1D np.array
+            number of tokens in each document
+        * order :: 1D np.array
+            index of each document in the batch it was originally taken from
+    """
+
+    def __init__(self, counts, lengths, order):
+        self.counts = counts
+        self.lengths = lengths
+        self.order = order
+
+    @classmethod
+    def from_tokens(cls, tokenses, vocab_size, lookup=None):
+        """Builds a DocBatch from token ids
+
+            * tokenses :: [[int]]
+                the first dimension separates documents; the second dimension
+                separates tokens (each document may also be a 1D np.array)
+            * vocab_size :: int
+            * lookup :: 1D np.array
+                if given, token t is replaced by lookup[t], and dropped if
+                lookup[t] is negative
+        """
+        doc_lengths = np.fromiter((len(tokens) for tokens in tokenses),
+                                  dtype=np.int64,
+                                  count=len(tokenses))
+        tokens = np.concatenate(
+            [np.zeros(0, dtype=np.int64)] +
+            [np.asarray(tokens, dtype=np.int64) for tokens in tokenses])
+        rows = np.repeat(np.arange(len(tokenses)), doc_lengths)
+        if lookup is not None:
+            tokens = lookup[tokens]
+            keep = tokens >= 0
+            tokens = tokens[keep]
+            rows = rows[keep]
+        # duplicate entries get summed when converting to CSR
+        counts = scipy.sparse.csr_matrix(
+            (np.ones(len(tokens)), (rows, tokens)),
+            shape=(len(tokenses), vocab_size))
+        counts.sum_duplicates()
+        return cls(counts,
+                   np.bincount(rows, minlength=len(tokenses)),
+                   np.arange(len(tokenses)))
+
+    def __len__(self):
+        return self.counts.shape[0]
+
+    def doc_tokens(self, i):
+        """Returns token ids of document i (in word id order)"""
+        start, stop = self.counts.indptr[i], self.counts.indptr[i+1]
+        return np.repeat(self.counts.indices[start:stop],
+                         self.counts.data[start:stop].astype(np.int64))
+
+    def subset(self, rows):
+        """Returns DocBatch of the documents in rows (an index array or mask)
+        """
+        return DocBatch(self.counts[rows],
+                        self.lengths[rows],
+                        self.order[rows])
+
+    def unique(self):
+        """Returns DocBatch of the distinct documents in this batch, along with
+        the row of that DocBatch that each document in this batch matches
+
+        Documents are grouped by a hash of their rows, and each document is
+        then checked against the first document of its group, so a hash
+        collision costs time (an exact, slower pass) but never a wrong match
+        """
+        counts = self.counts
+        lengths = np.diff(counts.indptr)
+        # rows are in canonical form (sorted, no duplicate word ids), so
+        # summing the hashes of their entries hashes equal documents equally
+        entry_hashes = _mix64(
+            counts.indices.astype(np.uint64) * np.uint64(0x9e3779b97f4a7c15) +
+            np.ascontiguousarray(counts.data, dtype=np.float64).view(
+                np.uint64))
+        sums = np.zeros(len(entry_hashes) + 1, dtype=np.uint64)
+        np.cumsum(entry_hashes, out=sums[1:])
+        row_hashes = (sums[counts.indptr[1:]] - sums[counts.indptr[:-1]]) ^ \
+            _mix64(lengths.astype(np.uint64))
+        _, firsts, groups = np.unique(row_hashes,
+                                      return_index=True,
+                                      return_inverse=True)
+        groups = groups.ravel()
+        # number groups in order of first appearance
+        by_appearance = np.argsort(firsts, kind='stable')
+        rank = np.empty(len(firsts), dtype=np.int64)
+        rank[by_appearance] = np.arange(len(firsts))
+        keep = firsts[by_appearance]
+        inverse = rank[groups]
+        if not self._rows_match(keep[inverse]):
+            keep, inverse = self._unique_exact()
+        return self.subset(keep), inverse
+
+    def _rows_match(self, matches):
+        """Whether each document is the same as document matches[i]"""
+        counts = self.counts
+        lengths = np.diff(counts.indptr)
+        if np.any(lengths != lengths[matches]):
+            return False
+        # compare every entry with the same entry of the matching row
+        entry_rows = np.repeat(np.arange(len(self)), lengths)
+        positions = counts.indptr[matches][entry_rows] + \
+            (np.arange(len(entry_rows)) - counts.indptr[entry_rows])
+        return np.array_equal(counts.indices, counts.indices[positions]) and \
+            np.array_equal(counts.data, counts.data[positions])
+
+    def _unique_exact(self):
+        """Same as unique, but without hashing: returns (rows to keep,
+        inverse)"""
+        firsts = {}
+        keep = []
+        inverse = np.empty(len(self), dtype=np.int64)
+        counts = self.counts
+        for i in range(len(self)):
+            start, stop = counts.indptr[i], counts.indptr[i+1]
+            key = (counts.indices[start:stop].tobytes(),
+                   counts.data[start:stop].tobytes())
+            if key not in firsts:
+                firsts[key] = len(keep)
+                keep.append(i)
+            inverse[i] = firsts[key]
+        return np.array(keep, dtype=np.int64), inverse
+
+
+def _mix64(values):
+    """Scrambles the bits of each of values (a np.uint64 array), as
+    splitmix64 does"""
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xbf58476d1ce4e5b9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94d049bb133111eb)
+    return values ^ (values >> np.uint64(31))
+
+
+def build_features(topic_mixes, batch, dtype=np.float64):
+    """Builds the feature matrix of topic mixtures followed by word counts
+
+        * topic_mixes :: 2D np.array
+            has shape (number of documents, topic count)
+        * batch :: DocBatch
+        * dtype :: np.dtype
+    Returns scipy.sparse.csr_matrix of shape (number of documents, topic count
+    + vocab size), written directly rather than by stacking two matrices
+    """
+    num_docs, numtopics = topic_mixes.shape
+    counts = batch.counts
+    topic_rows, topic_cols = np.nonzero(topic_mixes)
+    topic_nnz = np.bincount(topic_rows, minlength=num_docs)
+    word_nnz = np.diff(counts.indptr)
+    indptr = np.zeros(num_docs + 1, dtype=np.int64)
+    np.cumsum(topic_nnz + word_nnz, out=indptr[1:])
+    data = np.empty(indptr[-1], dtype=dtype)
+    indices = np.empty(indptr[-1], dtype=np.int32)
+    # in each row, the topic entries come first...
+    topic_starts = np.cumsum(topic_nnz) - topic_nnz
+    topic_pos = indptr[topic_rows] + \
+        np.arange(len(topic_rows)) - topic_starts[topic_rows]
+    data[topic_pos] = topic_mixes[topic_rows, topic_cols]
+    indices[topic_pos] = topic_cols
+    # ...followed by the word count entries
+    word_rows = np.repeat(np.arange(num_docs), word_nnz)
+    word_pos = indptr[word_rows] + topic_nnz[word_rows] + \
+        np.arange(counts.nnz) - counts.indptr[word_rows]
+    data[word_pos] = counts.data
+    indices[word_pos] = counts.indices + numtopics
+    return scipy.sparse.csr_matrix(
+        (data, indices, indptr),
+        shape=(num_docs, numtopics + counts.shape[1]))
+
+
+def scratch_dir():
+    """Makes a private directory for the files of one call to an external
+    program (lda-c or SVMLight), so that concurrent calls do not overwrite
+    each other's files
+
+    Returns a tempfile.TemporaryDirectory, to be used as a context manager
+    """
+    return tempfile.TemporaryDirectory(prefix='classtm-', dir=SCRATCH_ROOT)
+
+
+def write_ldac_model(topics, model_root):
+    """Writes topics as the lda-c model files model_root.beta and
+    model_root.other
+
+        * topics :: 2D np.array
+            should have shape (vocab size, number of topics)
+    """
+    # .beta file has shape (topics, vocab)
+    topicscopy = topics.T.copy()
+    # lda-c stores topics in log space
+    topicscopy += 0.1e-100
+    # pylint:disable=no-member
+    topicscopy = np.log(topicscopy)
+    np.savetxt(model_root+'.beta', topicscopy, fmt='%5.10f')
+    with open(model_root+'.other', 'w') as ofh:
+        ofh.write('num_topics '+str(topicscopy.shape[0])+'\n')
+        ofh.write('num_terms '+str(topicscopy.shape[1])+'\n')
+        ofh.write('alpha '+str(LDAC_ALPHA)+'\n')
+
+
+def ldac_topic_mixes(model_root, batch, dtype):
+    """Call on lda-c to get gammas
+
+        * model_root :: str
+            name root of the model files written by write_ldac_model
+        * batch :: DocBatch
+        * dtype :: np.dtype
+    Assuming that all documents in batch are non-empty
+
+    Safe to call concurrently: the documents and gammas of each call go in a
+    scratch directory of their own
+    """
+    counts = batch.counts
+    # lda-c runs in the directory of the model files, so that only their name
+    # root counts towards its limit on the length of file names
+    model_dir, model_name = os.path.split(os.path.abspath(model_root))
+    with scratch_dir() as scratch:
+        datafile = os.path.join(scratch, 'words.txt')
+        output = os.path.join(scratch, 'out')
+        with open(datafile, 'w') as ofh:
+            for i in range(len(batch)):
+                start, stop = counts.indptr[i], counts.indptr[i+1]
+                line = [str(stop - start)]
+                for token, count in zip(counts.indices[start:stop],
+                                        counts.data[start:stop]):
+                    line.append('%d:%d' % (token, count))
+                ofh.write(' '.join(line)+'\n')
+        subprocess.run(
+            [
+                LDAC_EXE,
+                'inf',
+                LDAC_SETTINGS,
+                model_name,
+                datafile,
+                output],
+            cwd=model_dir)
+        # ndmin, so that a single document still gets a row
+        return np.loadtxt(output+'-gamma.dat', dtype=dtype, ndmin=2)
+
+
+def sampled_topic_mixes(topics, batch, numsamples):
+    """Call ankura to get topic mixtures for all the documents
+
+        * topics :: 2D np.array
+            should have shape (vocab size, number of topics)
+        * batch :: DocBatch
+        * numsamples :: int
+            number of samples averaged for each document
+    Assumes that all documents in batch are non-empty
+    """
+    topic_mixes = np.zeros((len(batch), topics.shape[1]), dtype=topics.dtype)
+    for i in range(len(batch)):
+        _sampled_doc_topics(topics, batch.doc_tokens(i), numsamples,
+                            topic_mixes[i])
+    return topic_mixes
+
+
+def _sampled_doc_topics(topics, docws, numsamples, out):
+    """Averages the topic assignment counts of numsamples runs of ankura's
+    sampler on the tokens docws into out"""
+    # the only inference here that is not done with numpy, scipy, or lda-c
+    import ankura.topic
+    result = np.zeros(topics.shape[1])
+    for _ in range(numsamples):
+        counts, _ = ankura.topic.predict_topics(topics, docws)
+        result += counts
+    result /= (len(docws) * numsamples)
+    out[:] = result
+    return out
+
+
+class LdacInference(object):
+    """Topic mixtures from lda-c, as VariationalHelper gets them"""
+
+    def __init__(self, model_root, dtype):
+        """
+            * model_root :: str
+                name root of the model files written by write_ldac_model
+            * dtype :: np.dtype
+        """
+        self.model_root = model_root
+        self.dtype = dtype
+
+    def predict_topics(self, batch):
+        """Topic mixtures of batch (assumed to have no empty documents)"""
+        return ldac_topic_mixes(self.model_root, batch, self.dtype)
+
+
+class SamplingInference(object):
+    """Topic mixtures from ankura's sampler, as SamplingHelper gets them"""
+
+    def __init__(self, topics, numsamples):
+        """
+            * topics :: 2D np.array
+                should have shape (vocab size, number of topics)
+            * numsamples :: int
+                number of samples averaged for each document
+        """
+        self.topics = topics
+        self.numsamples = numsamples
+
+    def doc_topics(self, ids, counts, out):
+        """Computes the topic mixture of one non-empty document (see
+        OnlineInference.doc_topics)"""
+        return _sampled_doc_topics(
+            self.topics,
+            np.repeat(ids, np.asarray(counts).astype(np.int64)),
+            self.numsamples,
+            out)
+
+    def predict_topics(self, batch):
+        """Topic mixtures of batch (assumed to have no empty documents)"""
+        return sampled_topic_mixes(self.topics, batch, self.numsamples)
+
+
+def predict_parallel(predict, tokenses, workers):
+    """Predicts labels of tokenses on a pool of threads
+
+        * predict :: function([[int]]) -> 1D np.array
+            a model's predict, which must be safe to call concurrently
+        * tokenses :: [[int]]
+            documents as token ids in corpus space
+        * workers :: int
+            number of threads; tokenses gets split into this many contiguous
+            pieces
+    Returns the predictions, in the order of tokenses
+    """
+    workers = min(workers, len(tokenses))
+    if workers <= 1:
+        return np.asarray(predict(tokenses))
+    bounds = np.linspace(0, len(tokenses), workers + 1).astype(np.int64)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pieces = list(executor.map(
+            predict,
+            [tokenses[start:stop]
+             for start, stop in zip(bounds[:-1], bounds[1:])]))
+    return np.concatenate([np.asarray(piece) for piece in pieces])
+
+
+def infer_topic_mixes(predict_topics, batch, numtopics, dtype):
+    """Predict topic mixtures for batch
+
+        * predict_topics :: function(DocBatch) -> 2D np.array
+            infers topic mixtures of non-empty documents
+        * batch :: DocBatch
+        * numtopics :: int
+        * dtype :: np.dtype
+    Topic mixtures only get inferred once for each distinct non-empty
+    document; empty documents get the uniform mixture
+
+    Returns the topic mixtures, along with the number of documents that were
+    skipped because they were duplicates of other documents in batch
+    """
+    result = np.full((len(batch), numtopics), 1.0/numtopics, dtype=dtype)
+    nonempty = np.flatnonzero(batch.lengths > 0)
+    unique, inverse = batch.subset(nonempty).unique()
+    if len(unique) > 0:
+        topic_mixes = predict_topics(unique)
+        result[nonempty] = topic_mixes[inverse]
+    return result, len(nonempty) - len(unique)
+
+
+def free_decision_function(features, batch, weights, class_given_word,
+                           chunk_size):
+    """Score each class for each instance in features, as FreeClassifier does
+
+        * features :: 2D np.array
+            has shape (number of instances, topic count)
+        * batch :: DocBatch
+            the documents features were computed for; word ids past the end of
+            class_given_word (i.e., label pseudo-words) are ignored
+        * weights :: 2D np.array
+            column normalized class topic weights
+        * class_given_word :: scipy.sparse.csr_matrix
+            has shape (number of classes, vocab size)
+        * chunk_size :: int
+            number of instances scored at a time
+    See FreeClassifier.decision_function for what the scores are
+    """
+    num_words = class_given_word.shape[1]
+    class_given_word_t = class_given_word.T.tocsc()
+    result = np.empty((features.shape[0], weights.shape[0]),
+                      dtype=np.result_type(features, weights))
+    for start in range(0, features.shape[0], chunk_size):
+        stop = min(start + chunk_size, features.shape[0])
+        score = result[start:stop]
+        np.dot(features[start:stop], weights.T, out=score)
+        score /= score.sum(axis=1, keepdims=True)
+        doc_words = batch.counts[start:stop, :num_words]
+        word_score = (doc_words * class_given_word_t).toarray()
+        word_score_sum = word_score.sum(axis=1, keepdims=True)
+        # wherever sums are 0, make no-op division
+        word_score_sum[word_score_sum == 0] = 1
+        score += word_score / word_score_sum
+    return result
+
+
+def _dirichlet_expectation(alpha):
+    """exp(E[log theta]) for theta ~ Dirichlet(alpha), along the last axis"""
+    return np.exp(scipy.special.psi(alpha) -
+                  scipy.special.psi(alpha.sum(axis=-1, keepdims=True)))
+
+
+class OnlineInference(object):
+    """Gets topic mixtures the way OnlineHelper does, but with numpy alone
+
+    This is the E step of scikit-learn's online variational Bayes, with the
+    mixtures normalized as LatentDirichletAllocation.transform does
+    """
+
+    def __init__(self, topic_word, dtype):
+        """
+            * topic_word :: 2D np.array
+                exp(E[log beta]) of the topics, with shape (number of topics,
+                vocab size); i.e., exp_dirichlet_component_ of the
+                LatentDirichletAllocation
+            * dtype :: np.dtype
+                dtype of the topic mixtures
+        """
+        self.topic_word = topic_word
+        self.dtype = dtype
+        self.doc_topic_prior = 1.0 / topic_word.shape[0]
+
+    def doc_topics(self, ids, counts, out):
+        """Computes the topic mixture of one non-empty document
+
+            * ids :: 1D np.array
+                distinct word ids of the document
+            * counts :: 1D np.array
+                number of times each word in ids occurs in the document
+            * out :: 1D np.array
+                gets the topic mixture (float64)
+        """
+        eps = np.finfo(np.float64).eps
+        topic_word = np.asarray(self.topic_word[:, ids], dtype=np.float64)
+        doc_topic = np.ones(self.topic_word.shape[0])
+        exp_doc_topic = _dirichlet_expectation(doc_topic)
+        for _ in range(ONLINE_MAX_DOC_UPDATE_ITER):
+            last = doc_topic
+            norm_phi = exp_doc_topic.dot(topic_word) + eps
+            doc_topic = exp_doc_topic * \
+                (counts / norm_phi).dot(topic_word.T) + \
+                self.doc_topic_prior
+            exp_doc_topic = _dirichlet_expectation(doc_topic)
+            if np.mean(np.abs(last - doc_topic)) < ONLINE_MEAN_CHANGE_TOL:
+                break
+        np.divide(doc_topic, doc_topic.sum(), out=out)
+        return out
+
+    def predict_topics(self, batch):
+        """Compute topic mixtures
+
+            * batch :: DocBatch
+        Assumes that all documents in batch are non-empty
+        """
+        counts = batch.counts
+        result = np.empty((len(batch), self.topic_word.shape[0]))
+        for i in range(len(batch)):
+            start, stop = counts.indptr[i], counts.indptr[i+1]
+            self.doc_topics(counts.indices[start:stop],
+                            counts.data[start:stop],
+                            result[i])
+        return result.astype(self.dtype, copy=False)
+
+
+class _LdacDocument(ctypes.Structure):
+    """lda-c's document"""
+    _fields_ = [('words', ctypes.POINTER(ctypes.c_int)),
+                ('counts', ctypes.POINTER(ctypes.c_int)),
+                ('length', ctypes.c_int),
+                ('total', ctypes.c_int)]
+
+
+class _LdacModel(ctypes.Structure):
+    """lda-c's lda_model"""
+    _fields_ = [('alpha', ctypes.c_double),
+                ('log_prob_w', ctypes.POINTER(ctypes.POINTER(ctypes.c_double))),
+                ('num_topics', ctypes.c_int),
+                ('num_terms', ctypes.c_int)]
+
+
+# LDAC_LIB, once loaded by _ldac_lib
+_LDAC_LIB = None
+
+
+def _ldac_lib():
+    """Loads LDAC_LIB, set up as lda-c inf sets itself up from LDAC_SETTINGS
+    """
+    global _LDAC_LIB
+    if _LDAC_LIB is None:
+        lib = ctypes.CDLL(LDAC_LIB)
+        lib.lda_inference.restype = ctypes.c_double
+        lib.lda_inference.argtypes = [
+            ctypes.POINTER(_LdacDocument),
+            ctypes.POINTER(_LdacModel),
+            ctypes.POINTER(ctypes.c_double),
+            ctypes.POINTER(ctypes.POINTER(ctypes.c_double))]
+        with open(LDAC_SETTINGS) as ifh:
+            settings = ifh.read().splitlines()
+        ctypes.c_int.in_dll(lib, 'VAR_MAX_ITER').value = \
+            int(settings[0].split()[-1])
+        ctypes.c_float.in_dll(lib, 'VAR_CONVERGED').value = \
+            float(settings[1].split()[-1])
+        _LDAC_LIB = lib
+    return _LDAC_LIB
+
+
+def _row_pointers(matrix):
+    """Array of pointers to the rows of matrix (a C-contiguous 2D np.array of
+    float64), as lda-c takes its matrices"""
+    return (ctypes.POINTER(ctypes.c_double) * matrix.shape[0])(
+        *[row.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+          for row in matrix])
+
+
+class VariationalInference(object):
+    """Gets topic mixtures the way VariationalHelper does, but in memory
+
+    Calls lda-c's own lda_inference from LDAC_LIB (built along with lda-c), so
+    the topic mixtures are lda-c's, fast approximations of exp and digamma
+    included, without writing files or starting a process.  The model is read
+    the way lda-c reads the files write_ldac_model writes: log topics rounded
+    to 10 decimal places, then to float
+    """
+
+    def __init__(self, topics, dtype):
+        """
+            * topics :: 2D np.array
+                should have shape (vocab size, number of topics), as for
+                VariationalHelper
+            * dtype :: np.dtype
+                dtype of the topic mixtures
+        """
+        self.dtype = dtype
+        self.numtopics = topics.shape[1]
+        self._lib = _ldac_lib()
+        # lda_model.log_prob_w has shape (topics, vocab)
+        log_topics = np.log(np.asarray(topics, dtype=np.float64).T + 0.1e-100)
+        self._log_prob_w = np.ascontiguousarray(
+            np.round(log_topics, 10).astype(np.float32), dtype=np.float64)
+        self._log_prob_w_rows = _row_pointers(self._log_prob_w)
+        self._model = _LdacModel(float(np.float32(LDAC_ALPHA)),
+                                 self._log_prob_w_rows,
+                                 self.numtopics,
+                                 topics.shape[0])
+        # scratch buffers, one set per thread
+        self._local = threading.local()
+
+    def _buffers(self, length):
+        """This thread's scratch buffers for a document of length distinct
+        words: its words and counts (as C ints), and phi, with one row per
+        word and pointers to its rows"""
+        local = self._local
+        if getattr(local, 'capacity', 0) < length:
+            local.capacity = max(length, 2 * getattr(local, 'capacity', 0))
+            local.words = np.empty(local.capacity, dtype=np.intc)
+            local.counts = np.empty(local.capacity, dtype=np.intc)
+            local.phi = np.empty((local.capacity, self.numtopics))
+            local.phi_rows = _row_pointers(local.phi)
+            local.gamma = np.empty(self.numtopics)
+        return local
+
+    def doc_topics(self, ids, counts, out):
+        """Computes the topic mixture (lda-c's gamma) of one non-empty
+        document
+
+            * ids :: 1D np.array
+                distinct word ids of the document
+            * counts :: 1D np.array
+                number of times each word in ids occurs in the document
+            * out :: 1D np.array
+                gets the topic mixture (float64)
+        """
+        length = len(ids)
+        local = self._buffers(length)
+        local.words[:length] = ids
+        local.counts[:length] = counts
+        doc = _LdacDocument(
+            local.words.ctypes.data_as(ctypes.POINTER(ctypes.c_int)),
+            local.counts.ctypes.data_as(ctypes.POINTER(ctypes.c_int)),
+            length,
+            int(local.counts[:length].sum()))
+        self._lib.lda_inference(
+            ctypes.byref(doc),
+            ctypes.byref(self._model),
+            local.gamma.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),
+            local.phi_rows)
+        out[:] = local.gamma
+        return out
+
+    def predict_topics(self, batch):
+        """Compute topic mixtures
+
+            * batch :: DocBatch
+        Assumes that all documents in batch are non-empty
+        """
+        counts = batch.counts
+        result = np.empty((len(batch), self.numtopics))
+        for i in range(len(batch)):
+            start, stop = counts.indptr[i], counts.indptr[i+1]
+            self.doc_topics(counts.indices[start:stop],
+                            counts.data[start:stop],
+                            result[i])
+        return result.astype(self.dtype, copy=False)
+
+
+class SingleDocScorer(object):
+    """Predicts labels one document at a time, entirely in memory
+
+    Skips what predict does to handle batches: topic mixtures are inferred in
+    memory (see OnlineInference, VariationalInference, and SamplingInference)
+    into per-thread buffers, and linear and free classifiers get scored with
+    dense weights laid out ahead of time by word, so no sparse matrices get
+    built.  Classifiers that could only be pickled still get their features
+    as a one-row sparse matrix.
+    """
+
+    # pylint:disable-msg=too-many-arguments
+    def __init__(self, inference, numtopics, corpus_to_train_vocab, vocabsize,
+                 dtype, predictor_kind, arrays, selected_words=None,
+                 predictor=None):
+        """
+            * inference :: object
+                has doc_topics (e.g., OnlineInference)
+            * numtopics :: int
+            * corpus_to_train_vocab :: 1D np.array
+            * vocabsize :: int
+            * dtype :: np.dtype
+                dtype of topic mixtures
+            * predictor_kind :: str
+                'free', 'linear', or 'pickle'
+            * arrays :: {str: np.array}
+                arrays for the predictor, as AbstractClassifyingAnchor.export
+                writes them ('class_given_word' is the scipy.sparse matrix of
+                a free classifier)
+            * selected_words :: 1D np.array
+                word ids whose counts are features, or None for all words
+            * predictor :: sklearn-style classifier
+                used if predictor_kind is 'pickle'
+        """
+        self.inference = inference
+        self.numtopics = numtopics
+        self.lookup = np.asarray(corpus_to_train_vocab, dtype=np.int64)
+        self.vocabsize = vocabsize
+        self.dtype = dtype
+        self.predictor_kind = predictor_kind
+        self.selected_words = selected_words
+        self.predictor = predictor
+        self.classes = np.asarray(arrays['classes'])
+        # scratch buffers, one set per thread
+        self._local = threading.local()
+        if predictor_kind == 'linear':
+            coef = np.asarray(arrays['coef'], dtype=np.float64)
+            self.topic_weights = np.ascontiguousarray(coef[:, :numtopics])
+            # word_weights[w] holds the weights of the count of word w
+            self.word_weights = np.zeros((vocabsize, coef.shape[0]))
+            if selected_words is None:
+                self.word_weights[:] = coef[:, numtopics:].T
+            else:
+                self.word_weights[selected_words] = coef[:, numtopics:].T
+            self.intercept = np.asarray(arrays['intercept'],
+                                        dtype=np.float64)
+        elif predictor_kind == 'free':
+            self.topic_weights = np.asarray(arrays['weights'])
+            class_given_word = arrays['class_given_word']
+            # word ids past the end of class_given_word (i.e., label
+            # pseudo-words) get no weight
+            self.word_weights = np.zeros((vocabsize,
+                                          class_given_word.shape[0]))
+            self.word_weights[:class_given_word.shape[1]] = \
+                class_given_word.T.toarray()
+
+    def _infer(self, ids, counts):
+        """Returns the topic mixture of the document, in this thread's scratch
+        buffer"""
+        topic_mix = getattr(self._local, 'topic_mix', None)
+        if topic_mix is None:
+            topic_mix = self._local.topic_mix = np.empty(self.numtopics)
+        if not len(ids):
+            topic_mix.fill(1.0/self.numtopics)
+        else:
+            self.inference.doc_topics(ids, counts, topic_mix)
+        if self.dtype != topic_mix.dtype:
+            # round as predict would
+            topic_mix[:] = topic_mix.astype(self.dtype)
+        return topic_mix
+
+    def _batch(self, ids, counts):
+        """DocBatch of the document with words ids and counts"""
+        return DocBatch(
+            scipy.sparse.csr_matrix(
+                (counts, ids, np.array([0, len(ids)])),
+                shape=(1, self.vocabsize)),
+            np.array([counts.sum()], dtype=np.int64),
+            np.zeros(1, dtype=np.int64))
+
+    def predict_one(self, tokens):
+        """Predict label of one document
+
+            * tokens :: [int]
+                token ids in corpus space
+        """
+        tokens = self.lookup[np.asarray(tokens, dtype=np.int64)]
+        ids, counts = np.unique(tokens[tokens >= 0], return_counts=True)
+        counts = counts.astype(np.float64)
+        topic_mix = self._infer(ids, counts)
+        if self.predictor_kind == 'pickle':
+            batch = self._batch(ids, counts)
+            if self.selected_words is not None:
+                batch = DocBatch(batch.counts[:, self.selected_words],
+                                 batch.lengths,
+                                 batch.order)
+            return self.predictor.predict(build_features(
+                topic_mix[np.newaxis].astype(self.dtype),
+                batch,
+                self.dtype))[0]
+        scores = self.topic_weights.dot(topic_mix)
+        word_scores = counts.dot(self.word_weights[ids])
+        if self.predictor_kind == 'free':
+            scores /= scores.sum()
+            word_score_sum = word_scores.sum()
+            if word_score_sum != 0:
+                scores += word_scores / word_score_sum
+            return self.classes[np.argmax(scores)]
+        scores += word_scores
+        scores += self.intercept
+        if len(scores) == 1:
+            # binary linear classifiers only score the second class
+            return self.classes[int(scores[0] > 0)]
+        return self.classes[np.argmax(scores)]
+
+
+def write_export(path, meta, arrays):
+    """Writes an export directory
+
+        * path :: str
+            directory to write to (created if need be)
+        * meta :: {str: ?}
+            JSON-serializable description of the model
+        * arrays :: {str: np.array}
+            written uncompressed as path/name.npy, so that they can be
+            memory-mapped
+    The description gets written last, so that a partially written export
+    cannot be loaded
+    """
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name+'.npy'),
+                np.asarray(array),
+                allow_pickle=False)
+    meta = dict(meta, version=EXPORT_VERSION, arrays=sorted(arrays))
+    with open(os.path.join(path, EXPORT_META), 'w') as ofh:
+        json.dump(meta, ofh, indent=2, sort_keys=True)
+
+
+# pylint:disable-msg=too-many-instance-attributes
+class ExportedModel(object):
+    """Trained model loaded from an export directory
+
+    Only has what prediction needs; arrays are memory-mapped from the export
+    directory, so loading takes about as long as reading model.json
+    """
+
+    def __init__(self, path):
+        """
+            * path :: str
+                export directory written by AbstractClassifyingAnchor.export
+        """
+        with open(os.path.join(path, EXPORT_META)) as ifh:
+            meta = json.load(ifh)
+        if meta['version'] != EXPORT_VERSION:
+            raise Exception('Unsupported export version: '+str(meta['version']))
+        self.path = path
+        self.meta = meta
+        self.arrays = {name: np.load(os.path.join(path, name+'.npy'),
+                                     mmap_mode='r',
+                                     allow_pickle=False)
+                       for name in meta['arrays']}
+        self.numtopics = meta['numtopics']
+        self.vocabsize = meta['vocabsize']
+        self.dtype = np.dtype(meta['dtype'])
+        self.classorder = meta['classorder']
+        self.corpus_to_train_vocab = self.arrays['corpus_to_train_vocab']
+        self.selected_words = self.arrays.get('selected_words')
+        self.classes = self.arrays['classes']
+        self.predictor_kind = meta['predictor']
+        self.predictor = None
+        if self.predictor_kind == 'free':
+            self.class_given_word = scipy.sparse.csr_matrix(
+                (self.arrays['class_given_word_data'],
+                 self.arrays['class_given_word_indices'],
+                 self.arrays['class_given_word_indptr']),
+                shape=tuple(meta['class_given_word_shape']))
+        elif self.predictor_kind == 'pickle':
+            # anything that is not linear gets pickled, so unpickling it
+            # imports whatever it was built with
+            with open(os.path.join(path, 'predictor.pkl'), 'rb') as ifh:
+                self.predictor = pickle.load(ifh)
+            if meta.get('svmlight_models'):
+                # SVMLight reads its models from the copies in the export
+                self.predictor.model_prefix = os.path.join(
+                    path, EXPORT_SVMLIGHT_DIR, 'model')
+        if meta['helper'] == 'OnlineHelper':
+            self.lda = OnlineInference(self.arrays['topic_word'], self.dtype)
+        elif meta['helper'] == 'VariationalHelper':
+            self.lda = LdacInference(os.path.join(path, EXPORT_LDAC_MODEL),
+                                     self.dtype)
+        elif meta['helper'] == 'SamplingHelper':
+            self.lda = SamplingInference(self.arrays['topics'],
+                                         meta['samples'])
+        else:
+            raise Exception('Unsupported helper: '+meta['helper'])
+        # number of documents that predict_topics last skipped inference on
+        # because they were duplicates of other documents in the batch
+        self.duplicate_docs = 0
+        self._scorer = None
+
+    def batch(self, tokenses):
+        """Makes DocBatch in training set vocabulary space
+
+            * tokenses :: [[int]]
+                documents as token ids in corpus space
+        """
+        return DocBatch.from_tokens(tokenses,
+                                    self.vocabsize,
+                                    self.corpus_to_train_vocab)
+
+    def predict_topics(self, batch):
+        """Predict topic mixtures for batch (in training set space)"""
+        result, self.duplicate_docs = infer_topic_mixes(
+            self.lda.predict_topics, batch, self.numtopics, self.dtype)
+        return result
+
+    def features(self, batch):
+        """Topic mixtures followed by (selected) word counts, as the model's
+        classifier was trained on"""
+        topic_mixes = self.predict_topics(batch)
+        if self.selected_words is not None:
+            batch = DocBatch(batch.counts[:, self.selected_words],
+                             batch.lengths,
+                             batch.order)
+        return build_features(topic_mixes, batch, self.dtype)
+
+    def decision_function(self, tokenses):
+        """Score each class (columns, in the order of classes) for each
+        document in tokenses
+
+        Not available for models whose classifier got pickled
+        """
+        batch = self.batch(tokenses)
+        if self.predictor_kind == 'free':
+            return free_decision_function(self.predict_topics(batch),
+                                          batch,
+                                          self.arrays['weights'],
+                                          self.class_given_word,
+                                          FREE_CHUNK_SIZE)
+        if self.predictor_kind == 'linear':
+            scores = self.features(batch).dot(self.arrays['coef'].T) + \
+                self.arrays['intercept']
+            return np.asarray(scores)
+        raise Exception('No decision function for a pickled classifier')
+
+    def predict(self, tokenses):
+        """Predict labels
+
+            * tokenses :: [[int]]
+                documents as token ids in corpus space
+        """
+        if self.predictor_kind == 'pickle':
+            return self.predictor.predict(self.features(self.batch(tokenses)))
+        scores = self.decision_function(tokenses)
+        if scores.shape[1] == 1:
+            # binary linear classifiers only score the second class
+            return self.classes[(scores[:, 0] > 0).astype(np.int64)]
+        return self.classes[np.argmax(scores, axis=1)]
+
+    def predict_parallel(self, tokenses, workers):
+        """Predict labels on a pool of workers threads (see predict_parallel)
+        """
+        return predict_parallel(self.predict, tokenses, workers)
+
+    def predict_one(self, tokens):
+        """Predict label of one document, entirely in memory (see
+        SingleDocScorer)
+
+            * tokens :: [int]
+                token ids in corpus space
+        """
+        if self._scorer is None:
+            arrays = dict(self.arrays)
+            if self.predictor_kind == 'free':
+                arrays['class_given_word'] = self.class_given_word
+            inference = self.lda
+            if isinstance(inference, LdacInference):
+                inference = VariationalInference(self.arrays['topics'],
+                                                 self.dtype)
+            self._scorer = SingleDocScorer(inference,
+                                           self.numtopics,
+                                           self.corpus_to_train_vocab,
+                                           self.vocabsize,
+                                           self.dtype,
+                                           self.predictor_kind,
+                                           arrays,
+                                           self.selected_words,
+                                           self.predictor)
+        return self._scorer.predict_one(tokens)
+
+
+def load(path):
+    """Loads a model written by AbstractClassifyingAnchor.export
+
+    See ExportedModel for parameters
+    """
+    return ExportedModel(path)
+
+
+def load_model(path):
+    """Loads a trained model
+
+        * path :: str
+            an export directory (see AbstractClassifyingAnchor.export), a
+            pickled model, or a .results file written by submain.py
+    """
+    if os.path.isdir(path):
+        return load(path)
+    with open(path, 'rb') as ifh:
+        loaded = pickle.load(ifh)
+    if isinstance(loaded, dict):
+        return loaded['model']
+    return loaded
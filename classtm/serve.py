@@ -0,0 +1,272 @@
+"""Long-running prediction server for trained ClassTM models
+
+Clients send newline-delimited JSON over a Unix or TCP socket, one request per
+line: either a list of token ids, or {"model": name, "tokens": [token ids]}
+(with an optional "id", which is echoed back).  Each request gets one line
+back, in the order requests were sent on that connection: {"label": label} or
+{"error": message}.
+
+Requests that arrive within a short window of each other (from any number of
+connections) are scored together in one call to the model's predict, which
+runs on a worker pool so that slow batches do not hold up the event loop.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import signal
+
+import numpy as np
+
+import classtm.scoring
+
+
+# seconds the first request of a batch waits for others to join it
+BATCH_WINDOW = 0.005
+# most requests scored in one call to predict
+MAX_BATCH = 256
+
+
+class MicroBatcher(object):
+    """Coalesces concurrent prediction requests for one model into batches
+
+    Up to concurrency batches get scored at once; while they are, new requests
+    pile up into the next batch
+    """
+
+    # pylint:disable-msg=too-many-arguments
+    def __init__(self, model, executor, window=BATCH_WINDOW,
+                 max_batch=MAX_BATCH, concurrency=1):
+        """
+            * model :: AbstractClassifyingAnchor or ExportedModel
+            * executor :: concurrent.futures.Executor
+                worker pool that predict runs on
+            * window :: float
+                seconds the first request of a batch waits for others
+            * max_batch :: int
+                most requests in a batch
+            * concurrency :: int
+                most batches scored at once
+        """
+        self.model = model
+        self.executor = executor
+        self.window = window
+        self.max_batch = max_batch
+        self.concurrency = concurrency
+        # batches being scored
+        self._scoring = set()
+        self.vocab_size = len(model.corpus_to_train_vocab)
+        self.queue = asyncio.Queue()
+        # number of batches and requests scored so far
+        self.batches = 0
+        self.requests = 0
+
+    async def predict(self, tokens):
+        """Predicts the label of one document
+
+            * tokens :: [int]
+                token ids in corpus space
+        """
+        tokens = np.asarray(tokens, dtype=np.int64)
+        if tokens.ndim != 1:
+            raise ValueError('tokens must be a list of token ids')
+        if len(tokens) and (tokens.min() < 0 or
+                            tokens.max() >= self.vocab_size):
+            raise ValueError('token ids must be in [0, {:d})'.format(
+                self.vocab_size))
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((tokens, future))
+        return await future
+
+    async def run(self):
+        """Scores batches of requests as they come in, forever"""
+        slots = asyncio.Semaphore(self.concurrency)
+        while True:
+            await slots.acquire()
+            pending = [await self.queue.get()]
+            if self.window > 0 and self.queue.qsize() < self.max_batch - 1:
+                await asyncio.sleep(self.window)
+            while len(pending) < self.max_batch and not self.queue.empty():
+                pending.append(self.queue.get_nowait())
+            task = asyncio.ensure_future(self._score(pending, slots))
+            self._scoring.add(task)
+            task.add_done_callback(self._scoring.discard)
+
+    async def _score(self, pending, slots):
+        """Scores one batch of (tokens, future) and releases its slot"""
+        try:
+            labels = await asyncio.get_event_loop().run_in_executor(
+                self.executor,
+                self.model.predict,
+                [tokens for tokens, _ in pending])
+        # pylint:disable-msg=broad-except
+        except Exception as err:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(err)
+            return
+        finally:
+            slots.release()
+        self.batches += 1
+        self.requests += len(pending)
+        for (_, future), label in zip(pending, np.asarray(labels).tolist()):
+            # the client may have gone away in the meantime
+            if not future.done():
+                future.set_result(label)
+
+
+class PredictionServer(object):
+    """Serves predictions from one or more models over a socket"""
+
+    def __init__(self, models, workers=None, window=BATCH_WINDOW,
+                 max_batch=MAX_BATCH):
+        """
+            * models :: {str: model}
+                models by the name requests refer to them by; requests that
+                name no model go to the first one
+            * workers :: int
+                size of the worker pool (default is the number of CPUs); each
+                model may have up to this many batches scored at once
+            * window :: float
+            * max_batch :: int
+                see MicroBatcher
+        """
+        workers = workers or os.cpu_count() or 1
+        self.default_model = next(iter(models))
+        self.executor = ThreadPoolExecutor(workers)
+        self.batchers = {name: MicroBatcher(model,
+                                            self.executor,
+                                            window,
+                                            max_batch,
+                                            workers)
+                         for name, model in models.items()}
+        self.max_pipelined = max_batch
+
+    async def respond(self, line):
+        """Gets the response to one request line"""
+        response = {}
+        try:
+            request = json.loads(line.decode())
+            if isinstance(request, dict):
+                if 'id' in request:
+                    response['id'] = request['id']
+                name = request.get('model', self.default_model)
+                tokens = request['tokens']
+            else:
+                name = self.default_model
+                tokens = request
+            if name not in self.batchers:
+                raise KeyError('No model named '+str(name))
+            response['label'] = await self.batchers[name].predict(tokens)
+        # pylint:disable-msg=broad-except
+        except Exception as err:
+            response['error'] = '{:s}: {:s}'.format(type(err).__name__,
+                                                    str(err))
+        return response
+
+    async def handle(self, reader, writer):
+        """Serves one connection
+
+        Requests are read as fast as they come, so that several requests on
+        one connection can share a batch; responses are written in request
+        order
+        """
+        responses = asyncio.Queue(self.max_pipelined)
+
+        async def write_responses():
+            while True:
+                response = await responses.get()
+                if response is None:
+                    break
+                writer.write((json.dumps(await response)+'\n').encode())
+                await writer.drain()
+
+        writing = asyncio.ensure_future(write_responses())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                await responses.put(asyncio.ensure_future(self.respond(line)))
+            await responses.put(None)
+            await writing
+        except ConnectionError:
+            writing.cancel()
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path=None, host='127.0.0.1', port=None):
+        """Listens on the Unix socket at socket_path, or else on host:port,
+        until cancelled or sent SIGTERM"""
+        batching = [asyncio.ensure_future(batcher.run())
+                    for batcher in self.batchers.values()]
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(self.handle, socket_path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        serving = asyncio.ensure_future(server.serve_forever())
+        asyncio.get_event_loop().add_signal_handler(signal.SIGTERM,
+                                                    serving.cancel)
+        try:
+            await serving
+        except asyncio.CancelledError:
+            pass
+        finally:
+            server.close()
+            for task in batching:
+                task.cancel()
+            self.executor.shutdown(wait=False)
+            if socket_path is not None and os.path.exists(socket_path):
+                os.remove(socket_path)
+
+
+def parse_model_args(model_args):
+    """Parses name=path model arguments (a bare path is named by its base
+    name) into {name: path}, in the order given"""
+    result = {}
+    for model_arg in model_args:
+        if '=' in model_arg:
+            name, path = model_arg.split('=', 1)
+        else:
+            path = model_arg
+            name = os.path.basename(os.path.normpath(path))
+        result[name] = path
+    return result
+
+
+def add_arguments(parser):
+    """Adds arguments of the serve command to parser"""
+    parser.add_argument('models', nargs='+',
+                        help='models to serve, as [name=]path, where path is '
+                        'an export directory or a pickled model or results')
+    listen = parser.add_mutually_exclusive_group(required=True)
+    listen.add_argument('--socket', help='path of Unix socket to listen on')
+    listen.add_argument('--port', type=int, help='TCP port to listen on')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='TCP address to listen on')
+    parser.add_argument('--workers', type=int,
+                        help='size of the prediction worker pool')
+    parser.add_argument('--window', type=float, default=BATCH_WINDOW*1000,
+                        help='milliseconds a request waits for others to '
+                        'share its batch')
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH,
+                        help='most requests scored at once')
+
+
+def main(args):
+    """Runs the serve command"""
+    models = {name: classtm.scoring.load_model(path)
+              for name, path in parse_model_args(args.models).items()}
+    server = PredictionServer(models,
+                              args.workers,
+                              args.window / 1000,
+                              args.max_batch)
+    where = args.socket if args.socket else \
+        '{:s}:{:d}'.format(args.host, args.port)
+    print('# serving', ', '.join(models), 'on', where, flush=True)
+    try:
+        asyncio.run(server.serve(args.socket, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,212 @@
+"""Streaming batch prediction with trained ClassTM models
+
+Documents are read, tokenized, scored, and written a chunk at a time, with
+reading, inference, and writing each on their own thread and bounded queues
+between them, so memory use stays the same no matter how many documents there
+are
+"""
+import os
+import pickle
+import queue
+import resource
+import sys
+import threading
+import time
+
+import ankura.tokenize
+
+import classtm.corpus
+import classtm.scoring
+
+
+# documents scored per call to predict
+CHUNK_SIZE = 1024
+# chunks each stage of the pipeline may get ahead of the next one
+QUEUE_DEPTH = 2
+# marks the end of the items in a prefetch queue
+_DONE = object()
+
+
+class _Failure(object):
+    """Carries an exception raised on a prefetch thread"""
+
+    def __init__(self, err):
+        self.err = err
+
+
+def prefetch(iterable, depth=QUEUE_DEPTH):
+    """Iterates over iterable on a separate thread, staying at most depth
+    items ahead of the consumer
+
+    Exceptions raised by iterable get raised again in the consumer
+    """
+    items = queue.Queue(depth)
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        # pylint:disable-msg=broad-except
+        except BaseException as err:
+            items.put(_Failure(err))
+        else:
+            items.put(_DONE)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    while True:
+        item = items.get()
+        if item is _DONE:
+            break
+        if isinstance(item, _Failure):
+            raise item.err
+        yield item
+    thread.join()
+
+
+def load_vocab(path):
+    """Gets {word: token id} of a corpus
+
+        * path :: str
+            a pickled dataset or corpus directory (whose vocab is used), or a
+            text file with one word per line (line i having the word with
+            token id i)
+    """
+    if os.path.isdir(path):
+        vocab = classtm.corpus.load_corpus(path).vocab
+    else:
+        with open(path, 'rb') as ifh:
+            # binary pickles start with the PROTO opcode
+            if ifh.read(1) == pickle.PROTO:
+                ifh.seek(0)
+                vocab = pickle.load(ifh).vocab
+            else:
+                vocab = None
+    if vocab is None:
+        with open(path) as ifh:
+            vocab = [line.rstrip('\n') for line in ifh]
+    return {word: i for i, word in enumerate(vocab)}
+
+
+def read_chunks(lines, tokenizer, vocab, chunk_size=CHUNK_SIZE, titled=False):
+    """Tokenizes documents, a chunk at a time
+
+        * lines :: iterable of str
+            one document per line
+        * tokenizer :: function(str) -> [str]
+        * vocab :: {str: int}
+            words not in vocab are dropped
+        * chunk_size :: int
+        * titled :: bool
+            if True, each line starts with the document's title, followed by a
+            tab
+    Yields ([title], [[token id]]); titles are None if not titled
+    """
+    titles = []
+    tokenses = []
+    for line in lines:
+        line = line.rstrip('\n')
+        if titled:
+            title, line = line.split('\t', 1)
+        else:
+            title = None
+        titles.append(title)
+        tokenses.append([vocab[word] for word in tokenizer(line)
+                         if word in vocab])
+        if len(tokenses) == chunk_size:
+            yield titles, tokenses
+            titles = []
+            tokenses = []
+    if tokenses:
+        yield titles, tokenses
+
+
+def predict_chunks(model, chunks, workers=1):
+    """Yields ([title], [label]) for each chunk of ([title], [[token id]]),
+    with each chunk split across workers threads"""
+    for titles, tokenses in chunks:
+        yield titles, classtm.scoring.predict_parallel(model.predict,
+                                                       tokenses,
+                                                       workers)
+
+
+def peak_rss():
+    """Peak resident set size of this process, in bytes"""
+    # Linux reports kilobytes; macOS reports bytes
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+# pylint:disable-msg=too-many-arguments
+def run(model, lines, ofh, tokenizer, vocab, chunk_size=CHUNK_SIZE,
+        titled=False, depth=QUEUE_DEPTH, workers=1):
+    """Writes a prediction for each document in lines to ofh
+
+    Each output line is the predicted label, preceded by the title and a tab
+    if titled; each chunk gets scored on workers threads (see read_chunks for
+    the other parameters)
+
+    Returns the number of documents scored
+    """
+    chunks = prefetch(read_chunks(lines, tokenizer, vocab, chunk_size, titled),
+                      depth)
+    count = 0
+    for titles, labels in prefetch(predict_chunks(model, chunks, workers),
+                                   depth):
+        for title, label in zip(titles, labels):
+            if titled:
+                ofh.write(title+'\t')
+            ofh.write(str(label)+'\n')
+        count += len(labels)
+    ofh.flush()
+    return count
+
+
+def add_arguments(parser):
+    """Adds arguments of the predict command to parser"""
+    parser.add_argument('model',
+                        help='export directory, pickled model, or results')
+    parser.add_argument('vocab',
+                        help='pickled dataset or corpus directory the model '
+                        'was trained on, or a file with one word of its '
+                        'vocabulary per line')
+    parser.add_argument('input', nargs='?', default='-',
+                        help='file with one document per line (default: '
+                        'stdin)')
+    parser.add_argument('--output', default='-',
+                        help='file to write labels to (default: stdout)')
+    parser.add_argument('--tokenizer', default='simple',
+                        help='name of the ankura.tokenize function the corpus '
+                        'was tokenized with')
+    parser.add_argument('--titled', action='store_true',
+                        help='lines start with a title and a tab, and the '
+                        'title is written before each label')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='documents scored at a time')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='threads each chunk is split across')
+
+
+def main(args):
+    """Runs the predict command"""
+    model = classtm.scoring.load_model(args.model)
+    vocab = load_vocab(args.vocab)
+    tokenizer = getattr(ankura.tokenize, args.tokenizer)
+    ifh = sys.stdin if args.input == '-' else open(args.input)
+    ofh = sys.stdout if args.output == '-' else open(args.output, 'w')
+    start = time.time()
+    try:
+        count = run(model, ifh, ofh, tokenizer, vocab, args.chunk_size,
+                    args.titled, workers=args.workers)
+    finally:
+        if ifh is not sys.stdin:
+            ifh.close()
+        if ofh is not sys.stdout:
+            ofh.close()
+    seconds = time.time() - start
+    sys.stderr.write(
+        '# {:d} documents in {:.2f} s ({:.1f} documents/s); '
+        'peak RSS {:.1f} MB\n'.format(count,
+                                      seconds,
+                                      count / seconds if seconds else 0.0,
+                                      peak_rss() / 2**20))
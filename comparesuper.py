@@ -8,8 +8,10 @@ import socket
 import time
 
 from activetm import utils
+import classtm.corpus
 import classtm.labeled
 import classtm.models
+import classtm.pickling
 from classtm import evaluate
 
 import submain
@@ -48,8 +50,7 @@ def _run():
         start = time.time()
         input_pickle = os.path.join(args.outputdir,
                                     utils.get_pickle_name(args.settings))
-        with open(input_pickle, 'rb') as ifh:
-            dataset = pickle.load(ifh)
+        dataset = classtm.corpus.load_dataset(input_pickle)
         # print('Got pickle')
         if args.seed == -1:
             rng = random.Random(int(settings['seed']))
@@ -118,6 +119,7 @@ def _run():
             for docid in unlabeled_doc_ids[prev_count:labeled_count]:
                 train_labels.append(dataset.labels[dataset.titles[docid]])
         model.cleanup()
+        classtm.pickling.check_pickled_size(model, 'model')
 
         with open(outprefix+'.results', 'wb') as ofh:
             pickle.dump(results, ofh)
@@ -9,8 +9,10 @@ from threading import Thread
 import time
 
 from activetm import utils
+import classtm.corpus
 import classtm.labeled
 import classtm.models
+import classtm.pickling
 from classtm import evaluate
 
 import submain
@@ -60,8 +62,7 @@ def _run():
         start = time.time()
         input_pickle = os.path.join(args.outputdir,
                                     utils.get_pickle_name(args.settings))
-        with open(input_pickle, 'rb') as ifh:
-            dataset = pickle.load(ifh)
+        dataset = classtm.corpus.load_dataset(input_pickle)
         # print('Got pickle')
         if args.seed == -1:
             rng = random.Random(int(settings['seed']))
@@ -115,6 +116,8 @@ def _run():
                                                                        dataset.classorder)
             results.append({'init_time': init_time,
                             'confusion_matrix': confusion_matrix,
+                            'duplicate_docs': model.duplicate_docs,
+                            'selected_k': model.selected_k,
                             'labeled_count': labeled_count,
                             'anchorwords_time': anchorwords_time,
                             'applytrain_time': applytrain_time,
@@ -134,6 +137,7 @@ def _run():
                                                       dataset.labels[title])
             label_time = datetime.timedelta(seconds=time.time()-start)
         model.cleanup()
+        classtm.pickling.check_pickled_size(model, 'model')
 
         with open(outprefix+'.results', 'wb') as ofh:
             pickle.dump(results, ofh)
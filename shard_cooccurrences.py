@@ -0,0 +1,119 @@
+#! /usr/bin/env python3
+
+"""Computes shards of Q ahead of training, on several hosts at once
+
+Takes the same arguments as submain.py (or incremental_submain.py, for
+incremental models) and builds the dataset that the driver first builds Q for:
+the training set of the model, or the incrementally labeled dataset once its
+initial documents have been labeled.  q_shard_dir (on a filesystem all hosts
+share) and q_shards come from the settings.
+
+Run compute on each host with --shards set to the shards that host should
+compute; once all shards have been written, run merge to add them up into Q in
+q_shard_dir.  Drivers run with the same settings then load that Q instead of
+building it.  Shards of documents whose labels change in later rounds get
+recomputed by the driver as needed.
+"""
+
+import argparse
+import datetime
+import os
+import random
+import time
+
+from activetm import utils
+
+import classtm.corpus
+import classtm.labeled
+import classtm.models
+
+import submain
+
+
+def parse_args():
+    """Parses arguments"""
+    parser = argparse.ArgumentParser(
+        description='Sharded computation of Q for ClassTM datasets')
+    parser.add_argument('action', choices=['compute', 'merge'],
+                        help='compute shards or merge them into Q')
+    parser.add_argument('settings',
+                        help='settings file, as passed to the driver')
+    parser.add_argument('outputdir',
+                        help='output directory, as passed to the driver')
+    parser.add_argument('seed', default=-1, type=int, nargs='?',
+                        help='seed, as passed to the driver')
+    parser.add_argument('--shards', type=int, nargs='*',
+                        help='indices of shards to compute (default: all)')
+    parser.add_argument('--processes', type=int,
+                        help='number of local worker processes (default: '
+                        'q_shard_processes)')
+    return parser.parse_args()
+
+
+def build_dataset(settingsfile, outputdir, seed):
+    """Builds the dataset the driver builds Q for first, using the random
+    numbers the same way the driver does"""
+    settings = utils.parse_settings(settingsfile)
+    dataset = classtm.corpus.load_dataset(
+        os.path.join(outputdir, utils.get_pickle_name(settingsfile)))
+    if seed == -1:
+        rng = random.Random(int(settings['seed']))
+    else:
+        rng = random.Random(seed)
+    if settings['model'] in classtm.models.INCFACTORY:
+        # as in incremental_submain.py
+        _, train_doc_ids = submain.partition_data_ids(dataset.num_docs,
+                                                      rng,
+                                                      settings)
+        _, incrementaldataset = classtm.models.initialize(rng,
+                                                          dataset,
+                                                          settings)
+        initial_train = [dataset.titles[trainid] for trainid in
+                         train_doc_ids[:int(settings['startlabeled'])]]
+        incrementaldataset.initial_label(
+            initial_train,
+            [dataset.labels[title] for title in initial_train])
+        return incrementaldataset
+    # as in submain.py
+    model = classtm.models.build(rng, settings)
+    _, train_doc_ids = submain.partition_data_ids(dataset.num_docs,
+                                                  rng,
+                                                  settings)
+    known_labels = [dataset.labels[dataset.titles[tid]]
+                    for tid in train_doc_ids]
+    trainingset, _ = model.train_set_builder.build_train_set(dataset,
+                                                             train_doc_ids,
+                                                             known_labels)
+    return trainingset
+
+
+def _run():
+    args = parse_args()
+    start = time.time()
+    dataset = build_dataset(args.settings, args.outputdir, args.seed)
+    if dataset.q_shard_dir is None:
+        raise ValueError('No q_shard_dir in '+args.settings)
+    if args.action == 'compute':
+        ranges = classtm.labeled.shard_ranges(dataset.num_docs,
+                                              dataset.q_shards)
+        if args.shards:
+            ranges = [ranges[i] for i in args.shards]
+        processes = args.processes
+        if processes is None:
+            processes = dataset.q_shard_processes
+        classtm.labeled.write_cooccurrence_shards(dataset,
+                                                  ranges,
+                                                  dataset.q_shard_dir,
+                                                  processes)
+    else:
+        classtm.labeled.merged_cooccurrences(dataset,
+                                             dataset.q_shard_dir,
+                                             dataset.q_shards)
+    end = time.time()
+    print('# {:s} time: {:s}'.format(
+        args.action,
+        str(datetime.timedelta(seconds=end-start))))
+
+
+if __name__ == '__main__':
+    _run()
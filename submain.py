@@ -11,7 +11,9 @@ import socket
 import time
 
 from activetm import utils
+import classtm.corpus
 import classtm.models
+import classtm.pickling
 from classtm import evaluate
 
 
@@ -76,8 +78,7 @@ def _run():
         start = time.time()
         input_pickle = os.path.join(args.outputdir,
                                     utils.get_pickle_name(args.settings))
-        with open(input_pickle, 'rb') as ifh:
-            dataset = pickle.load(ifh)
+        dataset = classtm.corpus.load_dataset(input_pickle)
         # print('Got pickle')
         if args.seed == -1:
             rng = random.Random(int(settings['seed']))
@@ -118,10 +119,13 @@ def _run():
         end = time.time()
         eval_time = datetime.timedelta(seconds=end-start)
         model.cleanup()
+        classtm.pickling.check_pickled_size(model, 'model')
 
         with open(outprefix+'.results', 'wb') as ofh:
             pickle.dump({'init_time': init_time,
                          'confusion_matrix': confusion_matrix,
+                         'duplicate_docs': model.duplicate_docs,
+                         'selected_k': model.selected_k,
                          'train_time': train_time,
                          'eval_time': eval_time,
                          'model': model},